@@ -0,0 +1,424 @@
+"""
+Streaming per-pixel statistics of detector frames.
+
+By default only the per-pixel sum of the frames is accumulated (PixelSum),
+which gives the mean in one pass over each frame. The variance, minimum and
+maximum (PixelStats) cost several more passes per frame, and are only
+accumulated if config.accumulate_moments is True.
+
+PixelStats accumulates in float64. make_accumulator also provides
+reduced-precision accumulators (see config.accumulation_dtype), which
+trade a bounded rounding error (float32) or a restriction to integer data
+(int64) for lower memory traffic; all of them finalize to a float64
+PixelStats.
+"""
+
+import numpy as np
+
+class PixelStats(object):
+    """
+    Single-pass (Welford) accumulator of the per-pixel count, mean, variance,
+    minimum and maximum of a sequence of equally-shaped frames.
+
+    Partial accumulators (e.g. from different MPI ranks, pool workers or runs)
+    are combined with merge(), which implements the pairwise update rule of
+    Chan et al. and gives the same result as accumulating all frames in one
+    instance.
+
+    Instances finalized from a PixelSum hold the mean only (m2, min and max
+    are None). Merging such an instance with any other gives a mean-only
+    instance.
+
+    Attributes:
+    count : int
+        Number of frames accumulated
+    mean, min, max : np.ndarray
+        Per-pixel statistics (None while count == 0)
+    m2 : np.ndarray
+        Per-pixel sum of squared deviations from the mean
+    dtype : str
+        dtype in which frames are accumulated
+    """
+    dtype = 'float64'
+
+    def __init__(self, count = 0, mean = None, m2 = None, min = None, max = None,
+            dtype = 'float64'):
+        self.dtype = dtype
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        self.min = min
+        self.max = max
+
+    def has_moments(self):
+        """
+        Return True if the variance, minimum and maximum are available.
+        """
+        return self.m2 is not None
+
+    @classmethod
+    def from_frames(cls, frames):
+        """
+        Return an instance accumulated from an array of frames stacked along
+        the first axis.
+        """
+        frames = np.asarray(frames, dtype = 'float64')
+        if len(frames) == 0:
+            return cls()
+        mean = frames.mean(axis = 0)
+        return cls(len(frames), mean, ((frames - mean)**2).sum(axis = 0),
+            frames.min(axis = 0), frames.max(axis = 0))
+
+    def add(self, frame):
+        """
+        Accumulate a single frame in place.
+        """
+        frame = np.asarray(frame, dtype = self.dtype)
+        if self.count == 0:
+            self.count = 1
+            self.mean = frame.copy()
+            self.m2 = np.zeros_like(self.mean)
+            self.min = frame.copy()
+            self.max = frame.copy()
+            return self
+        self.count += 1
+        delta = frame - self.mean
+        self.mean += delta / self.count
+        delta *= frame - self.mean
+        self.m2 += delta
+        np.minimum(self.min, frame, out = self.min)
+        np.maximum(self.max, frame, out = self.max)
+        return self
+
+    def merge(self, other):
+        """
+        Return a new instance combining the frames accumulated in self and
+        other.
+        """
+        if other is None or other.count == 0:
+            return self.copy()
+        if self.count == 0:
+            return other.copy()
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        mean = self.mean + delta * (float(other.count) / count)
+        if not (self.has_moments() and other.has_moments()):
+            return PixelStats(count, mean)
+        m2 = self.m2 + other.m2 + delta**2 * (float(self.count) * other.count / count)
+        return PixelStats(count, mean, m2, np.minimum(self.min, other.min),
+            np.maximum(self.max, other.max))
+
+    def merge_in_place(self, other):
+        """
+        Like merge(), but update self's arrays in place (e.g. when they live
+        in shared memory). If self is empty it takes copies of other's arrays
+        (which may be shared with other instances, see shift()). Returns
+        self.
+        """
+        if other is None or other.count == 0:
+            return self
+        if self.count == 0:
+            copied = other.copy()
+            self.count, self.mean, self.m2, self.min, self.max = \
+                copied.count, copied.mean, copied.m2, copied.min, copied.max
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        if self.has_moments() and other.has_moments():
+            self.m2 += other.m2
+            self.m2 += delta**2 * (float(self.count) * other.count / count)
+            np.minimum(self.min, other.min, out = self.min)
+            np.maximum(self.max, other.max, out = self.max)
+        else:
+            self.m2, self.min, self.max = None, None, None
+        delta *= float(other.count) / count
+        self.mean += delta
+        self.count = count
+        return self
+
+    def __add__(self, other):
+        return self.merge(other)
+
+    def finalize(self):
+        """Return the accumulated statistics as a float64 PixelStats."""
+        return self
+
+    def astype(self, dtype):
+        """
+        Return a copy with the per-pixel arrays converted to dtype.
+        """
+        if self.count == 0:
+            return PixelStats(dtype = dtype)
+        return PixelStats(self.count, *[None if arr is None else np.asarray(arr).astype(dtype)
+            for arr in (self.mean, self.m2, self.min, self.max)], dtype = dtype)
+
+    def copy(self):
+        def copy_arr(arr):
+            if arr is None:
+                return None
+            return np.array(arr, copy = True)
+        return PixelStats(self.count, copy_arr(self.mean), copy_arr(self.m2),
+            copy_arr(self.min), copy_arr(self.max), dtype = self.dtype)
+
+    def shift(self, offset):
+        """
+        Return the statistics of the frames with offset subtracted from each
+        one. The variance is unchanged, so m2 is shared with self.
+        """
+        if self.count == 0:
+            return self.copy()
+        if not self.has_moments():
+            return PixelStats(self.count, self.mean - offset)
+        return PixelStats(self.count, self.mean - offset, self.m2,
+            self.min - offset, self.max - offset)
+
+    def variance(self, ddof = 0):
+        """
+        Return the per-pixel variance, normalized by count - ddof.
+        """
+        if self.count - ddof <= 0:
+            raise ValueError("Not enough frames (%d) for ddof = %d" % (self.count, ddof))
+        if not self.has_moments():
+            raise ValueError("The variance wasn't accumulated (see config.accumulate_moments)")
+        return self.m2 / (self.count - ddof)
+
+    def std(self, ddof = 0):
+        return np.sqrt(self.variance(ddof = ddof))
+
+    def allreduce(self, comm):
+        """
+        Collective over comm: return the statistics over the frames
+        accumulated on all ranks, using buffer reductions only (no
+        gathering of per-rank arrays). Ranks without any frames take part
+        with count 0. The moments are only reduced if all non-empty ranks
+        have them, so that mean-only statistics take a single reduction.
+        """
+        from mpi4py import MPI
+        layouts = filter(lambda layout: layout is not None,
+            comm.allgather(None if self.count == 0 else
+                (np.shape(self.mean), self.has_moments())))
+        if not layouts:
+            return PixelStats()
+        shape = layouts[0][0]
+        moments = all(has_moments for _, has_moments in layouts)
+        if self.count == 0:
+            zeros = np.zeros(shape)
+            mean, m2 = zeros, zeros
+            lo = np.full(shape, np.inf)
+            hi = np.full(shape, -np.inf)
+        else:
+            mean = np.asarray(self.mean, dtype = 'float64')
+            if moments:
+                m2, lo, hi = map(lambda arr: np.asarray(arr, dtype = 'float64'),
+                    (self.m2, self.min, self.max))
+        count = comm.allreduce(self.count, op = MPI.SUM)
+        total = np.empty_like(mean)
+        comm.Allreduce(mean * self.count, total, op = MPI.SUM)
+        global_mean = total / count
+        if not moments:
+            return PixelStats(count, global_mean)
+        # M2 = sum over ranks of (M2_i + n_i * (mean_i - mean)**2)
+        local_m2 = m2 + self.count * (mean - global_mean)**2
+        global_m2 = np.empty_like(local_m2)
+        comm.Allreduce(local_m2, global_m2, op = MPI.SUM)
+        global_min = np.empty_like(lo)
+        comm.Allreduce(lo, global_min, op = MPI.MIN)
+        global_max = np.empty_like(hi)
+        comm.Allreduce(hi, global_max, op = MPI.MAX)
+        return PixelStats(count, global_mean, global_m2, global_min, global_max)
+
+def merge_all(stats_list):
+    """
+    Merge an iterable of PixelStats instances (None entries are skipped).
+    """
+    return reduce(lambda x, y: x.merge(y),
+        filter(lambda s: s is not None, stats_list), PixelStats())
+
+class BlockedPixelStats(object):
+    """
+    Accumulator that performs the per-frame (Welford) updates in float32,
+    over blocks of block_size frames, and merges each completed block into
+    float64 totals.
+
+    Per-frame memory traffic is that of float32 arrays, and merging costs
+    O(pixels) once per block. Rounding errors don't accumulate across
+    blocks: the error of the mean is of order block_size * 2**-24 (6e-8)
+    times the largest absolute frame value, and likewise for the standard
+    deviation relative to the spread of the values, independently of the
+    total number of frames.
+    """
+    def __init__(self, block_size = 64):
+        self.block_size = block_size
+        self.total = PixelStats()
+        self.block = PixelStats(dtype = 'float32')
+
+    @property
+    def count(self):
+        return self.total.count + self.block.count
+
+    def _flush(self):
+        self.total.merge_in_place(self.block.astype('float64'))
+        self.block = PixelStats(dtype = 'float32')
+
+    def add(self, frame):
+        self.block.add(frame)
+        if self.block.count >= self.block_size:
+            self._flush()
+        return self
+
+    def finalize(self):
+        self._flush()
+        return self.total
+
+class IntegerPixelStats(object):
+    """
+    Exact accumulator for integer-valued frames (e.g. raw ADU), keeping
+    per-pixel int64 sums and sums of squares.
+
+    Integer sums are exact as long as the sums of squares don't overflow,
+    i.e. for fewer than 2**63 / max(|x|)**2 frames (more than 3e10 frames
+    of 14-bit data). The variance is derived from the sums in float64. If a
+    non-integer frame is added, the accumulated sums are converted to a
+    float64 PixelStats, which accumulates the remaining frames.
+    """
+    def __init__(self):
+        self._count = 0
+        self.sum = None
+        self.sumsq = None
+        self.min = None
+        self.max = None
+        self._fallback = None
+
+    @property
+    def count(self):
+        if self._fallback is not None:
+            return self._fallback.count
+        return self._count
+
+    def add(self, frame):
+        if self._fallback is not None:
+            self._fallback.add(frame)
+            return self
+        frame = np.asarray(frame)
+        if frame.dtype.kind not in 'biu':
+            self._fallback = self.finalize().copy()
+            self._fallback.add(frame)
+            return self
+        if self._count == 0:
+            self.sum = frame.astype('int64')
+            self.sumsq = self.sum**2
+            self.min = self.sum.copy()
+            self.max = self.sum.copy()
+        else:
+            self.sum += frame
+            self.sumsq += np.multiply(frame, frame, dtype = 'int64')
+            np.minimum(self.min, frame, out = self.min)
+            np.maximum(self.max, frame, out = self.max)
+        self._count += 1
+        return self
+
+    def finalize(self):
+        if self._fallback is not None:
+            return self._fallback
+        if self._count == 0:
+            return PixelStats()
+        mean = self.sum / float(self._count)
+        return PixelStats(self._count, mean, self.sumsq - self.sum * mean,
+            self.min.astype('float64'), self.max.astype('float64'))
+
+class PixelSum(object):
+    """
+    Accumulator of the per-pixel sum of a sequence of frames, for when only
+    the mean is needed: each frame is added to the sum in one pass. finalize()
+    returns a mean-only PixelStats.
+
+    With dtype 'int64' the sums of integer frames are exact. If a
+    non-integer frame is added, the sum is converted to float64.
+    """
+    def __init__(self, dtype = 'float64'):
+        self.dtype = dtype
+        self.count = 0
+        self.sum = None
+
+    def add(self, frame):
+        frame = np.asarray(frame)
+        exact = frame.dtype.kind in 'biu'
+        if self.count == 0:
+            self.sum = frame.astype(self.dtype if exact else 'float64')
+        else:
+            if self.sum.dtype.kind == 'i' and not exact:
+                self.sum = self.sum.astype('float64')
+            self.sum += frame
+        self.count += 1
+        return self
+
+    def finalize(self):
+        if self.count == 0:
+            return PixelStats()
+        return PixelStats(self.count, self.sum / float(self.count))
+
+class CompensatedPixelSum(object):
+    """
+    Per-pixel sum of a sequence of frames in float32 with Kahan
+    compensation: a second float32 array carries the low-order bits lost in
+    each addition, and is subtracted from the sum in float64 by finalize().
+
+    The error of the sum is bounded by about 2 * 2**-24 times the sum of the
+    absolute frame values (Higham, Accuracy and Stability of Numerical
+    Algorithms, sec. 4.3), i.e. a relative error of about 1.2e-7 in the mean
+    for non-negative data, independently of the number of frames. A plain
+    float32 sum's error bound grows in proportion to the number of frames.
+    Frames are rounded to float32 when they are added.
+    """
+    def __init__(self):
+        self.count = 0
+        self.sum = None
+        self.compensation = None
+        # scratch arrays, reused for every frame
+        self._y = None
+        self._t = None
+
+    def add(self, frame):
+        frame = np.asarray(frame, dtype = 'float32')
+        if self.count == 0:
+            self.sum = frame.copy()
+            self.compensation = np.zeros_like(self.sum)
+            self._y = np.empty_like(self.sum)
+            self._t = np.empty_like(self.sum)
+        else:
+            y = np.subtract(frame, self.compensation, out = self._y)
+            t = np.add(self.sum, y, out = self._t)
+            np.subtract(t, self.sum, out = self.compensation)
+            self.compensation -= y
+            self.sum, self._t = t, self.sum
+        self.count += 1
+        return self
+
+    def finalize(self):
+        if self.count == 0:
+            return PixelStats()
+        total = self.sum.astype('float64')
+        total -= self.compensation
+        return PixelStats(self.count, total / self.count)
+
+def make_accumulator(dtype = 'float64', block_size = 64, moments = True):
+    """
+    Return an empty accumulator of per-pixel statistics for the given
+    accumulation dtype: 'float64' (PixelStats), 'float32'
+    (BlockedPixelStats) or 'int64' (IntegerPixelStats). If moments is
+    False, only the sum is accumulated (PixelSum in float64 or int64,
+    CompensatedPixelSum in float32). All of them implement add() and
+    finalize(), which returns a PixelStats.
+    """
+    if not moments:
+        if dtype == 'float32':
+            return CompensatedPixelSum()
+        if dtype in ('float64', 'int64'):
+            return PixelSum(dtype)
+    if dtype == 'float64':
+        return PixelStats()
+    elif dtype == 'float32':
+        return BlockedPixelStats(block_size)
+    elif dtype == 'int64':
+        return IntegerPixelStats()
+    raise ValueError("Unsupported accumulation dtype: %s" % str(dtype))
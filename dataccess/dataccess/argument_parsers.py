@@ -80,3 +80,11 @@ def addparser_query(subparsers):
 def addparser_showderived(subparsers):
     config.playback = False
     showderived = subparsers.add_parser('showderived', help = 'output the names of all existing derived datasets.')
+
+def addparser_cache(subparsers):
+    config.playback = False
+    cache = subparsers.add_parser('cache', help = 'Show the contents of the on-disk result cache, and optionally prune or clear it.')
+    cache.add_argument('--prune', '-p', action = 'store_true', help = 'Evict entries older than the maximum age, then least recently used entries until the cache fits in its byte budget (config.cache_max_age and config.cache_max_bytes, unless overridden).')
+    cache.add_argument('--max_bytes', type = int, help = 'Byte budget to prune to.')
+    cache.add_argument('--max_age', type = float, help = 'Maximum age, in days, of entries kept by pruning.')
+    cache.add_argument('--clear', '-c', nargs = '?', const = '', metavar = 'NAMESPACE', help = 'Remove all entries under NAMESPACE (e.g. psget/gsmp), or the whole cache if no namespace is given.')
@@ -0,0 +1,388 @@
+"""
+Content-addressed on-disk cache of function return values.
+
+Each entry is a file <config.cache_dir>/<namespace>/<key>, where the key is
+the fingerprint (see fingerprint.py) of the cached function's arguments. Entries are written atomically
+(to a temporary file that is then renamed), so concurrent readers (e.g.
+other MPI ranks) never see a partial entry, and only the root rank of the
+communicator that looked the entry up writes it.
+
+The total size of the cache is bounded by config.cache_max_bytes (None for
+no limit): each process keeps a running total of the cache size, and when a
+write takes it over the budget (or every PRUNE_INTERVAL writes, to account
+for other processes' writes) the least recently used entries (by file
+modification time, which is updated on every hit) are evicted until the
+cache fits in its budget. Entries older than config.cache_max_age seconds
+are evicted by prune(). Eviction is serialized across processes with a lock
+file in the cache directory.
+
+With MPI, every rank calls the cached functions, and ranks that miss go on
+to evaluate the function collectively. load_shared() therefore lets the root
+rank alone look an entry up and broadcasts the outcome (and the value), so
+that all ranks agree on hits and misses even while the root evicts entries.
+
+Arrays of at least config.cache_memmap_min_bytes bytes (e.g. mean frames and
+stacks of per-event frames) aren't pickled into the entry: each is saved as
+a .npy file in a directory next to it, and loading the entry maps them
+(copy-on-write) instead of reading them. Opening a large cached result is
+therefore fast, and only the pages that are actually used are read.
+"""
+
+import os
+import time
+import uuid
+import fcntl
+import shutil
+import functools
+import glob
+import pickle
+from collections import OrderedDict
+import dill
+import numpy as np
+
+import config
+import fingerprint
+import workqueue
+from output import log
+
+LOCK_NAME = '.lock'
+ARRAYS_SUFFIX = '.arrays'
+
+# Number of writes after which the cache size is recomputed from disk
+PRUNE_INTERVAL = 64
+# Number of return values of each persist_to_file function kept in memory
+MEMO_SIZE = 8
+
+class _ArrayPickler(dill.Pickler):
+    """
+    Pickler that saves large arrays to .npy files in arrays_dir and pickles
+    references to them.
+    """
+    def __init__(self, f, arrays_dir, min_bytes):
+        dill.Pickler.__init__(self, f, protocol = 2)
+        self.arrays_dir = arrays_dir
+        self.min_bytes = min_bytes
+        # id -> (array, reference), so that shared arrays are saved once
+        self.saved = {}
+
+    def persistent_id(self, obj):
+        if (self.min_bytes is None or not isinstance(obj, np.ndarray)
+                or obj.dtype.hasobject or obj.nbytes < self.min_bytes):
+            return None
+        if id(obj) in self.saved:
+            return self.saved[id(obj)][1]
+        if not os.path.isdir(self.arrays_dir):
+            os.makedirs(self.arrays_dir)
+        name = '%d.npy' % len(self.saved)
+        np.save(os.path.join(self.arrays_dir, name), obj)
+        reference = '%s/%s' % (os.path.basename(self.arrays_dir), name)
+        self.saved[id(obj)] = (obj, reference)
+        return reference
+
+class _ArrayUnpickler(dill.Unpickler):
+    """
+    Unpickler that maps the arrays referenced by _ArrayPickler.
+    """
+    def __init__(self, f, dirname):
+        dill.Unpickler.__init__(self, f)
+        self.dirname = dirname
+
+    def persistent_load(self, pid):
+        return np.load(os.path.join(self.dirname, pid), mmap_mode = 'c')
+
+def _dir_size(path):
+    return sum(os.path.getsize(os.path.join(dirpath, name))
+        for dirpath, _, filenames in os.walk(path) for name in filenames)
+
+class DiskCache(object):
+    """
+    On-disk cache rooted at directory root.
+
+    Attributes hits, misses, bytes_read, bytes_written and evictions count
+    this process's cache activity.
+    """
+    def __init__(self, root, max_bytes = None, max_age = None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.evictions = 0
+        # running total of the cache size (None until computed), and number
+        # of writes since it was
+        self.size = None
+        self.writes = 0
+
+    def path(self, namespace, key):
+        return os.path.join(self.root, namespace, key)
+
+    def load(self, namespace, key):
+        """
+        Return the value stored under key. Raises KeyError if there isn't
+        one (or it can't be read).
+        """
+        path = self.path(namespace, key)
+        try:
+            with open(path, 'rb') as f:
+                value = _ArrayUnpickler(f, os.path.dirname(path)).load()
+            size = os.path.getsize(path)
+            os.utime(path, None)
+        except (IOError, OSError):
+            self.misses += 1
+            raise KeyError(key)
+        except (EOFError, ValueError, pickle.UnpicklingError), e:
+            log('discarding unreadable cache entry %s: %s' % (path, str(e)))
+            self.misses += 1
+            raise KeyError(key)
+        self.hits += 1
+        self.bytes_read += size
+        return value
+
+    def load_shared(self, namespace, key):
+        """
+        Like load(), but collective over the ranks of shared_comm(): the
+        root rank looks the entry up and broadcasts the result.
+        """
+        comm = shared_comm()
+        if comm is None:
+            return self.load(namespace, key)
+        if comm.Get_rank() == 0:
+            try:
+                found = (True, self.load(namespace, key))
+            except KeyError:
+                found = (False, None)
+        else:
+            found = None
+        hit, value = workqueue.bcast_arrays(comm, found)
+        if not hit:
+            raise KeyError(key)
+        return value
+
+    def store(self, namespace, key, value, shared = True):
+        """
+        Store value under key, then evict entries as needed to stay within
+        max_bytes.
+
+        If shared is True, only the root rank of shared_comm() (the ranks
+        that agreed on the miss in load_shared()) writes the entry;
+        otherwise every caller does.
+        """
+        comm = shared_comm() if shared else None
+        if comm is not None and comm.Get_rank() != 0:
+            return
+        path = self.path(namespace, key)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError: # created concurrently
+                pass
+        token = uuid.uuid4().hex
+        tmp_path = '%s.%s.tmp' % (path, token)
+        arrays_dir = '%s.%s%s' % (path, token, ARRAYS_SUFFIX)
+        with open(tmp_path, 'wb') as f:
+            _ArrayPickler(f, arrays_dir, config.cache_memmap_min_bytes).dump(value)
+        os.rename(tmp_path, path)
+        # arrays of the entry's previous version, if any
+        self._remove_arrays(path, keep = arrays_dir)
+        nbytes = os.path.getsize(path)
+        if os.path.isdir(arrays_dir):
+            nbytes += _dir_size(arrays_dir)
+        self.bytes_written += nbytes
+        if self.max_bytes is None:
+            return
+        self.writes += 1
+        if self.size is None or self.writes >= PRUNE_INTERVAL:
+            # also picks up the entries written by other processes
+            self.size = sum(size for _, size, _ in self.entries())
+            self.writes = 0
+        else:
+            self.size += nbytes
+        if self.size > self.max_bytes:
+            self.prune(max_age = None)
+
+    def entries(self, namespace = ''):
+        """
+        Return a list of (path, size, mtime) for all entries under namespace,
+        least recently used first.
+        """
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(os.path.join(self.root, namespace)):
+            arrays_dirs = [name for name in dirnames if name.endswith(ARRAYS_SUFFIX)]
+            dirnames[:] = [name for name in dirnames if not name.endswith(ARRAYS_SUFFIX)]
+            for name in filenames:
+                if name == LOCK_NAME or name.endswith('.tmp'):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                    size = st.st_size + sum(_dir_size(os.path.join(dirpath, arrays))
+                        for arrays in arrays_dirs if arrays.startswith(name + '.'))
+                except OSError: # removed concurrently
+                    continue
+                entries.append((path, size, st.st_mtime))
+        return sorted(entries, key = lambda entry: entry[2])
+
+    def _lock(self):
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        lock = open(os.path.join(self.root, LOCK_NAME), 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def _remove_arrays(self, path, keep = None):
+        for arrays_dir in glob.glob(path + '.*' + ARRAYS_SUFFIX):
+            if arrays_dir != keep:
+                shutil.rmtree(arrays_dir, ignore_errors = True)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            return False
+        self._remove_arrays(path)
+        self.evictions += 1
+        return True
+
+    def prune(self, max_bytes = -1, max_age = -1):
+        """
+        Evict entries older than max_age seconds, then least recently used
+        entries until the total size is at most max_bytes. Both default to
+        the instance's limits; None disables the corresponding limit.
+
+        Returns the number of entries evicted and the number of bytes freed.
+        """
+        if max_bytes == -1:
+            max_bytes = self.max_bytes
+        if max_age == -1:
+            max_age = self.max_age
+        if not os.path.isdir(self.root):
+            return 0, 0
+        removed, freed = 0, 0
+        lock = self._lock()
+        try:
+            entries = self.entries()
+            if max_age is not None:
+                cutoff = time.time() - max_age
+                for path, size, mtime in [entry for entry in entries if entry[2] < cutoff]:
+                    if self._remove(path):
+                        removed += 1
+                        freed += size
+                entries = [entry for entry in entries if entry[2] >= cutoff]
+            total = sum(size for _, size, _ in entries)
+            if max_bytes is not None:
+                for path, size, mtime in entries:
+                    if total <= max_bytes:
+                        break
+                    if self._remove(path):
+                        removed += 1
+                        freed += size
+                    total -= size
+            self.size, self.writes = total, 0
+        finally:
+            lock.close()
+        if removed:
+            log('cache: evicted %d entries (%d bytes)' % (removed, freed))
+        return removed, freed
+
+    def clear(self, namespace = ''):
+        """
+        Remove all entries under namespace (the whole cache by default).
+        """
+        lock = self._lock()
+        try:
+            target = os.path.join(self.root, namespace)
+            if namespace and os.path.isdir(target):
+                shutil.rmtree(target)
+            else:
+                for path, _, _ in self.entries(namespace):
+                    self._remove(path)
+        finally:
+            lock.close()
+
+    def summary(self):
+        """
+        Return {namespace: (number of entries, total bytes, last access
+        time)} for all entries in the cache.
+        """
+        summary = {}
+        for path, size, mtime in self.entries():
+            namespace = os.path.relpath(os.path.dirname(path), self.root)
+            count, total, last = summary.get(namespace, (0, 0, 0.))
+            summary[namespace] = (count + 1, total + size, max(last, mtime))
+        return summary
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written, 'evictions': self.evictions}
+
+    def report(self):
+        log('cache: %(hits)d hits, %(misses)d misses, %(bytes_read)d bytes read, '
+            '%(bytes_written)d bytes written, %(evictions)d evictions' % self.stats())
+
+def shared_comm():
+    """
+    Return the MPI communicator whose ranks must agree on cache hits, or None
+    if there's only one process (or in multiprocess mode, in which pool
+    workers don't evaluate cached functions).
+    """
+    if config.multiprocess:
+        return None
+    try:
+        comm = workqueue.get_comm()
+    except ImportError: # no mpi4py
+        return None
+    if comm.Get_size() == 1:
+        return None
+    return comm
+
+_cache = [None]
+
+def get_cache():
+    """
+    Return the DiskCache configured by config.cache_dir, config.cache_max_bytes
+    and config.cache_max_age.
+    """
+    cache = _cache[0]
+    if cache is None or cache.root != config.cache_dir:
+        cache = _cache[0] = DiskCache(config.cache_dir)
+    cache.max_bytes = config.cache_max_bytes
+    cache.max_age = config.cache_max_age
+    return cache
+
+def persist_to_file(namespace, collective = True):
+    """
+    Decorator that caches a function's return values in the namespace of the
+    on-disk cache, keyed by the fingerprint of its arguments. The MEMO_SIZE
+    most recently used values are also kept in memory; large arrays in the
+    others are memory-mapped from the cache when they're loaded again.
+
+    If collective is True, the function must be called by all MPI ranks,
+    which then agree on cache hits (see DiskCache.load_shared). Pass False
+    for functions that don't communicate and may be called on a single
+    rank.
+    """
+    def decorator(func):
+        memo = OrderedDict()
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            key = fingerprint.fingerprint((args, kwargs))
+            if key in memo:
+                memo[key] = value = memo.pop(key)
+                return value
+            try:
+                if collective:
+                    value = get_cache().load_shared(namespace, key)
+                else:
+                    value = get_cache().load(namespace, key)
+            except KeyError:
+                value = func(*args, **kwargs)
+                get_cache().store(namespace, key, value, shared = collective)
+            memo[key] = value
+            if len(memo) > MEMO_SIZE:
+                memo.popitem(last = False)
+            return value
+        return wrapped
+    return decorator
@@ -8,6 +8,7 @@ import logbook
 import database
 import config
 import query
+import eventmask
 from output import log
 
 from joblib import Memory
@@ -64,12 +65,18 @@ def eval_dataset(dataset_identifier, detid, event_data_getter = None, event_mask
         The detector from which to extract data.
     event_data_getter : function
         Function to evaluate over each event.
-    event_mask : dict
-        Mapping of the format {run numbers -> {event number -> bools}}, indicating which
-        events to include and exclude.
+    event_mask : eventmask.EventMask or dict
+        Mask indicating which events to include and exclude. A dict of the
+        format {run numbers -> {event number -> bools}} is also accepted.
 
     Returns a DataResult instance.
+
+    detid may also be a list of specs, in which case this is equivalent to
+    eval_dataset_multi(dataset_identifier, detid, event_mask = event_mask,
+    **kwargs).
     """
+    if isinstance(detid, list):
+        return eval_dataset_multi(dataset_identifier, detid, event_mask = event_mask, **kwargs)
     dataset = get_dataset(dataset_identifier)
     runList = dataset.runs
     return psget.get_signal_many_parallel(
@@ -77,6 +84,50 @@ def eval_dataset(dataset_identifier, detid, event_data_getter = None, event_mask
         event_mask = event_mask, dark_frame =  dark_frame, **kwargs)
         #print "event data is: ", event_data
 
+def eval_dataset_multi(dataset_identifier, specs, event_mask = None, event_filter = None,
+        **kwargs):
+    """
+    Evaluate several detectors and/or derived quantities over a dataset in a
+    single pass over its events.
+
+    specs : list
+        Each element is a detector id or a tuple of the form (detid[,
+        event_data_getter[, frame_processor[, dark_frame]]]).
+    event_filter : tuple
+        Optional spec of the same form, whose event_data_getter is evaluated
+        first on each event; events for which it returns a false value are
+        excluded from all specs.
+
+    Returns a list of DataResult instances, one per spec, followed by one for
+    event_filter if it is provided. Without config.smd the specs are
+    evaluated in separate passes.
+    """
+    dataset = get_dataset(dataset_identifier)
+    specs = map(psget.make_spec, specs)
+    if config.smd:
+        return psget.get_signal_many_multi(dataset.runs, specs,
+            event_mask = event_mask, event_filter = event_filter, **kwargs)
+    results = []
+    if event_filter is not None:
+        event_filter = psget.make_spec(event_filter)
+        mask_result = eval_dataset(dataset, event_filter.detid,
+            event_data_getter = event_filter.event_data_getter,
+            frame_processor = event_filter.frame_processor,
+            dark_frame = event_filter.dark_frame, event_mask = event_mask)
+        filter_mask = eventmask.as_event_mask(mask_result.event_data)
+        if event_mask is not None:
+            event_mask = filter_mask & event_mask
+        else:
+            event_mask = filter_mask
+    for spec in specs:
+        results.append(eval_dataset(dataset, spec.detid,
+            event_data_getter = spec.event_data_getter,
+            frame_processor = spec.frame_processor, dark_frame = spec.dark_frame,
+            event_mask = event_mask, **kwargs))
+    if event_filter is not None:
+        results.append(mask_result)
+    return results
+
 def get_dark_dataset(dataset_identifier):
     """
     Return the dataset of either (1) the dark run associated with the
@@ -102,13 +153,28 @@ def get_dark_dataset(dataset_identifier):
     return dark_dataset
 
 #@memory.cache
-@utils.eager_persist_to_file('cache/dataccess/epr')
 def eval_dataset_and_filter(dataset_identifier, detid, event_data_getter = None,
         darksub = False, frame_processor = None, event_mask = None, **kwargs):
     """
     # TODO: update this. Make it clear that this function is the public interface.
     """
+    result, = eval_dataset_and_filter_multi(dataset_identifier,
+        [(detid, event_data_getter, frame_processor)], darksub = darksub,
+        event_mask = event_mask)
+    return result
+
+def eval_dataset_and_filter_multi(dataset_identifier, specs, darksub = False,
+        event_mask = None):
+    """
+    Multi-spec version of eval_dataset_and_filter: evaluate the specs (see
+    eval_dataset_multi) and the dataset's event filter, if any, in a single
+    pass over the dataset's events. Returns a list of DataResult instances,
+    one per spec.
+
+    Results aren't cached here: psget caches them per run list and spec.
+    """
     dataset = get_dataset(dataset_identifier)
+    specs = map(psget.make_spec, specs)
 
     def get_darkframe(detid):
         if darksub:
@@ -124,33 +190,27 @@ def eval_dataset_and_filter(dataset_identifier, detid, event_data_getter = None,
         else:
             return None
 
+    def with_darkframe(spec):
+        return spec._replace(dark_frame = get_darkframe(spec.detid))
+
+    specs = map(with_darkframe, specs)
     # dataset.event_filter is a function that takes a np array and returns a boolean
     if event_mask is not None:
-        return eval_dataset(dataset, detid,
-            event_data_getter = event_data_getter,
-            dark_frame = get_darkframe(detid), frame_processor =
-            frame_processor, event_mask = event_mask)
+        return eval_dataset_multi(dataset, specs, event_mask = event_mask)
     elif dataset.event_filter:
-        mask_result = eval_dataset(dataset, dataset.event_filter_detid,
-                event_data_getter = dataset.event_filter,
-                dark_frame = get_darkframe(dataset.event_filter_detid))
-        # unpack elements of a DataResult instance
-        _, event_mask = mask_result
+        event_filter = with_darkframe(psget.make_spec(
+            (dataset.event_filter_detid, dataset.event_filter)))
+        results = eval_dataset_multi(dataset, specs, event_filter = event_filter)
+        mask_result = results.pop()
         sum_true = sum(mask_result.flat_event_data())
         log( "Event mask True entries: ", sum_true, "Total number of events: ", mask_result.nevents())
-        return eval_dataset(dataset, detid,
-            event_data_getter = event_data_getter, event_mask = event_mask,
-            dark_frame = get_darkframe(detid), frame_processor =
-            frame_processor)
+        return results
     else:
         if utils.isroot():
             log( "!!!!!!!!!!!!!!!!!!")
             log( "Dataset %s: No event filter provided." % dataset.label)
             log( "!!!!!!!!!!!!!!!!!!")
-        return eval_dataset(dataset, detid,
-            event_data_getter = event_data_getter,
-            dark_frame = get_darkframe(detid), frame_processor =
-            frame_processor)
+        return eval_dataset_multi(dataset, specs)
 
 
 #def flux_constructor(label):
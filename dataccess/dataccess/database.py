@@ -7,6 +7,7 @@ import gridfs
 import os
 import binascii
 import utils
+import cache
 from output import log
 
 """
@@ -283,4 +284,4 @@ def delete_collections(delete_logbook = False):
     if delete_logbook:
         log('mongo delete')
         collections_lookup['logbook'].delete_many({})
-    os.system('rm -rf cache/query/DataSet.evaluate*')
+    cache.get_cache().clear('query/DataSet.evaluate')
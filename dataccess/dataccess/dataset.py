@@ -1,6 +1,7 @@
 import copy
 import config
 import utils
+import cache
 import dataquery
 import database
 import logbook
@@ -97,7 +98,7 @@ class DataSet(object):
 #    def db_insert(self):
 #        self.dataset_store.insert(self, label = self.label)
 
-    @utils.eager_persist_to_file('cache/dataquery/DataSet/')
+    @cache.persist_to_file('dataquery/DataSet')
     def query_data(self, detid, event_data_getter = None):
         """
         Query data belonging to/derived from this object.
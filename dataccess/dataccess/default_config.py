@@ -25,3 +25,79 @@ autompi = True
 autobatch = True
 #import matplotlib.pyplot as plt
 multiprocess = False
+
+# Number of events per work unit handed out to MPI ranks and multiprocessing
+# workers by psget's dynamic event scheduler
+event_chunk_size = 20
+
+# Number of events psget reads ahead on a background thread while the current
+# event is being processed. 0 disables prefetching. Experimental and
+# unsupported: psana isn't guaranteed to be thread-safe, and the background
+# thread reads events and detector data while the main thread processes
+# others (see prefetch.py).
+prefetch_depth = 0
+
+# In multiprocess mode, pool workers accumulate per-pixel statistics in memory
+# maps under shared_memory_dir (a tmpfs) that the parent reduces in place,
+# instead of returning frame-sized arrays by pickling.
+multiprocess_shared_memory = True
+shared_memory_dir = '/dev/shm'
+
+# Number of runs psget evaluates at the same time with MPI in smd mode. The
+# ranks are split into this many groups, and runs are assigned to groups by
+# their number of events.
+concurrent_runs = 1
+
+# If True, psget also accumulates the per-pixel variance, minimum and maximum
+# of area detector frames (see DataResult.variance()). These cost several
+# extra passes over each frame and three extra reductions per spec with MPI,
+# so by default only the sum of the frames (i.e. the mean) is accumulated.
+accumulate_moments = False
+
+# dtype in which psget accumulates per-pixel statistics of area detector
+# frames when no frame processor or event data getter consumes the frames:
+#   'float64': exact to double precision.
+#   'float32': halves per-frame memory traffic. The sum is accumulated
+#       with Kahan compensation, with a relative error of about 1.2e-7 in
+#       the mean regardless of the number of frames. With
+#       accumulate_moments, the per-frame updates are done in float32 over
+#       blocks of accumulation_block_size frames, which are merged into
+#       float64 totals; the error of the mean is then of order
+#       accumulation_block_size * 6e-8 times the largest frame value.
+#   'int64': exact integer sums of raw ADU for detectors with integer raw
+#       data (falls back to float64 for anything else).
+# Results are float64 in all cases.
+accumulation_dtype = 'float64'
+accumulation_block_size = 64
+
+# dtype in which frames of stored per-run partial results are written to
+# disk. 'float32' halves their size at a relative error of at most 6e-8
+# (2**-24) per pixel value.
+storage_dtype = 'float64'
+
+# On-disk result cache (see cache.py): root directory, size budget in bytes
+# (least recently used entries are evicted beyond it; None for no limit) and
+# maximum entry age in seconds enforced by pruning (None for no limit).
+cache_dir = 'cache'
+cache_max_bytes = None
+cache_max_age = None
+
+# Arrays of at least this many bytes in cached values are stored as .npy
+# files and memory-mapped on load (None to pickle everything).
+cache_memmap_min_bytes = 1 << 20
+
+# If not None, per-event values (e.g. frames returned by an identity
+# event_data_getter) of at least frame_store_min_bytes bytes are written to
+# chunked HDF5 files in frame_store_dir as they are read, and event data
+# refers to them lazily instead of holding them in memory. The files aren't
+# removed automatically (cached results refer to them). e.g. 1 << 20.
+# frame_store_compression is passed to h5py (e.g. 'lzf' or 'gzip').
+frame_store_dir = 'framestore'
+frame_store_min_bytes = None
+frame_store_compression = None
+
+# With MPI, ranks write their event data to shard files in frame_store_dir
+# and send only the shards' paths to the root rank, instead of sending all
+# event data to all ranks. The root broadcasts a merged view of the shards,
+# in which values of at least frame_store_min_bytes bytes stay on disk.
+event_data_shards = False
@@ -0,0 +1,311 @@
+"""
+Columnar storage of per-event data.
+
+EventData holds the output of an event_data_getter for a set of events as
+three contiguous arrays (run numbers, event numbers and values) sorted by
+(run, event). Values that are numbers or equally-shaped arrays are stacked
+into a single ndarray; anything else is kept in an object array.
+
+The values column may also be a lazy column (e.g. framestore.FrameColumn,
+for frames kept on disk): any sequence with an is_lazy_column attribute that
+supports len(), integer and array indexing, iteration and copy(), and whose
+class implements concatenate() of lazy columns and ndarrays.
+
+For compatibility with code written against the nested dict representation
+{run number: {event number: value}}, EventData also implements the read-only
+mapping interface of that dict.
+"""
+
+import numpy as np
+
+def _stack_values(values):
+    """
+    Return values as an ndarray, stacking numbers and equally-shaped arrays
+    along a new first axis. Other values go into a 1d object array.
+    """
+    values = list(values)
+    if not values:
+        return np.zeros(0)
+    def is_numeric(v):
+        return isinstance(v, (np.ndarray, np.number, int, long, float, bool, np.bool_))
+    if all(map(is_numeric, values)):
+        shapes = set(np.shape(v) for v in values)
+        if len(shapes) == 1:
+            stacked = np.array(values)
+            if stacked.dtype != object:
+                return stacked
+    arr = np.empty(len(values), dtype = object)
+    for i, v in enumerate(values):
+        arr[i] = v
+    return arr
+
+def _is_lazy(data):
+    return getattr(data, 'is_lazy_column', False)
+
+def event_keys(runs, events):
+    """
+    Combine run and event numbers into a single int64 sort/lookup key.
+    """
+    return (np.asarray(runs, dtype = 'int64') << 32) + np.asarray(events, dtype = 'int64')
+
+class RunView(object):
+    """
+    Read-only {event number: value} mapping over the events of a single run
+    in an EventData instance.
+    """
+    def __init__(self, events, data):
+        self.events = events
+        self.data = data
+
+    def _index(self, nevent):
+        i = np.searchsorted(self.events, nevent)
+        if i < len(self.events) and self.events[i] == nevent:
+            return i
+        raise KeyError(nevent)
+
+    def __getitem__(self, nevent):
+        return self.data[self._index(nevent)]
+
+    def __contains__(self, nevent):
+        try:
+            self._index(nevent)
+        except KeyError:
+            return False
+        return True
+
+    def get(self, nevent, default = None):
+        try:
+            return self[nevent]
+        except KeyError:
+            return default
+
+    def __len__(self):
+        return len(self.events)
+
+    def __iter__(self):
+        return iter(self.events.tolist())
+
+    def keys(self):
+        return self.events.tolist()
+
+    def values(self):
+        # lazy columns are returned as is, so that frames are read on access
+        if _is_lazy(self.data):
+            return self.data
+        return list(self.data)
+
+    def items(self):
+        return zip(self.keys(), self.values())
+
+    iterkeys = __iter__
+
+    def itervalues(self):
+        return iter(self.data)
+
+    def iteritems(self):
+        return iter(self.items())
+
+class EventData(object):
+    """
+    Columnar {run number: {event number: value}} store.
+
+    Attributes:
+    runs : np.ndarray of int64
+    events : np.ndarray of int64
+    data : np.ndarray or lazy column
+        Event values, indexed along the first axis in the same order as runs
+        and events.
+    """
+    def __init__(self, runs = (), events = (), data = None):
+        runs = np.asarray(runs, dtype = 'int64')
+        events = np.asarray(events, dtype = 'int64')
+        if data is None:
+            data = np.zeros(0)
+        elif not (isinstance(data, np.ndarray) or _is_lazy(data)):
+            data = _stack_values(data)
+        if not (len(runs) == len(events) == len(data)):
+            raise ValueError("runs, events and data must have the same length")
+        order = np.lexsort((events, runs))
+        if np.any(order != np.arange(len(order))):
+            runs, events, data = runs[order], events[order], data[order]
+        self.runs = runs
+        self.events = events
+        self.data = data
+        self._run_bounds = None
+
+    @classmethod
+    def from_dict(cls, event_data_dict):
+        """
+        Construct an instance from a nested {run: {nevent: value}} dict.
+        """
+        if isinstance(event_data_dict, EventData):
+            return event_data_dict
+        runs, events, values = [], [], []
+        for run, run_dict in event_data_dict.iteritems():
+            for nevent, value in run_dict.iteritems():
+                runs.append(run)
+                events.append(nevent)
+                values.append(value)
+        return cls(runs, events, _stack_values(values))
+
+    def to_dict(self):
+        return {run: dict(self[run].items()) for run in self}
+
+    def __getstate__(self):
+        return {'runs': self.runs, 'events': self.events, 'data': self.data}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._run_bounds = None
+
+    def keys(self):
+        """Return the (sorted) run numbers."""
+        return self._bounds().keys()
+
+    def _bounds(self):
+        if self._run_bounds is None:
+            unique_runs, starts = np.unique(self.runs, return_index = True)
+            stops = list(starts[1:]) + [len(self.runs)]
+            self._run_bounds = dict(zip(unique_runs.tolist(), zip(starts, stops)))
+        return self._run_bounds
+
+    def __getitem__(self, run):
+        start, stop = self._bounds()[run]
+        return RunView(self.events[start:stop], self.data[start:stop])
+
+    def __contains__(self, run):
+        return run in self._bounds()
+
+    def __iter__(self):
+        return iter(sorted(self.keys()))
+
+    def __len__(self):
+        """Number of runs (as for the nested dict representation)."""
+        return len(self._bounds())
+
+    def __nonzero__(self):
+        return len(self.runs) > 0
+
+    def get(self, run, default = None):
+        if run in self:
+            return self[run]
+        return default
+
+    def values(self):
+        return [self[run] for run in self]
+
+    def items(self):
+        return [(run, self[run]) for run in self]
+
+    iterkeys = __iter__
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def nevents(self):
+        return len(self.runs)
+
+    def flat(self):
+        """Return the array of values, ordered by (run, event)."""
+        return self.data
+
+    def iter_rows(self):
+        """Iterate through (run, nevent, value) tuples."""
+        return zip(self.runs.tolist(), self.events.tolist(), self.data)
+
+    def keys_array(self):
+        return event_keys(self.runs, self.events)
+
+    def _select(self, index):
+        return EventData(self.runs[index], self.events[index], self.data[index])
+
+    def copy(self):
+        return EventData(self.runs.copy(), self.events.copy(), self.data.copy())
+
+    def contains_events(self, other):
+        """
+        Return a boolean array indicating which of self's events are also
+        present in other.
+        """
+        other = EventData.from_dict(other)
+        return np.in1d(self.keys_array(), other.keys_array())
+
+    def intersection(self, other):
+        """
+        Return an instance containing the events of self that are also present
+        in other (an EventData instance or nested dict).
+        """
+        return self._select(self.contains_events(other))
+
+    def join(self, other):
+        """
+        Return the pair (self.intersection(other), other.intersection(self)),
+        whose rows are aligned by (run, event).
+        """
+        other = EventData.from_dict(other)
+        return self.intersection(other), other.intersection(self)
+
+    def merge(self, other):
+        """
+        Return the union of self and other. For events present in both, the
+        value from other is kept.
+        """
+        other = EventData.from_dict(other)
+        if not self.nevents():
+            return other
+        if not other.nevents():
+            return self
+        return concatenate([self._select(~self.contains_events(other)), other])
+
+    def __repr__(self):
+        return 'EventData(%d runs, %d events)' % (len(self), self.nevents())
+
+def _concatenate_data(arrays):
+    lazy = filter(_is_lazy, arrays)
+    if lazy:
+        # without reading the lazy columns' values
+        return type(lazy[0]).concatenate(arrays)
+    try:
+        return np.concatenate(arrays)
+    except ValueError: # incompatible value shapes
+        return _stack_values([v for arr in arrays for v in arr])
+
+def concatenate(instances):
+    """
+    Combine EventData instances that contain disjoint sets of events (e.g.
+    the partial results of different MPI ranks) into one instance.
+    """
+    instances = [inst for inst in instances if inst.nevents()]
+    if not instances:
+        return EventData()
+    if len(instances) == 1:
+        return instances[0]
+    return EventData(np.concatenate([inst.runs for inst in instances]),
+        np.concatenate([inst.events for inst in instances]),
+        _concatenate_data([inst.data for inst in instances]))
+
+def merge_all(instances):
+    """
+    Return the union of a sequence of EventData instances. For events present
+    in more than one instance, the value from the last one is kept. Disjoint
+    instances (e.g. the results for different runs) are concatenated in a
+    single pass.
+    """
+    instances = [inst for inst in instances if inst.nevents()]
+    if len(instances) > 1:
+        keys = np.concatenate([inst.keys_array() for inst in instances])
+        if len(np.unique(keys)) != len(keys):
+            return reduce(lambda x, y: x.merge(y), instances)
+    return concatenate(instances)
+
+def as_event_data(event_data):
+    """
+    Convert a nested {run: {nevent: value}} dict (or None) to an EventData
+    instance.
+    """
+    if event_data is None:
+        return EventData()
+    return EventData.from_dict(event_data)
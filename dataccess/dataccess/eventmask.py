@@ -0,0 +1,230 @@
+"""
+Compact event masks.
+
+An EventMask records, for each run, which events are to be included in an
+analysis. Each run's mask is stored as a packed boolean array (one bit per
+event) of a fixed length; events beyond that length are excluded, which
+matches the semantics of the legacy {run: {nevent: bool}} dicts, where events
+without an entry are excluded.
+"""
+
+import numpy as np
+
+class RunMask(object):
+    """
+    Mask of the events of a single run. Supports the lookups of the legacy
+    {nevent: bool} dict: `nevent in run_mask` and `run_mask[nevent]`.
+    """
+    def __init__(self, bits):
+        self.bits = np.asarray(bits, dtype = bool)
+
+    def __len__(self):
+        return len(self.bits)
+
+    def __array__(self, dtype = None):
+        if dtype is None:
+            return self.bits
+        return self.bits.astype(dtype)
+
+    def __contains__(self, nevent):
+        return 0 <= nevent < len(self.bits)
+
+    def __getitem__(self, nevent):
+        if nevent not in self:
+            raise KeyError(nevent)
+        return bool(self.bits[nevent])
+
+    def get(self, nevent, default = None):
+        if nevent in self:
+            return self[nevent]
+        return default
+
+    def __iter__(self):
+        return iter(xrange(len(self.bits)))
+
+    def keys(self):
+        return range(len(self.bits))
+
+    def values(self):
+        return self.bits.tolist()
+
+    def items(self):
+        return zip(self.keys(), self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def is_valid(self, nevent):
+        return 0 <= nevent < len(self.bits) and self.bits[nevent]
+
+    def accepted(self):
+        """Return the sorted array of included event numbers."""
+        return np.flatnonzero(self.bits)
+
+    def count(self):
+        return int(np.count_nonzero(self.bits))
+
+def _padded(bits, length):
+    if len(bits) >= length:
+        return bits
+    return np.concatenate((bits, np.zeros(length - len(bits), dtype = bool)))
+
+class EventMask(object):
+    """
+    Mapping of run numbers to RunMask instances, stored as packed bits.
+
+    EventMask instances can be combined with &, | and ~. For & and |, a run
+    or event missing from one of the operands counts as excluded; ~ inverts
+    events within each run's mask length.
+    """
+    def __init__(self, run_bits = None):
+        """
+        run_bits : dict
+            Maps run numbers to 1d boolean arrays indexed by event number.
+        """
+        self._packed = {}
+        self._nbits = {}
+        self._views = {}
+        for run, bits in (run_bits or {}).iteritems():
+            bits = np.asarray(bits, dtype = bool)
+            self._packed[run] = np.packbits(bits)
+            self._nbits[run] = len(bits)
+
+    @classmethod
+    def from_events(cls, runs, events_included, nevents):
+        """
+        Given a list of run numbers, and a list of lists of event numbers to
+        include for each run, return a mask covering the first nevents events
+        of each run.
+        """
+        run_bits = {}
+        for run, events in zip(runs, events_included):
+            bits = np.zeros(nevents, dtype = bool)
+            events = np.asarray(events, dtype = int)
+            bits[events[(events >= 0) & (events < nevents)]] = True
+            run_bits[run] = bits
+        return cls(run_bits)
+
+    @classmethod
+    def from_dict(cls, mask_dict):
+        """
+        Construct an instance from a legacy {run: {nevent: bool}} mapping
+        (a nested dict or an eventdata.EventData instance).
+        """
+        if hasattr(mask_dict, 'runs') and hasattr(mask_dict, 'events'):
+            # columnar event data
+            run_bits = {}
+            for run in np.unique(mask_dict.runs):
+                select = mask_dict.runs == run
+                events = mask_dict.events[select]
+                bits = np.zeros(events.max() + 1, dtype = bool)
+                bits[events] = np.asarray(mask_dict.data[select], dtype = bool)
+                run_bits[int(run)] = bits
+            return cls(run_bits)
+        run_bits = {}
+        for run, run_dict in mask_dict.iteritems():
+            if not run_dict:
+                run_bits[run] = np.zeros(0, dtype = bool)
+                continue
+            events = np.fromiter(run_dict.iterkeys(), dtype = int)
+            values = np.fromiter((bool(v) for v in run_dict.itervalues()), dtype = bool)
+            bits = np.zeros(events.max() + 1, dtype = bool)
+            bits[events] = values
+            run_bits[run] = bits
+        return cls(run_bits)
+
+    def to_dict(self):
+        """Return the legacy {run: {nevent: bool}} representation."""
+        return {run: dict(self[run].items()) for run in self}
+
+    def bits(self, run):
+        """Return the unpacked boolean array for run (empty if absent)."""
+        if run not in self._packed:
+            return np.zeros(0, dtype = bool)
+        return np.unpackbits(self._packed[run])[:self._nbits[run]].astype(bool)
+
+    def __getitem__(self, run):
+        if run not in self._views:
+            self._views[run] = RunMask(self.bits(run))
+        return self._views[run]
+
+    def __contains__(self, run):
+        return run in self._packed
+
+    def __iter__(self):
+        return iter(sorted(self._packed))
+
+    def keys(self):
+        return sorted(self._packed)
+
+    def values(self):
+        return [self[run] for run in self]
+
+    def items(self):
+        return [(run, self[run]) for run in self]
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def __len__(self):
+        return len(self._packed)
+
+    def is_valid(self, run, nevent):
+        return self[run].is_valid(nevent)
+
+    def count(self):
+        """Total number of included events."""
+        return sum(self[run].count() for run in self)
+
+    def _combine(self, other, op, runs):
+        other = as_event_mask(other)
+        run_bits = {}
+        for run in runs:
+            a, b = self.bits(run), other.bits(run)
+            length = max(len(a), len(b))
+            run_bits[run] = op(_padded(a, length), _padded(b, length))
+        return EventMask(run_bits)
+
+    def __and__(self, other):
+        other = as_event_mask(other)
+        return self._combine(other, np.logical_and,
+            set(self._packed) & set(other._packed))
+
+    def __or__(self, other):
+        other = as_event_mask(other)
+        return self._combine(other, np.logical_or,
+            set(self._packed) | set(other._packed))
+
+    def __invert__(self):
+        return EventMask({run: ~self.bits(run) for run in self})
+
+    def __eq__(self, other):
+        if not isinstance(other, EventMask):
+            return NotImplemented
+        return self.keys() == other.keys() and all(
+            np.array_equal(self.bits(run), other.bits(run)) for run in self)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __getstate__(self):
+        return {'_packed': self._packed, '_nbits': self._nbits}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._views = {}
+
+    def __repr__(self):
+        return 'EventMask(%d runs, %d events included)' % (len(self), self.count())
+
+def as_event_mask(event_mask):
+    """
+    Convert a legacy mask dict or columnar event data to an EventMask.
+    None is passed through.
+    """
+    if event_mask is None or isinstance(event_mask, EventMask):
+        return event_mask
+    return EventMask.from_dict(event_mask)
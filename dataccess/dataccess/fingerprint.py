@@ -0,0 +1,144 @@
+"""
+Fast, stable fingerprints of Python values, for use as cache keys.
+
+fingerprint() hashes a canonical, type-tagged encoding of a value instead of
+its pickle:
+
+- ndarrays are hashed from their dtype, shape and raw data, fed to the hash
+  function in chunks (no serialization, and no full-size temporary copy for
+  non-contiguous arrays).
+- Functions are hashed from their code (bytecode, constants, referenced
+  names and nested code objects), default arguments and the values of their
+  closure cells, so that equivalent closures created in different sessions
+  (e.g. frame processors returned by factory functions in nbfunctions) get
+  the same fingerprint.
+- Dicts and sets are hashed independently of their iteration order.
+- Other objects are hashed from their type and their __getstate__() or
+  __dict__, falling back to their pickle if they have neither.
+"""
+
+import hashlib
+import types
+import functools
+import dill
+import numpy as np
+
+# Bytes of array data fed to the hash function at a time
+CHUNK_BYTES = 1 << 22
+
+def fingerprint(obj):
+    """
+    Return the hex digest fingerprint of obj.
+    """
+    h = hashlib.sha1()
+    _update(h, obj, {})
+    return h.hexdigest()
+
+def _tag(h, tag, *fields):
+    h.update(tag)
+    for field in fields:
+        h.update(':%s' % str(field))
+    h.update(';')
+
+def _type_name(obj):
+    cls = type(obj)
+    return '%s.%s' % (cls.__module__, cls.__name__)
+
+def _update_array(h, arr, seen):
+    _tag(h, 'ndarray', arr.dtype.str, arr.shape)
+    if arr.dtype.hasobject:
+        for item in arr.flat:
+            _update(h, item, seen)
+        return
+    if arr.flags.c_contiguous:
+        flat = arr.reshape(-1).view('uint8')
+        for start in xrange(0, len(flat), CHUNK_BYTES):
+            h.update(flat[start:start + CHUNK_BYTES])
+        return
+    # copy about CHUNK_BYTES at a time, in C order along the first axis
+    row_bytes = max(1, arr[:1].nbytes)
+    step = max(1, CHUNK_BYTES // row_bytes)
+    for start in xrange(0, len(arr), step):
+        h.update(np.ascontiguousarray(arr[start:start + step]).view('uint8').reshape(-1))
+
+def _update_code(h, code, seen):
+    _tag(h, 'code', code.co_argcount, code.co_flags, len(code.co_code))
+    h.update(code.co_code)
+    _update(h, code.co_names, seen)
+    _update(h, code.co_varnames, seen)
+    _update(h, code.co_freevars, seen)
+    _tag(h, 'consts', len(code.co_consts))
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _update_code(h, const, seen)
+        else:
+            _update(h, const, seen)
+
+def _update_function(h, func, seen):
+    _tag(h, 'function', func.__module__, func.__name__)
+    _update_code(h, func.func_code, seen)
+    _update(h, func.func_defaults, seen)
+    cells = func.func_closure or ()
+    _tag(h, 'closure', len(cells))
+    for cell in cells:
+        try:
+            contents = cell.cell_contents
+        except ValueError: # empty cell
+            _tag(h, 'empty')
+            continue
+        _update(h, contents, seen)
+    # attributes set on the function object, e.g. frame_processor.detids
+    _update(h, dict(func.__dict__), seen)
+
+def _update(h, obj, seen):
+    if obj is None or isinstance(obj, (bool, int, long, float, complex, str, unicode)):
+        _tag(h, type(obj).__name__, repr(obj))
+        return
+    if isinstance(obj, np.generic):
+        _tag(h, 'scalar', obj.dtype.str, repr(obj.item()))
+        return
+    # back-references for shared and self-referencing containers
+    if id(obj) in seen:
+        _tag(h, 'ref', seen[id(obj)][0])
+        return
+    seen[id(obj)] = (len(seen), obj)
+    if isinstance(obj, np.ndarray):
+        _update_array(h, obj, seen)
+    elif isinstance(obj, (tuple, list)):
+        _tag(h, _type_name(obj), len(obj))
+        for item in obj:
+            _update(h, item, seen)
+    elif isinstance(obj, dict):
+        _tag(h, 'dict', len(obj))
+        items = sorted(((fingerprint(key), value) for key, value in obj.iteritems()),
+            key = lambda item: item[0])
+        for key_fingerprint, value in items:
+            h.update(key_fingerprint)
+            _update(h, value, seen)
+    elif isinstance(obj, (set, frozenset)):
+        _tag(h, 'set', len(obj))
+        for item_fingerprint in sorted(map(fingerprint, obj)):
+            h.update(item_fingerprint)
+    elif isinstance(obj, types.FunctionType):
+        _update_function(h, obj, seen)
+    elif isinstance(obj, types.MethodType):
+        _tag(h, 'method')
+        _update(h, obj.im_func, seen)
+        _update(h, obj.im_self, seen)
+    elif isinstance(obj, functools.partial):
+        _tag(h, 'partial')
+        _update(h, obj.func, seen)
+        _update(h, obj.args, seen)
+        _update(h, obj.keywords, seen)
+    elif isinstance(obj, (type, types.ClassType, types.ModuleType,
+            types.BuiltinFunctionType)):
+        _tag(h, 'named', getattr(obj, '__module__', None), obj.__name__)
+    elif hasattr(obj, '__getstate__'):
+        _tag(h, _type_name(obj))
+        _update(h, obj.__getstate__(), seen)
+    elif hasattr(obj, '__dict__'):
+        _tag(h, _type_name(obj))
+        _update(h, obj.__dict__, seen)
+    else:
+        _tag(h, 'pickle', _type_name(obj))
+        h.update(dill.dumps(obj))
@@ -0,0 +1,341 @@
+"""
+Out-of-core storage of per-event detector frames.
+
+Event data getters that return whole frames (e.g. identity, as used by
+datashow.one_plot and the nbfunctions helpers) would otherwise keep every
+frame of every run in memory, and in MPI mode send all of them to every
+rank. Instead, each rank (or pool worker) appends frames of at least
+config.frame_store_min_bytes bytes to its own chunked HDF5 file under
+config.frame_store_dir as it reads them, and the values column of the
+resulting EventData is a FrameColumn: a lazy, indexable handle that
+references frames by (file, row) and reads them only when they are indexed
+or iterated over. FrameColumns pickle to a few index arrays, so gathering,
+merging and caching event data only moves references.
+
+With config.event_data_shards, MPI ranks also don't allgather their event
+data: gather_event_data() writes each rank's event data to a shard file in
+the same directory and gathers only a manifest of ShardEntry tuples (path,
+format, number of events) to the root rank, which assembles the merged
+EventData and broadcasts it. Large values stay on disk, in FrameColumns
+over the shards, so that only references to them are communicated.
+
+Storing frames is opt-in (config.frame_store_min_bytes is None by default).
+The files (including shards that event data refers to) aren't removed
+automatically, since cached results refer to them; clear the cache before
+deleting config.frame_store_dir.
+"""
+
+import os
+import uuid
+import pickle
+from collections import namedtuple
+
+import numpy as np
+
+import config
+import eventdata
+import workqueue
+
+# Name of the frames dataset in each file
+DATASET = 'frames'
+
+# (pid, path) -> open h5py.File, for reading
+_files = {}
+
+def _open(path):
+    # h5py file handles can't be shared with forked pool workers
+    key = (os.getpid(), path)
+    if key not in _files:
+        import h5py
+        _files[key] = h5py.File(path, 'r')
+    return _files[key]
+
+def close_files():
+    """
+    Close this process's open file handles (e.g. before the files are
+    deleted).
+    """
+    pid = os.getpid()
+    for key in [key for key in _files if key[0] == pid]:
+        _files.pop(key).close()
+
+def new_path(suffix = '.h5'):
+    """
+    Return the path of a new file in config.frame_store_dir.
+    """
+    # absolute, since the path is read back by other processes
+    return os.path.abspath(os.path.join(config.frame_store_dir,
+        '%d-%s%s' % (os.getpid(), uuid.uuid4().hex, suffix)))
+
+def _makedirs(path):
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError: # created concurrently
+            pass
+
+class FrameWriter(object):
+    """
+    Appends equally-shaped frames to a chunked, resizable HDF5 dataset (one
+    chunk per frame). The file is created when the first frame is written.
+    """
+    def __init__(self, path = None):
+        self.path = path or new_path()
+        self.file = None
+        self.frames = None
+        self.nframes = 0
+
+    def accepts(self, value):
+        """
+        Return True if value is a frame that belongs in this file.
+        """
+        min_bytes = config.frame_store_min_bytes
+        if (min_bytes is None or not isinstance(value, np.ndarray)
+                or value.dtype.hasobject or value.nbytes < min_bytes):
+            return False
+        if self.frames is None:
+            return True
+        return value.shape == self.frames.shape[1:] and value.dtype == self.frames.dtype
+
+    def _create(self, frame):
+        import h5py
+        _makedirs(self.path)
+        self.file = h5py.File(self.path, 'w')
+        self.frames = self.file.create_dataset(DATASET, shape = (0,) + frame.shape,
+            maxshape = (None,) + frame.shape, chunks = (1,) + frame.shape,
+            dtype = frame.dtype, compression = config.frame_store_compression)
+
+    def append(self, frame):
+        """
+        Write frame and return its row in the file.
+        """
+        frame = np.asarray(frame)
+        if self.file is None:
+            self._create(frame)
+        if self.nframes == len(self.frames):
+            self.frames.resize(max(16, 2 * self.nframes), axis = 0)
+        self.frames[self.nframes] = frame
+        self.nframes += 1
+        return self.nframes - 1
+
+    def close(self):
+        """
+        Trim the dataset to the frames written and close the file.
+        """
+        if self.file is None:
+            return
+        self.frames.resize(self.nframes, axis = 0)
+        self.file.close()
+        self.file = None
+
+    def column(self, rows):
+        """
+        Return a FrameColumn over the given rows of this file. The writer
+        must be closed first.
+        """
+        rows = np.asarray(rows, dtype = 'int64')
+        if self.frames is None:
+            raise ValueError("No frames have been written to %s" % self.path)
+        return FrameColumn([self.path], np.zeros(len(rows), dtype = 'int64'), rows,
+            self.frames.shape[1:], self.frames.dtype)
+
+class FrameColumn(object):
+    """
+    Lazy, read-only sequence of frames stored in one or more files written
+    by FrameWriter. Elements may also be values held in memory (e.g. those
+    of events whose values were too small to be stored), so that columns of
+    stored and unstored values can be concatenated without reading the
+    stored frames.
+
+    Integer indexing reads one frame; indexing with a slice, an index array
+    or a boolean mask returns a new FrameColumn without reading anything.
+    Iteration reads one frame at a time, and np.asarray() reads all of them.
+
+    Attributes:
+    paths : list of str
+        Files referenced by the column
+    shards, rows : np.ndarray of int64
+        File (index into paths) and row of each element. Elements with a
+        negative shard are memory[row].
+    memory : list
+        Values held in memory
+    frame_shape, dtype
+        Shape and dtype of the stored frames (None and object if the
+        column's frames differ in shape or dtype)
+    """
+    # Recognized by eventdata.EventData in place of an ndarray
+    is_lazy_column = True
+
+    def __init__(self, paths, shards, rows, frame_shape, dtype, memory = ()):
+        self.paths = list(paths)
+        self.shards = np.asarray(shards, dtype = 'int64')
+        self.rows = np.asarray(rows, dtype = 'int64')
+        if frame_shape is not None:
+            frame_shape = tuple(frame_shape)
+        self.frame_shape = frame_shape
+        self.dtype = np.dtype(dtype)
+        self.memory = list(memory)
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def shape(self):
+        return (len(self),) + (self.frame_shape or ())
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def _read(self, i):
+        shard = self.shards[i]
+        if shard < 0:
+            return self.memory[self.rows[i]]
+        return _open(self.paths[shard])[DATASET][self.rows[i]]
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, long, np.integer)):
+            return self._read(index)
+        return FrameColumn(self.paths, self.shards[index], self.rows[index],
+            self.frame_shape, self.dtype, self.memory)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self._read(i)
+
+    def __array__(self, dtype = None):
+        if self.frame_shape is None or np.any(self.shards < 0):
+            arr = eventdata._stack_values(list(self))
+        else:
+            arr = np.empty(self.shape, dtype = self.dtype)
+            for i, frame in enumerate(self):
+                arr[i] = frame
+        if dtype is not None:
+            return arr.astype(dtype)
+        return arr
+
+    def copy(self):
+        return FrameColumn(self.paths, self.shards.copy(), self.rows.copy(),
+            self.frame_shape, self.dtype, self.memory)
+
+    @classmethod
+    def concatenate(cls, columns):
+        """
+        Return a FrameColumn over the elements of columns (FrameColumns or
+        ndarrays, whose values are kept in memory), in order. Nothing is
+        read from disk.
+        """
+        paths, memory, shards, rows = [], [], [], []
+        layouts = set()
+        for column in columns:
+            if not isinstance(column, FrameColumn):
+                shards.append(np.full(len(column), -1, dtype = 'int64'))
+                rows.append(np.arange(len(memory), len(memory) + len(column)))
+                memory.extend(column)
+                continue
+            index = []
+            for path in column.paths:
+                if path not in paths:
+                    paths.append(path)
+                index.append(paths.index(path))
+            stored = column.shards >= 0
+            column_shards = column.shards.copy()
+            column_shards[stored] = np.asarray(index, dtype = 'int64')[column.shards[stored]]
+            column_rows = column.rows.copy()
+            column_rows[~stored] += len(memory)
+            if np.any(stored):
+                layouts.add((column.frame_shape, column.dtype))
+            shards.append(column_shards)
+            rows.append(column_rows)
+            memory.extend(column.memory)
+        if len(layouts) == 1:
+            frame_shape, dtype = layouts.pop()
+        else:
+            frame_shape, dtype = None, object
+        return cls(paths, np.concatenate(shards), np.concatenate(rows), frame_shape, dtype,
+            memory)
+
+    def __repr__(self):
+        return 'FrameColumn(%d frames of shape %s in %d files, %d in memory)' % (len(self),
+            str(self.frame_shape), len(self.paths), np.sum(self.shards < 0))
+
+# Description of a shard written by write_shard(). format is 'hdf5' (runs,
+# events and DATASET datasets) or 'pickle' (a pickled EventData). keep is
+# True if read_shard() leaves the values on disk, i.e. if the EventData it
+# returns refers to the file.
+ShardEntry = namedtuple('ShardEntry', ['path', 'format', 'nevents', 'keep'])
+
+def write_shard(event_data):
+    """
+    Write an EventData instance to a new shard file and return its
+    ShardEntry. Numeric values are stored in HDF5, and left on disk by
+    read_shard() if each of them has at least config.frame_store_min_bytes
+    bytes. Anything else (including values that are already lazy columns)
+    is pickled.
+    """
+    data = event_data.data
+    if isinstance(data, np.ndarray) and not data.dtype.hasobject:
+        import h5py
+        path = new_path()
+        _makedirs(path)
+        with h5py.File(path, 'w') as f:
+            f.create_dataset('runs', data = event_data.runs)
+            f.create_dataset('events', data = event_data.events)
+            f.create_dataset(DATASET, data = data)
+        # the same per-value rule as FrameWriter.accepts()
+        min_bytes = config.frame_store_min_bytes
+        keep = min_bytes is not None and data[:1].nbytes >= min_bytes
+        return ShardEntry(path, 'hdf5', event_data.nevents(), keep)
+    path = new_path('.pkl')
+    _makedirs(path)
+    with open(path, 'wb') as f:
+        pickle.dump(event_data, f, 2)
+    return ShardEntry(path, 'pickle', event_data.nevents(), False)
+
+def read_shard(entry):
+    """
+    Return the EventData instance stored in a shard. If entry.keep, its
+    values are left on disk, in a FrameColumn.
+    """
+    if entry.format == 'pickle':
+        with open(entry.path, 'rb') as f:
+            return pickle.load(f)
+    import h5py
+    with h5py.File(entry.path, 'r') as f:
+        runs, events = f['runs'][...], f['events'][...]
+        values = f[DATASET]
+        if entry.keep:
+            data = FrameColumn([entry.path], np.zeros(len(values), dtype = 'int64'),
+                np.arange(len(values)), values.shape[1:], values.dtype)
+        else:
+            data = values[...]
+    return eventdata.EventData(runs, events, data)
+
+def gather_event_data(comm, event_data, root = 0):
+    """
+    Collective over comm: return the concatenation of all ranks' event data
+    on every rank.
+
+    Each rank writes its event data to a shard, and only the manifest (one
+    ShardEntry per rank) is gathered, to the root rank. The root assembles
+    the merged view without reading the shards' stored values: those of
+    shards with entry.keep stay on disk, in a FrameColumn, and only the
+    other shards (whose values are small) are read, after which the root,
+    their only reader, removes them. The view (index arrays, small values
+    and file references) is then broadcast to the other ranks.
+    """
+    if event_data.nevents():
+        entry = write_shard(event_data)
+    else:
+        entry = None
+    manifest = comm.gather(entry, root = root)
+    if comm.Get_rank() == root:
+        shards = [shard for shard in manifest if shard is not None]
+        merged = eventdata.concatenate(map(read_shard, shards))
+        for shard in shards:
+            if not shard.keep:
+                os.remove(shard.path)
+    else:
+        merged = None
+    return workqueue.bcast_arrays(comm, merged, root = root)
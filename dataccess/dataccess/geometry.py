@@ -6,10 +6,13 @@ patterns from area detector data.
 import numpy.ma as ma
 from scipy.interpolate import griddata
 import itertools
+import os
 import numpy as np
+from scipy import sparse
 from scipy.ndimage.filters import gaussian_filter
 
 import utils
+import cache
 from output import log
 import config
 
@@ -28,17 +31,106 @@ def get_detid_parameters(detid):
     return (phi, x0, y0, alpha, r)
 
 
+def _compute_maps(shape, phi, x0, y0, alpha, r, dtype = 'float64'):
+    """
+    Given a frame shape and CSPAD geometry parameters, return a dict of
+    per-pixel maps: 'x', 'y' (column and row indices), 'beta' (2theta, in
+    degrees), 'rho' (distance) and 'phi2' (azimuthal angle with respect to
+    the x-ray beam).
+    """
+    length, width = shape
+    x = np.arange(width, dtype = 'float64')[np.newaxis, :]
+    y = np.arange(length, dtype = 'float64')[:, np.newaxis]
+    try:
+        x2 = -np.cos(phi) *(x-x0) + np.sin(phi) * (y-y0)
+        y2 = -np.sin(phi) * (x-x0) - np.cos(phi) * (y-y0)
+    except (AttributeError, TypeError):
+        raise AttributeError("Missing geometry data in config.py")
+    rho = (r**2 + x2**2 + y2**2)**0.5
+    y1 = y2 * np.cos(alpha) + r * np.sin(alpha)
+    z1 = - y2 * np.sin(alpha) + r * np.cos(alpha)
+
+    # beta is the twotheta value for a given (x,y)
+    beta = np.arctan2((y1**2 + x2**2)**0.5, z1) * 180 / np.pi
+    phi2 = np.arctan2(y1, z1)
+    maps = {'x': x, 'y': y, 'beta': beta, 'rho': rho, 'phi2': phi2}
+    return {k: np.broadcast_arrays(v, x2)[0].astype(dtype)
+        for k, v in maps.iteritems()}
+
+GEOMETRY_CACHE_DIR = 'cache/geometry/maps/'
+
+class GeometryMaps(object):
+    """
+    Read-only float32 per-pixel maps (x, y, beta, rho and phi2; see
+    _compute_maps) for one set of detector geometry parameters and frame
+    shape.
+
+    The maps are computed once, saved as .npy files in a directory under
+    GEOMETRY_CACHE_DIR whose name is derived from the geometry parameters
+    and shape, and memory-mapped. Pages are therefore shared between all
+    MPI ranks and worker processes on a node, and later sessions load the
+    maps without recomputing them.
+    """
+    names = ('x', 'y', 'beta', 'rho', 'phi2')
+
+    def __init__(self, geometry_params, shape):
+        import hashlib
+        self.geometry_params = tuple(geometry_params)
+        self.shape = tuple(shape)
+        key = hashlib.sha1(repr((self.geometry_params, self.shape))).hexdigest()
+        self.path = os.path.join(GEOMETRY_CACHE_DIR, key)
+        if not all(os.path.isfile(self._fname(name)) for name in GeometryMaps.names):
+            self._save(_compute_maps(self.shape, *self.geometry_params, dtype = 'float32'))
+        for name in GeometryMaps.names:
+            setattr(self, name, np.load(self._fname(name), mmap_mode = 'r'))
+
+    def _fname(self, name):
+        return os.path.join(self.path, name + '.npy')
+
+    def _save(self, maps):
+        """
+        Write maps to disk. Each file is written under a temporary name and
+        then renamed, so that concurrent writers never expose a partial file.
+        """
+        if not os.path.exists(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError: # created concurrently by another process
+                pass
+        for name, arr in maps.iteritems():
+            tmp = self._fname(name) + '.%d.tmp' % os.getpid()
+            with open(tmp, 'wb') as f:
+                np.save(f, arr)
+            os.rename(tmp, self._fname(name))
+
+_geometry_maps = {}
+def get_geometry_maps(detid, shape):
+    """
+    Return the GeometryMaps instance for the given detector ID and frame
+    shape. Instances are shared within the interpreter session.
+    """
+    geometry_params = get_detid_parameters(detid)
+    return _get_geometry_maps(geometry_params, shape)
+
+def _get_geometry_maps(geometry_params, shape):
+    key = (tuple(geometry_params), tuple(shape))
+    if key not in _geometry_maps:
+        _geometry_maps[key] = GeometryMaps(*key)
+    return _geometry_maps[key]
+
 def get_x_y(imarray, phi, x0, y0, alpha, r):
     """
     Given CSPAD geometry parameters and an assembeled image data array, return
     two arrays (each of the same shape as the image data) with values replaced
     by row/column indices.
     """
-    length, width = imarray.shape
-    y = np.vstack(np.ones(width)*i for i in range(length))
-    ecks = np.vstack([1 for i in range(length)])
-    x = np.hstack(ecks*i for i in range(width))
-    return x, y
+    if any(param is None for param in (phi, x0, y0, alpha, r)):
+        # pixel indices don't depend on the geometry parameters
+        length, width = np.shape(imarray)
+        return np.broadcast_arrays(np.arange(width)[np.newaxis, :],
+            np.arange(length)[:, np.newaxis] * 1.)
+    maps = _get_geometry_maps((phi, x0, y0, alpha, r), np.shape(imarray))
+    return maps.x, maps.y
 
 def get_beta_rho(imarray, phi, x0, y0, alpha, r):
     """
@@ -47,19 +139,8 @@ def get_beta_rho(imarray, phi, x0, y0, alpha, r):
     angle values and (2) an array (of the same shape as the image data) with
     rho (distance) values.
     """
-    x, y = get_x_y(imarray, phi, x0, y0, alpha, r)
-    try:
-        x2 = -np.cos(phi) *(x-x0) + np.sin(phi) * (y-y0)
-        y2 = -np.sin(phi) * (x-x0) - np.cos(phi) * (y-y0)
-    except AttributeError:
-        raise AttributeError("Missing geometry data in config.py")
-    rho = (r**2 + x2**2 + y2**2)**0.5
-    y1 = y2 * np.cos(alpha) + r * np.sin(alpha)
-    z1 = - y2 * np.sin(alpha) + r * np.cos(alpha)
-    
-    # beta is the twotheta value for a given (x,y)
-    beta = np.arctan2((y1**2 + x2**2)**0.5, z1) * 180 / np.pi
-    return beta, rho
+    maps = _get_geometry_maps((phi, x0, y0, alpha, r), np.shape(imarray))
+    return maps.beta, maps.rho
 
 def get_phi2(imarray, detid):
     """
@@ -67,17 +148,7 @@ def get_phi2(imarray, detid):
     (1) an array (of the same shape as the image data) with values of phi2,
     the azimuthal angle with respect to the x-ray beam.
     """
-    (phi, x0, y0, alpha, r) = get_detid_parameters(detid)
-    x, y = get_x_y(imarray, phi, x0, y0, alpha, r)
-    try:
-        x2 = -np.cos(phi) *(x-x0) + np.sin(phi) * (y-y0)
-        y2 = -np.sin(phi) * (x-x0) - np.cos(phi) * (y-y0)
-    except AttributeError:
-        raise AttributeError("Missing geometry data in config.py")
-    y1 = y2 * np.cos(alpha) + r * np.sin(alpha)
-    z1 = - y2 * np.sin(alpha) + r * np.cos(alpha)
-    phi2 = np.arctan2(y1, z1)
-    return phi2
+    return get_geometry_maps(detid, np.shape(imarray)).phi2
 
 def select_phi2(imarray, phi2_0, delta_phi2, detid):
     """
@@ -122,6 +193,93 @@ def binData(mi, ma, stepsize, valenza = True):
 
     return binangles
 
+class AzimuthalIntegrator(object):
+    """
+    Lookup table for binning the pixels of an assembeled detector frame by
+    scattering angle.
+
+    The pixel -> 2theta bin assignment is stored as a sparse
+    (nbins + 1) x (number of pixels) matrix, so that a powder pattern is
+    obtained from a frame with one sparse matrix-vector product. Binning
+    conventions are identical to the original per-pixel loop in
+    process_imarray: bin edges span the full range of 2theta values on the
+    detector and pixels of value 0 don't contribute to a bin's pixel count.
+    """
+    def __init__(self, beta, nbins, mask = None):
+        """
+        beta : np.ndarray
+            2theta value of each pixel (see get_beta_rho)
+        nbins : int
+            number of angular bins
+        mask : np.ndarray
+            optional boolean array of the same shape as beta. Pixels for
+            which it is False are excluded from the lookup table.
+        """
+        thetas = np.ravel(beta)
+        mi, ma = np.min(thetas), np.max(thetas)
+        stepsize = (ma - mi)/(nbins)
+        self.shape = np.shape(beta)
+        self.nbins = nbins
+        self.binangles = binData(mi, ma, stepsize)
+
+        # find which bin each theta lies in
+        bin_indices = np.floor((thetas - mi)/stepsize).astype(int)
+        bin_indices = np.clip(bin_indices, 0, nbins)
+        pixel_indices = np.arange(thetas.size)
+        if mask is not None:
+            keep = np.ravel(mask).astype(bool)
+            bin_indices, pixel_indices = bin_indices[keep], pixel_indices[keep]
+        self.matrix = sparse.csr_matrix(
+            (np.ones(len(pixel_indices)), (bin_indices, pixel_indices)),
+            shape = (nbins + 1, thetas.size))
+
+    def integrate(self, imarray):
+        """
+        Return the mean intensity in each angular bin as a 1d np.ndarray.
+        """
+        return self.integrate_stack(np.asarray(imarray)[np.newaxis])[0]
+
+    def integrate_stack(self, stack):
+        """
+        Given an (N, H, W) stack of frames, return an (N, nbins + 1) array
+        containing the powder pattern of each frame.
+
+        All frames are binned with a single sparse matrix - dense matrix
+        product.
+        """
+        stack = np.asarray(stack)
+        if stack.shape[1:] != self.shape:
+            raise ValueError("Frame shape %s doesn't match integrator shape %s" %\
+                (str(stack.shape[1:]), str(self.shape)))
+        # indices: pixel, frame
+        intens = stack.reshape(len(stack), -1).T.astype('float')
+        intenValue = self.matrix.dot(intens)
+        numPix = self.matrix.dot((intens != 0).astype('float'))
+        # form average by dividing total intensity by the number of pixels
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            return np.nan_to_num(intenValue / numPix).T
+
+@cache.persist_to_file('geometry/integrator', collective = False)
+def _make_integrator(geometry_params, shape, nbins):
+    # The binning is done in double precision, independently of the float32
+    # maps of GeometryMaps, to reproduce the original bin assignment.
+    beta = _compute_maps(shape, *geometry_params)['beta']
+    return AzimuthalIntegrator(beta, nbins)
+
+def get_integrator(detid, shape, nbins = 1000):
+    """
+    Return an AzimuthalIntegrator for the given detector ID, frame shape and
+    number of bins.
+
+    Integrators are cached on disk, keyed on the detector's geometry
+    parameters in config.py (rather than detid alone), so that the lookup
+    table is only rebuilt when one of these inputs changes. Masked pixels
+    are zeroed by the caller instead, and zero pixels are excluded from the
+    averages.
+    """
+    geometry_params = get_detid_parameters(detid)
+    return _make_integrator(geometry_params, tuple(shape), nbins)
+
 #@utils.eager_persist_to_file("cache/xrd.process_imarray/")
 def process_imarray(detid, imarray, nbins = 1000,
         fiducial_ellipses = None, bgsub = True, compound_list = [],
@@ -137,17 +295,16 @@ def process_imarray(detid, imarray, nbins = 1000,
         bgsub = False
         log( "Overriding bg_sub to False due to empty compound_list")
         
-    @utils.eager_persist_to_file('cache/xrd/process_imarray/expanded_mask')
     def expanded_mask(arr):
         """
         Return a boolean array that masks out zero values
-        in and their neighbors in the input array.\
+        in and their neighbors in the input array.
+
+        maskmaker.makemask memoizes on the zero-pixel layout, so this is
+        only recomputed when the layout changes.
         """
-        import numpy.ma as ma
         import maskmaker
-        mask = ma.make_mask(np.ones_like(arr))
-        mask = np.where(arr == 0, False, True)
-        return maskmaker.makemask(mask, 2 * pre_integration_smoothing)
+        return maskmaker.makemask(arr, 2 * pre_integration_smoothing)
     # TODO: make this take dataset as an argument
     (phi, x0, y0, alpha, r) = get_detid_parameters(detid)
     if bgsub:
@@ -155,34 +312,69 @@ def process_imarray(detid, imarray, nbins = 1000,
     
     mask = expanded_mask(imarray)
     imarray = gaussian_filter(imarray, pre_integration_smoothing) * mask
-    data, imarray = translate(phi, x0, y0, alpha, r, imarray, fiducial_ellipses = fiducial_ellipses)
-    
-    thetas = data[:,0]
-    intens = data[:,1]
-
-    # algorithm for binning the data
-    ma = max(thetas)
-    mi = min(thetas)
-    stepsize = (ma - mi)/(nbins)
-    binangles = binData(mi, ma, stepsize)
-    numPix = [0] * (nbins+1)
-    intenValue = [0] * (nbins+1)
-    
+    if fiducial_ellipses is not None:
+        _, imarray = translate(phi, x0, y0, alpha, r, imarray, fiducial_ellipses = fiducial_ellipses)
+
+    # masked pixels are zero, so the integrator doesn't depend on the mask
+    integrator = get_integrator(detid, np.shape(imarray), nbins = nbins)
     log( "putting data in bins"        )
-    # find which bin each theta lies in and add it to count
-    for j,theta in enumerate(thetas):
-        if intens[j] != 0:
-            k = int(np.floor((theta-mi)/stepsize))
-            numPix[k]=numPix[k]+1
-            intenValue[k]=intenValue[k]+intens[j]
-    # form average by dividing total intensity by the number of pixels
-    log( "adjusting intensity")
-    adjInten = np.nan_to_num((np.array(intenValue)/np.array(numPix)))
+    adjInten = integrator.integrate(imarray)
     
 #    if np.min(adjInten) < 0:
 #        log( "WARNING: Negative values have been suppressed in final powder pattern (may indicate background subtraction with an inadequate data mask).")
 #        adjInten[adjInten < 0.] = 0.
-    return binangles, list(  adjInten ), imarray
+    return list(integrator.binangles), list(  adjInten ), imarray
+
+
+def _iter_stacks(frames, chunksize):
+    """
+    Given an (N, H, W) array or an iterable of 2d frames, yield (n, H, W)
+    arrays of at most chunksize frames each.
+    """
+    if isinstance(frames, np.ndarray):
+        for start in range(0, len(frames), chunksize):
+            yield frames[start:start + chunksize]
+    else:
+        frames = iter(frames)
+        while True:
+            chunk = list(itertools.islice(frames, chunksize))
+            if not chunk:
+                return
+            yield np.array(chunk)
+
+def process_stack(detid, frames, nbins = 1000, pre_integration_smoothing = 0,
+        chunksize = 64):
+    """
+    Batched version of process_imarray (without background subtraction or
+    fiducials) for event-resolved powder patterns.
+
+    frames : np.ndarray or iterable
+        Either an (N, H, W) stack of assembeled frames or an iterable (e.g.
+        a generator) of 2d frames, which is consumed chunksize frames at a
+        time.
+
+    Returns binangles, a list of bin angles, and an (N, nbins + 1)
+    np.ndarray of powder patterns.
+    """
+    import maskmaker
+    binangles = None
+    patterns = []
+    for stack in _iter_stacks(frames, chunksize):
+        stack = stack.astype('float')
+        if pre_integration_smoothing:
+            # Zero out pixels near dead ones, as in process_imarray. Without
+            # smoothing this mask is a no-op, since zero-valued pixels are
+            # excluded from the binning anyway.
+            masks = np.array([maskmaker.makemask(frame, 2 * pre_integration_smoothing)
+                for frame in stack])
+            stack = gaussian_filter(stack,
+                (0, pre_integration_smoothing, pre_integration_smoothing)) * masks
+        integrator = get_integrator(detid, stack.shape[1:], nbins = nbins)
+        binangles = integrator.binangles
+        patterns.append(integrator.integrate_stack(stack))
+    if not patterns:
+        raise ValueError("process_stack: no frames provided")
+    return list(binangles), np.vstack(patterns)
 
 
 # From: http://stackoverflow.com/questions/7997152/python-3d-polynomial-surface-fit-order-dependent
@@ -267,7 +459,7 @@ def interp_2d_nearest_neighbor(imarray, detid, smoothing = DEFAULT_SMOOTHING):
     smoothed = gaussian_filter(resampled, smoothing)
     return smoothed, resampled
 
-@utils.eager_persist_to_file('cache/xrd/CTinterpolation')
+@cache.persist_to_file('xrd/CTinterpolation', collective = False)
 def CTinterpolation(imarray, detid, smoothing = 10):
     """
     Do a 2d interpolation to fill in zero values of a 2d ndarray.
@@ -1,6 +1,7 @@
 from dataccess import xrd
 from dataccess import query
 from dataccess import utils
+from dataccess import eventmask
 
 
 """
@@ -12,15 +13,7 @@ def make_event_mask(runs, events_included, max_events = 1000):
     Given a list of run numbers, and a list of list of event numbers to be included for each
     run, return an event mask.
     """
-    mask = {}
-    for r, events in zip(runs, events_included):
-        mask[r] = {}
-        for i in range(max_events):
-            if i in events:
-                mask[r][i] = True
-            else:
-                mask[r][i] = False
-    return mask
+    return eventmask.EventMask.from_events(runs, events_included, max_events)
 
 def make_pattern_getter(detid, peakfinder = False, compound_list = None):
     def pattern_getter(arr, **kwargs):
@@ -3,6 +3,7 @@ import numpy as np
 import pylab as plt
 import os.path
 import sys
+from collections import OrderedDict
 
 # the basic approach is to look at each pixel in the png, look out n=avoidby pixels from that pixel and count how many zeros are observed. if the number of zeros is >= maxzeros, that pixel will be excluded. All others are included. 
 
@@ -47,13 +48,38 @@ def has_zero_neighbors(arr, x, y, shapex, shapey, n):
 #			mask[x,y]=shoulduse
 #	return mask
 
+# Masks returned by makemask, keyed on the layout of zero-valued pixels. Only
+# the MASK_CACHE_SIZE most recently used layouts are kept.
+MASK_CACHE_SIZE = 16
+_mask_cache = OrderedDict()
+
 def makemask(image, avoidby):
-    mask = np.zeros(image.shape, dtype="bool")
-    for x in xrange(image.shape[0]):
-        for y in xrange(image.shape[1]):
-            if has_zero_neighbors(image, x, y, image.shape[0], image.shape[1], avoidby):
-                shoulduse = False
-            else:
-                shoulduse = True
-            mask[x,y]=shoulduse
-    return mask
+    """
+    Return a boolean mask that is False for every pixel that has a zero-valued
+    pixel (including itself) within a square neighborhood of half-width
+    avoidby, and True elsewhere.
+
+    This is a binary dilation of the zero-valued pixels of image. Results
+    are memoized on the zero-pixel pattern, so that repeated calls for
+    frames with the same dead-pixel layout don't redo the dilation. The
+    returned array is read-only.
+    """
+    import hashlib
+    from scipy.ndimage import binary_dilation
+    zeros = (np.asarray(image) == 0)
+    n = int(np.ceil(avoidby))
+    key = (zeros.shape, n, hashlib.sha1(np.packbits(zeros).tostring()).hexdigest())
+    if key in _mask_cache:
+        _mask_cache[key] = _mask_cache.pop(key)
+    else:
+        if n > 0:
+            # out-of-bounds pixels count as nonzero, as in has_zero_neighbors
+            dilated = binary_dilation(zeros, structure = np.ones((2 * n + 1, 2 * n + 1), dtype = bool))
+        else:
+            dilated = zeros
+        mask = ~dilated
+        mask.setflags(write = False)
+        _mask_cache[key] = mask
+        if len(_mask_cache) > MASK_CACHE_SIZE:
+            _mask_cache.popitem(last = False)
+    return _mask_cache[key]
@@ -3,6 +3,7 @@ Functions for getting derived data from MEC-specific diagnostics.
 """
 import data_access
 import utils
+import cache
 import numpy as np
 from dataccess import xes_process as spec
 
@@ -45,13 +46,13 @@ def si_imarr_cm_subregion_3(imarr, **kwargs):
 
 #TODO: should have an mec-specific config file
 # TODO: Add a generic function for the integral of a detector in xes_process.py
-@utils.eager_persist_to_file('cache/mec/si_spectrometer_integral')
+@cache.persist_to_file('mec/si_spectrometer_integral')
 def si_spectrometer_integral(label, **kwargs):
     # Dark frame-subtracted si spectrometer data
     mean_frame, event_data = data_access.eval_dataset_and_filter(label, 'si', event_data_getter = si_imarr_sum)
     return np.sum(background_subtracted_spectrum(mean_frame))
 
-@utils.eager_persist_to_file('cache/mec/xrts1_fe_fluorescence_integral')
+@cache.persist_to_file('mec/xrts1_fe_fluorescence_integral')
 def xrts1_fe_fluorescence_integral(label):
     def xrts1_sum(imarr, **kwargs):
         indices, spectrum = background_subtracted_spectrum(imarr)
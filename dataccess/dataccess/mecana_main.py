@@ -120,6 +120,32 @@ def call_showderived(args):
     import query
     log( '\n'.join(query.get_derived_datset_labels()))
 
+def call_cache(args):
+    """
+    Input: args, a value returned by argparse.ArgumentParser.parse_args()
+
+    Calls the cache sub-command of this script.
+    """
+    import cache
+    disk_cache = cache.get_cache()
+    if args.clear is not None:
+        disk_cache.clear(args.clear)
+    if args.prune:
+        max_bytes, max_age = -1, -1
+        if args.max_bytes is not None:
+            max_bytes = args.max_bytes
+        if args.max_age is not None:
+            max_age = args.max_age * 86400
+        removed, freed = disk_cache.prune(max_bytes = max_bytes, max_age = max_age)
+        log( 'evicted %d entries (%d bytes)' % (removed, freed))
+    summary = disk_cache.summary()
+    for namespace in sorted(summary):
+        count, nbytes, last = summary[namespace]
+        log( '%-50s %6d entries %12d bytes   last used %s' % (namespace, count, nbytes,
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(last))))
+    log( 'total: %d entries, %d bytes (budget: %s)' % (sum(v[0] for v in summary.values()),
+        sum(v[1] for v in summary.values()), str(disk_cache.max_bytes)))
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--noplot', '-n', action = 'store_true', help = 'If selected, plotting is suppressed')
@@ -135,6 +161,7 @@ def main():
     argument_parsers.addparser_eventframes(subparsers)
     argument_parsers.addparser_query(subparsers)
     argument_parsers.addparser_showderived(subparsers)
+    argument_parsers.addparser_cache(subparsers)
 
     args = parser.parse_args()
 
@@ -190,6 +217,8 @@ def main():
             call_query(args)
         elif cmd == 'showderived':
             call_showderived(args)
+        elif cmd == 'cache':
+            call_cache(args)
 
     if utils.isroot():
         if config.playback:
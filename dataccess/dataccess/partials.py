@@ -0,0 +1,98 @@
+"""
+On-disk store of per-run partial results.
+
+A partial result is the outcome of evaluating one spec (detector id, event
+data getter, frame processor and dark frame) over the events of one run:
+the tuple (mean, event_data, events_processed, pixel_stats) returned by
+psget's per-run functions. Dataset-level results are composed from partials
+by count-weighted merging, so extending a dataset only requires processing
+the runs that haven't been seen before.
+
+Partial results are stored in the NAMESPACE namespace of the on-disk cache.
+"""
+
+import numpy as np
+
+import config
+import cache
+import fingerprint
+import accumulators
+
+NAMESPACE = 'psget/partials'
+
+# Marker stored for runs that yielded no valid events
+NO_EVENTS = 'no events'
+
+# config settings that change the result of evaluating a spec over a run:
+# testing mode keeps only every tenth event, and the others change the
+# frames or the statistics accumulated from them.
+CONFIG_KEYS = ('testing', 'accumulation_dtype', 'accumulate_moments', 'chip_level_correction',
+    'exppath')
+
+def _detector_settings(spec):
+    """
+    Return the config entries (config.detinfo_map or config.nonarea) of the
+    detectors whose data spec is evaluated on: its detector id and those
+    listed in its frame processor's detids attribute, if any.
+    """
+    spec = tuple(spec)
+    detids = [spec[0]]
+    if len(spec) > 2:
+        detids.extend(getattr(spec[2], 'detids', ()))
+    return [(detid, config.detinfo_map.get(detid), config.nonarea.get(detid))
+        for detid in detids]
+
+def partial_key(runNum, spec, run_mask = None, event_filter = None, kind = 'events', **kwargs):
+    """
+    Return the key of the partial result for spec evaluated over run runNum,
+    restricted to the events included by run_mask (an EventMask covering
+    this run only, or None) and accepted by event_filter (a spec, or None).
+
+    kind distinguishes results that aren't interchangeable for the same
+    spec (e.g. non-area detector data indexed by position rather than event
+    number).
+
+    The config settings that change a run's result (see CONFIG_KEYS), and
+    the config entries of the detectors that spec and event_filter read
+    (device name, subregion index, etc.), are part of the key.
+    """
+    settings = [getattr(config, name, None) for name in CONFIG_KEYS]
+    settings.append(_detector_settings(spec))
+    if event_filter is not None:
+        event_filter = tuple(event_filter)
+        settings.append(_detector_settings(event_filter))
+    settings = tuple(settings)
+    return fingerprint.fingerprint((kind, runNum, tuple(spec), run_mask, event_filter,
+        kwargs, settings))
+
+def _convert_frames(result, dtype):
+    """
+    Return a partial result with its floating point frames (the mean and
+    per-pixel statistics, but not the event data) converted to dtype.
+    """
+    def convert(elt):
+        if isinstance(elt, np.ndarray) and elt.dtype.kind == 'f' and elt.dtype != dtype:
+            return elt.astype(dtype)
+        if isinstance(elt, accumulators.PixelStats) and elt.count and elt.mean.dtype != dtype:
+            return elt.astype(dtype)
+        return elt
+    if not isinstance(result, tuple):
+        return result
+    return tuple(convert(elt) for elt in result)
+
+def load(key):
+    """
+    Return the stored partial result for key, or None if there isn't one.
+    """
+    try:
+        # collective, so that all MPI ranks agree on which runs to evaluate
+        return _convert_frames(cache.get_cache().load_shared(NAMESPACE, key), 'float64')
+    except KeyError:
+        return None
+
+def store(key, result):
+    """
+    Store a partial result in the on-disk cache (see cache.py), which writes
+    it atomically and evicts old entries as needed.
+    """
+    cache.get_cache().store(NAMESPACE, key, _convert_frames(result, config.storage_dtype))
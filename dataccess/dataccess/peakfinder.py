@@ -1,13 +1,125 @@
 import pdb
 from dataccess import utils
 import numpy as np
+from collections import namedtuple
 
 peak_attrs = ['seg', 'row', 'col', 'npix', 'amp_max', 'amp_total', 'row_cgrav', 'col_cgrav', 'raw_sigma', 'col_sigma', 'row_min', 'row_max', 'col_min', 'col_max', 'bkgd', 'noise', 'son']
 
 def make_peak_dict(lst):
     return {k: v for k, v in zip(peak_attrs, lst)}
 
-def consolidate_peaks(nda, winds = None, mask = None, thr_low = 10, thr_high = 150, radius = 5, dr = 1.):
+# Record format of the peaks returned by find_peaks
+peak_dtype = np.dtype([('frame', int), ('row', int), ('col', int), ('npix', int),
+    ('amp_max', float), ('amp_total', float), ('row_cgrav', float), ('col_cgrav', float),
+    ('row_sigma', float), ('col_sigma', float), ('row_min', int), ('row_max', int),
+    ('col_min', int), ('col_max', int)])
+
+def find_peaks(stack, mask = None, thr_low = 10, thr_high = 150, radius = 5):
+    """
+    Vectorized droplet finder for a 2d frame or an (N, H, W) stack of frames.
+
+    A peak is seeded by a local maximum (within a (2 * radius + 1)-pixel
+    square window) of value >= thr_high. Its droplet consists of the
+    4-connected pixels of value > thr_low that lie within radius of a seed.
+    Adjacent seeds whose droplets touch are merged into a single peak.
+
+    Returns a structured np.ndarray of dtype peak_dtype with one record
+    per peak, ordered by frame and then by position; 'frame' is 0 for 2d
+    input.
+    """
+    from scipy import ndimage
+    stack = np.asarray(stack, dtype = 'float')
+    if stack.ndim == 2:
+        stack = stack[np.newaxis]
+    if mask is not None:
+        assert np.shape(mask) == stack.shape[1:]
+        stack = stack * mask
+    n = int(np.ceil(radius))
+    window = 2 * n + 1
+    seeds = (stack >= thr_high) &\
+        (stack == ndimage.maximum_filter(stack, size = (1, window, window)))
+    y, x = np.ogrid[-n:n + 1, -n:n + 1]
+    disk = (x**2 + y**2 <= radius**2)[np.newaxis]
+    droplets = (stack > thr_low) & ndimage.binary_dilation(seeds, structure = disk)
+    # connectivity within, but not across, frames
+    cross = np.zeros((3, 3, 3), dtype = bool)
+    cross[1] = ndimage.generate_binary_structure(2, 1)
+    labels, nlabels = ndimage.label(droplets, structure = cross)
+
+    flat_labels = labels.ravel()
+    has_seed = np.bincount(flat_labels[seeds.ravel()], minlength = nlabels + 1) > 0
+    has_seed[0] = False
+    index = np.nonzero(has_seed)[0]
+    peaks = np.zeros(len(index), dtype = peak_dtype)
+    if not len(index):
+        return peaks
+
+    pixels = np.flatnonzero(flat_labels)
+    lab = flat_labels[pixels]
+    values = stack.ravel()[pixels]
+    _, rows, cols = np.unravel_index(pixels, stack.shape)
+    def labelsum(weights):
+        return np.bincount(lab, weights = weights, minlength = nlabels + 1)[index]
+    amp_total = labelsum(values)
+    row_cgrav = labelsum(values * rows) / amp_total
+    col_cgrav = labelsum(values * cols) / amp_total
+    peaks['npix'] = np.bincount(lab, minlength = nlabels + 1)[index]
+    peaks['amp_total'] = amp_total
+    peaks['row_cgrav'] = row_cgrav
+    peaks['col_cgrav'] = col_cgrav
+    peaks['row_sigma'] = np.sqrt(np.maximum(labelsum(values * rows**2) / amp_total - row_cgrav**2, 0))
+    peaks['col_sigma'] = np.sqrt(np.maximum(labelsum(values * cols**2) / amp_total - col_cgrav**2, 0))
+    peaks['amp_max'] = ndimage.maximum(stack, labels, index)
+    frame, row, col = np.array(ndimage.maximum_position(stack, labels, index)).T
+    peaks['frame'], peaks['row'], peaks['col'] = frame, row, col
+    boxes = [box for box, seeded in zip(ndimage.find_objects(labels), has_seed[1:]) if seeded]
+    peaks['row_min'] = [box[1].start for box in boxes]
+    peaks['row_max'] = [box[1].stop - 1 for box in boxes]
+    peaks['col_min'] = [box[2].start for box in boxes]
+    peaks['col_max'] = [box[2].stop - 1 for box in boxes]
+    return peaks
+
+def default_method():
+    """
+    Return the peak finder used by default: 'psana' (ImgAlgos'
+    peak_finder_v1) if ImgAlgos can be imported, 'numpy' (find_peaks)
+    otherwise.
+    """
+    try:
+        import ImgAlgos
+    except ImportError:
+        return 'numpy'
+    return 'psana'
+
+def consolidate_peaks_stack(stack, mask = None, thr_low = 10, thr_high = 150, radius = 5):
+    """
+    Stack version of consolidate_peaks: given an (N, H, W) array, return an
+    array of the same shape in which each peak's total value is placed at its
+    center of mass position.
+    """
+    output = np.zeros_like(stack)
+    peaks = find_peaks(stack, mask = mask, thr_low = thr_low, thr_high = thr_high, radius = radius)
+    output[peaks['frame'], peaks['row_cgrav'].astype(int), peaks['col_cgrav'].astype(int)] =\
+        peaks['amp_total']
+    return output
+
+def consolidate_peaks(nda, winds = None, mask = None, thr_low = 10, thr_high = 150, radius = 5, dr = 1.,
+        method = None):
+    """
+    Return an array of the same shape as nda in which each peak's total value
+    is placed at its center of mass position.
+
+    If method == 'numpy', peaks are found with find_peaks. If method ==
+    'psana', ImgAlgos' peak_finder_v1 is used (winds and dr only apply to
+    the latter). Defaults to default_method().
+    """
+    if method is None:
+        method = default_method()
+    if method == 'numpy':
+        return consolidate_peaks_stack(np.asarray(nda)[np.newaxis], mask = mask,
+            thr_low = thr_low, thr_high = thr_high, radius = radius)[0]
+    elif method != 'psana':
+        raise ValueError("invalid method: %s" % method)
     #pdb.set_trace()
     output = np.zeros_like(nda)
     def add_peak(pk):
@@ -16,7 +128,7 @@ def consolidate_peaks(nda, winds = None, mask = None, thr_low = 10, thr_high = 1
         output array. 
         """
         value = pk['amp_total']# - pk['npix'] * pk['bkgd']
-        i, j = pk['row_cgrav'], pk['col_cgrav']
+        i, j = int(pk['row_cgrav']), int(pk['col_cgrav'])
         def peak_valid():
             n, m = np.shape(nda)
             return (n > i >= 0 and m > j >= 0)
@@ -34,6 +146,74 @@ def consolidate_peaks(nda, winds = None, mask = None, thr_low = 10, thr_high = 1
     map(add_peak, peaks)
     return output
 
+def benchmark_consolidate_peaks(stack, nrepeat = 3, **kwargs):
+    """
+    Time consolidate_peaks over the frames of stack using the numpy and (if
+    ImgAlgos is available) psana peak finders, as well as the batched
+    consolidate_peaks_stack.
+
+    Returns a dict mapping each method to its mean time per frame, in seconds.
+    kwargs are passed to consolidate_peaks.
+    """
+    import time
+    from output import log
+    def time_per_frame(func):
+        start = time.time()
+        for _ in range(nrepeat):
+            func()
+        return (time.time() - start) / (nrepeat * len(stack))
+    result = {}
+    result['numpy'] = time_per_frame(
+        lambda: [consolidate_peaks(frame, method = 'numpy', **kwargs) for frame in stack])
+    stack_kwargs = {k: v for k, v in kwargs.iteritems() if k in ('mask', 'thr_low', 'thr_high', 'radius')}
+    result['numpy_stack'] = time_per_frame(
+        lambda: consolidate_peaks_stack(stack, **stack_kwargs))
+    try:
+        import ImgAlgos
+        result['psana'] = time_per_frame(
+            lambda: [consolidate_peaks(frame, method = 'psana', **kwargs) for frame in stack])
+    except ImportError:
+        log("ImgAlgos not available: skipping psana peak finder benchmark")
+    log("consolidate_peaks time per frame (s): %s" % str(result))
+    return result
+
+IslandMap = namedtuple('IslandMap', ['arr', 'labels', 'slices', 'sizes'])
+
+@utils.memoize(timeout = None)
+def label_islands(detid, threshold, minsize = 75):
+    """
+    Find 'islands': 4-connected clusters of pixels with value above the given
+    threshold, in the combined extra masks for detid. Islands smaller than
+    minsize pixels are removed by setting them to 0.
+
+    Returns an IslandMap instance:
+        arr : np.ndarray
+            the combined mask with small islands removed
+        labels : np.ndarray of ints
+            label array of the same shape as arr. 0 denotes background;
+            remaining islands are numbered 1...n in raster order
+        slices : list of tuples of slices
+            bounding box of each island
+        sizes : np.ndarray
+            number of pixels in each island
+    """
+    import config
+    from scipy import ndimage
+    extra_masks = config.detinfo_map[detid].extra_masks
+    arr = utils.combine_masks(None, extra_masks, transpose = False)
+    labels, nlabels = ndimage.label(arr > threshold)
+    sizes = np.bincount(labels.ravel(), minlength = nlabels + 1)
+    small = sizes < minsize
+    small[0] = False
+    arr[small[labels]] = 0
+
+    # renumber the remaining islands
+    kept = np.nonzero(~small)[0][1:]
+    relabel = np.zeros(nlabels + 1, dtype = int)
+    relabel[kept] = np.arange(1, len(kept) + 1)
+    labels = relabel[labels]
+    return IslandMap(arr, labels, ndimage.find_objects(labels), sizes[kept])
+
 @utils.memoize(timeout = None)
 def find_islands(detid, threshold, minsize = 75):
     """
@@ -44,45 +224,14 @@ def find_islands(detid, threshold, minsize = 75):
     the affected pixels for each cluster/island:
         arr -> np.ndarray, clusters -> list of np.ndarray
     """
-    import config
-    extra_masks = config.detinfo_map[detid].extra_masks
-    arr = utils.combine_masks(None, extra_masks, transpose = False)
-    q = []
-    def search(i, j):
-        cluster = []
-        q.append((i, j))
-        visited[(i, j)] = True
-        while q:
-            if arr[(i + 1, j)] > threshold and not visited[(i + 1, j)]:
-                q.append((i + 1, j))
-                visited[(i + 1, j)] = True
-            if arr[(i, j + 1)] > threshold and not visited[(i, j + 1)]:
-                q.append((i, j + 1))
-                visited[(i, j + 1)] = True
-            if arr[(i - 1, j)] > threshold and not visited[(i - 1, j)]:
-                q.append((i - 1, j))
-                visited[(i - 1 , j)] = True
-            if arr[(i, j - 1)] > threshold and not visited[(i, j -1 )]:
-                q.append((i, j - 1))
-                visited[(i , j - 1)] = True
-            current = q.pop()
-            i, j = current
-            cluster.append(current)
-        return cluster
-    def zero_cluster(cluster):
-        for coords in cluster:
-            arr[coords] = 0
-    visited = np.zeros(arr.shape, dtype = np.bool)
-    clusters = []
-    for i in range(arr.shape[0]):
-        for j in range(arr.shape[1]):
-            if (not visited[i][j]) and (arr[i][j]) > 0:
-                cluster = search(i, j)
-                if len(cluster) < minsize:
-                    zero_cluster(cluster)
-                else:
-                    clusters.append(cluster)
-    return arr, map(np.array, clusters)
+    islands = label_islands(detid, threshold, minsize = minsize)
+    flat_labels = islands.labels.ravel()
+    # pixel indices grouped by island
+    order = np.argsort(flat_labels, kind = 'mergesort')
+    order = order[flat_labels[order] > 0]
+    coords = np.vstack(np.unravel_index(order, islands.labels.shape)).T
+    clusters = np.split(coords, np.cumsum(islands.sizes)[:-1]) if len(islands.sizes) else []
+    return islands.arr, clusters
 
 def bounding_view(array, cluster):
     def get_bounds(cluster):
@@ -97,28 +246,50 @@ def clustermap(arr, clusters, func):
     return map(func, map(do_one, clusters))
 
 
-def peakfilter_frame(arr, detid = None, window_min = 0, radius = 4, thr_low = 20, thr_high = 50, detid_match = lambda detid: True, box_start = 0, box_end = 1000):
+def peakfilter_stack(stack, detid = None, window_min = 0, radius = 4, thr_low = 20, thr_high = 50, detid_match = lambda detid: True, box_start = 0, box_end = 1000,
+        method = None):
     """
-    Mutates arr.
+    Batched version of peakfilter_frame for an (N, H, W) stack of frames.
+
+    With method == 'numpy', each island's bounding box is processed for all
+    frames at once, so the Python overhead scales with the number of islands
+    rather than with (number of islands) x (number of frames). With method ==
+    'psana', frames are passed to ImgAlgos' peak finder one at a time.
+    Defaults to default_method().
+
+    Mutates stack.
     """
-    import peakfinder
-    def filtfunc2(arr):
-        return peakfinder.consolidate_peaks(arr, thr_low = thr_low, thr_high = thr_high, radius = radius)
-    def process_island2(subarr):
-        subarr[:] -= np.percentile(subarr, 20)
-        subarr[:] = filtfunc2(subarr)
-        return subarr
-    
+    if method is None:
+        method = default_method()
     # TODO: this is temporary safeguard until I adapt the notebook code
     if detid == 'si':
         raise ValueError
-    if detid_match(detid):
-        _, clusters = find_islands(detid, box_start, box_end)
-    else:
-        return arr
-    subregions = clustermap(arr, clusters, process_island2)
-    for cluster, subarr in zip(clusters, subregions):
-        bounding_view(arr, cluster)[:] = subarr
-    arr[arr < window_min] = 0
-    return arr
+    if not detid_match(detid):
+        return stack
+    islands = label_islands(detid, box_start, box_end)
+    def process_islands(box):
+        subarr = stack[(slice(None),) + box].copy()
+        flat = subarr.reshape(len(subarr), -1)
+        subarr -= np.percentile(flat, 20, axis = 1)[:, np.newaxis, np.newaxis]
+        if method == 'psana':
+            return np.array([consolidate_peaks(frame, thr_low = thr_low, thr_high = thr_high,
+                radius = radius, method = 'psana') for frame in subarr])
+        return consolidate_peaks_stack(subarr, thr_low = thr_low, thr_high = thr_high, radius = radius)
+    # All subregions are computed from the unmodified frames before any of
+    # them is written back.
+    subregions = map(process_islands, islands.slices)
+    for box, subarr in zip(islands.slices, subregions):
+        stack[(slice(None),) + box] = subarr
+    stack[stack < window_min] = 0
+    return stack
 
+def peakfilter_frame(arr, detid = None, window_min = 0, radius = 4, thr_low = 20, thr_high = 50, detid_match = lambda detid: True, box_start = 0, box_end = 1000,
+        method = None):
+    """
+    Mutates arr.
+    """
+    peakfilter_stack(arr[np.newaxis], detid = detid, window_min = window_min,
+        radius = radius, thr_low = thr_low, thr_high = thr_high,
+        detid_match = detid_match, box_start = box_start, box_end = box_end,
+        method = method)
+    return arr
@@ -0,0 +1,137 @@
+"""
+Background prefetching of psana events.
+
+EventPrefetcher wraps an iterator of (nevent, read) pairs, where read() reads
+the event (i.e. performs run.event(t)). A worker thread performs the reads
+and evaluates an optional fetch function on each event (e.g. reading
+det.raw()), keeping up to depth events ahead of the consumer. This overlaps
+xtc reads with the calibration and processing of the current event.
+
+The iterator itself is only ever advanced on the consumer's thread, so event
+sources that do MPI communication (e.g. psget.idxgen's shared work counter
+and its collective cleanup) don't require MPI.THREAD_MULTIPLE.
+
+Prefetching is experimental and off by default (config.prefetch_depth = 0):
+psana doesn't guarantee that its API is thread-safe, and with prefetching
+the worker thread calls run.event() and the detector reads in fetch while
+the consumer's thread processes the previous events with psana (e.g.
+Detector calibration in frame processors). Only enable it after checking
+the results against a run with prefetching disabled.
+"""
+
+import sys
+import threading
+import time
+import Queue
+
+import config
+from output import log
+
+_DONE = object()
+
+class EventPrefetcher(object):
+    """
+    Iterating over an instance yields (nevent, evt, fetched) tuples, where
+    fetched is the return value of fetch(evt) (None if fetch is None).
+
+    evtgen : iterator
+        Yields (nevent, read) pairs if deferred is True, (nevent, evt) pairs
+        (of events that have already been read) otherwise.
+    depth : int
+        Number of events to read ahead. If 0, events are read synchronously
+        on the consumer's thread. Defaults to config.prefetch_depth.
+
+    Attributes io_wait and compute accumulate the time (in seconds) the
+    consumer spends waiting for the next event and processing events,
+    respectively.
+    """
+    def __init__(self, evtgen, fetch = None, depth = None, deferred = False):
+        if depth is None:
+            depth = config.prefetch_depth
+        if depth > 0:
+            log('prefetching %d events on a background thread (experimental: psana '
+                'is not guaranteed to be thread-safe)' % depth)
+        self.evtgen = evtgen
+        self.fetch = fetch
+        self.depth = depth
+        self.deferred = deferred
+        self.io_wait = 0.
+        self.compute = 0.
+        self.nevents = 0
+
+    def _fetched(self, evt):
+        if self.fetch is None:
+            return None
+        return self.fetch(evt)
+
+    def _read(self, item):
+        if self.deferred:
+            return item()
+        return item
+
+    def _iter_sync(self):
+        for nevent, item in self.evtgen:
+            evt = self._read(item)
+            yield nevent, evt, self._fetched(evt)
+
+    def _iter_async(self):
+        requests = Queue.Queue()
+        results = Queue.Queue()
+        def worker():
+            while True:
+                request = requests.get()
+                if request is _DONE:
+                    return
+                nevent, item = request
+                try:
+                    evt = self._read(item)
+                    results.put((nevent, evt, self._fetched(evt), None))
+                except Exception:
+                    results.put((nevent, None, None, sys.exc_info()))
+        thread = threading.Thread(target = worker)
+        thread.daemon = True
+        thread.start()
+        source = iter(self.evtgen)
+        exhausted = False
+        pending = 0
+        try:
+            while True:
+                # the consumer's thread advances evtgen
+                while not exhausted and pending < self.depth:
+                    try:
+                        requests.put(next(source))
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    pending += 1
+                if pending == 0:
+                    return
+                nevent, evt, fetched, exc_info = results.get()
+                pending -= 1
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                yield nevent, evt, fetched
+        finally:
+            # also reached if the consumer stops early or raises
+            requests.put(_DONE)
+
+    def __iter__(self):
+        if self.depth > 0:
+            source = self._iter_async()
+        else:
+            source = self._iter_sync()
+        while True:
+            t0 = time.time()
+            try:
+                item = next(source)
+            except StopIteration:
+                return
+            t1 = time.time()
+            self.io_wait += t1 - t0
+            yield item
+            self.compute += time.time() - t1
+            self.nevents += 1
+
+    def report(self):
+        log('prefetch (depth %d): %d events, %.2f s waiting on I/O, %.2f s computing' %
+            (self.depth, self.nevents, self.io_wait, self.compute))
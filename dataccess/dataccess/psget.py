@@ -4,13 +4,26 @@ import numpy as np
 import os
 import random
 import time
+import sys
+import pickle
+import traceback
 from collections import namedtuple
 #import batchjobs
 import inspect
+import operator
 
 import config
 import logging
 from output import log
+import workqueue
+import prefetch
+import accumulators
+import eventdata
+import eventmask
+import partials
+import cache
+import sharedmem
+import framestore
 
 frame = inspect.currentframe()
 
@@ -31,59 +44,175 @@ def get_pool():
 #    return pool
 
 
-DataResultBase = namedtuple("DataResultBase", "mean, event_data")
-class DataResult(DataResultBase):
+class DataResult(object):
     """
     Basic datatype representing extracted data for a set of events.
 
     Attributes: 
     mean : np.ndarray
         Mean of detector readout over a number of events
-    event_data : dict
-        Maps {run number: {event number: event data}}
+    event_data : eventdata.EventData
+        Columnar store of event data that also behaves as the mapping
+        {run number: {event number: event data}}. Nested dicts passed to the
+        constructor are converted.
+    pixel_stats : accumulators.PixelStats
+        Per-pixel count, mean, variance, min and max of the detector
+        readout (the variance, min and max only if config.accumulate_moments
+        is True), or None if not available
+    count : int
+        Number of events over which mean was computed, or None if not known
+
+    Instances are combined with + (count-weighted mean over the union of
+    events), bgsubtract() and intersection(). These operations don't copy
+    event data: EventData instances are treated as immutable and shared
+    between results, and means and merged event data are only materialized
+    when the mean and event_data attributes are first accessed. Combining a
+    dataset's per-run results therefore costs O(pixels) per run, independent
+    of the number of events.
+
+    For compatibility with the former namedtuple, instances unpack as
+    (mean, event_data).
     """
-    def __new__(cls, mean, event_data_dict):
-        self = super(DataResult, cls).__new__(cls, mean, event_data_dict)
+    def __init__(self, mean, event_data_dict, pixel_stats = None, count = None):
+        if count is None and pixel_stats is not None and pixel_stats.count:
+            count = pixel_stats.count
+        self._mean = mean
+        # Lazy mean: the count-weighted average of the (count, mean) pairs
+        # in _terms, minus _offset
+        self._terms = None
+        self._offset = None
+        self._event_parts = [eventdata.as_event_data(event_data_dict)]
+        self.pixel_stats = pixel_stats
+        self.count = count
+
+    @classmethod
+    def _lazy(cls, terms, offset, event_parts, pixel_stats, count, mean = None):
+        self = cls.__new__(cls)
+        self._mean = mean
+        self._terms = terms
+        self._offset = offset
+        self._event_parts = event_parts
+        self.pixel_stats = pixel_stats
+        self.count = count
         return self
 
+    @property
+    def mean(self):
+        if self._terms is not None:
+            total = sum(n for n, _ in self._terms)
+            mean = None
+            for n, term_mean in self._terms:
+                if mean is None:
+                    mean = term_mean * (float(n) / total)
+                else:
+                    mean = mean + term_mean * (float(n) / total)
+            if self._offset is not None:
+                mean = mean - self._offset
+            self._mean = mean
+            self._terms = None
+            self._offset = None
+        return self._mean
+
+    @property
+    def event_data(self):
+        if len(self._event_parts) > 1:
+            self._event_parts = [eventdata.merge_all(self._event_parts)]
+        return self._event_parts[0]
+
+    def _weighted_terms(self):
+        """
+        Return a list of (count, mean) pairs whose count-weighted average is
+        self.mean, without materializing it if possible.
+        """
+        if self._terms is not None and self._offset is None:
+            return self._terms
+        if not self.count:
+            return []
+        return [(self.count, self.mean)]
+
+    def __iter__(self):
+        return iter((self.mean, self.event_data))
+
+    def __len__(self):
+        return 2
+
+    def __getitem__(self, i):
+        return (self.mean, self.event_data)[i]
+
+    def __reduce__(self):
+        return (DataResult, (self.mean, self.event_data, self.pixel_stats, self.count))
+
     def flat_event_data(self):
         """
-        Return a 1d np.ndarray of event data.
+        Return a np.ndarray of event data, ordered by run and event number.
+
+        Array-valued event data is vstacked, as by the nested-dict
+        implementation: 1d values are stacked along a new first axis, and
+        2d values (e.g. frames) are concatenated along their first axis,
+        giving an array of shape (nevents * rows, columns). Use
+        event_data.flat() for the (nevents,) + value shape array.
         """
-        # TODO: currently does not work if each event datum is a numpy array rather than
-        # a numeric type
-        def extract_event_data(arr2d):
-            try:
-                data_col = arr2d[:, -1]
-            except TypeError: # arr2d is a list, not an array
-                data_col = np.array([elt[-1] for elt in arr2d])
-            if type(data_col[0]) == np.ndarray:
-                return np.vstack(data_col)
-            return data_col
-        return extract_event_data(utils.flatten_dict(self.event_data))
+        data = self.event_data.flat()
+        if data.ndim > 2:
+            return np.asarray(data).reshape((-1,) + data.shape[2:])
+        if data.dtype == object and len(data) and isinstance(data[0], np.ndarray):
+            # values of different shapes
+            return np.vstack(data)
+        return data
 
     # TODO docstring
     def iter_event_value_pairs(self):
-        event_data_dict = self.event_data
-        for run in event_data_dict:
-            for nevent in event_data_dict[run]:
-                yield event_data_dict[run][nevent]
+        return iter(self.event_data.data)
 
     def nevents(self):
         """ Return the number of events"""
-        return np.sum(map(len, self.event_data.values()))
+        return self.event_data.nevents()
+
+    def variance(self, ddof = 0):
+        """
+        Return the per-pixel variance of the detector readout. Requires
+        pixel_stats.
+        """
+        if self.pixel_stats is None:
+            raise ValueError("No per-pixel statistics available")
+        return self.pixel_stats.variance(ddof = ddof)
 
     def bgsubtract(self, bgarr):
-        """Return a new instance with bgarr subtracted from self.mean"""
-        from copy import deepcopy
-        return DataResult(
-            self.mean - bgarr,
-            deepcopy(self.event_data))
+        """
+        Return a new instance with bgarr subtracted from self.mean. Event data
+        is shared with self.
+        """
+        if self.pixel_stats is not None:
+            pixel_stats = self.pixel_stats.shift(bgarr)
+        else:
+            pixel_stats = None
+        if self._terms is None or self.count is None:
+            return DataResult._lazy(None, None, list(self._event_parts),
+                pixel_stats, self.count, mean = self.mean - bgarr)
+        if self._offset is None:
+            offset = bgarr
+        else:
+            offset = self._offset + bgarr
+        return DataResult._lazy(self._terms, offset, list(self._event_parts),
+            pixel_stats, self.count)
 
     def __add__(self, other):
-        return DataResult(
-            self.mean + other.mean,
-            utils.merge_dicts(self.event_data, other.event_data))
+        if self.pixel_stats is not None and other.pixel_stats is not None:
+            pixel_stats = self.pixel_stats.merge(other.pixel_stats)
+        else:
+            pixel_stats = None
+        event_parts = self._event_parts + other._event_parts
+        if self.count is None or other.count is None:
+            # Results without event counts (e.g. pickled by earlier
+            # versions) are combined by adding their means.
+            return DataResult._lazy(None, None, event_parts, pixel_stats, None,
+                mean = self.mean + other.mean)
+        terms = self._weighted_terms() + other._weighted_terms()
+        if not terms:
+            return DataResult._lazy(None, None, event_parts, pixel_stats, 0,
+                mean = self.mean)
+        return DataResult._lazy(terms, None, event_parts, pixel_stats,
+            self.count + other.count)
 
     def intersection(self, other):
         """
@@ -91,32 +220,148 @@ class DataResult(DataResultBase):
         Return data of the same type and format as flat_event_data, but exclude
         events that are not contained in other.
         """
-        pruned_event_data = utils.prune_dict(self.event_data, other.event_data)
-        return DataResult(None, pruned_event_data)
+        return DataResult(None, self.event_data.intersection(other.event_data))
         
 
-def idxgen(ds):
-    from mpi4py import MPI
-    comm = MPI.COMM_WORLD
+class DetectorCache(object):
+    """
+    Cache of psana Detector objects and of per-run detector constants
+    (pixel index arrays, pedestals), so that they are set up on the first
+    event of a run rather than on every event.
+
+    Detector instances are tied to the DataSource they were created from
+    and are dropped when a different one is seen; all other
+    entries are dropped when the run number changes. hits and misses count
+    lookups since the last call to reset_counters().
+    """
+    def __init__(self):
+        self.ds = None
+        self.run = None
+        self.detectors = {}
+        self.constants = {}
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, cache, key, make):
+        if key in cache:
+            self.hits += 1
+        else:
+            self.misses += 1
+            cache[key] = make()
+        return cache[key]
+
+    def detector(self, device_name, ds):
+        if ds is not self.ds:
+            self.ds = ds
+            self.detectors = {}
+        return self._lookup(self.detectors, device_name,
+            lambda: psana.Detector(device_name, ds.env()))
+
+    def get(self, key, rnum, make):
+        """
+        Return the run-scoped value for key, calling make() to compute it
+        on a miss.
+        """
+        if rnum != self.run:
+            self.run = rnum
+            self.constants = {}
+        return self._lookup(self.constants, key, make)
+
+    def pixel_indexes(self, det, device_name, rnum, quad):
+        def make():
+            geo = det.geometry(rnum)        # for >ana-0.17.5
+            return geo.get_pixel_coord_indexes('QUAD:V1', quad)
+        return self.get(('pixel_indexes', device_name, quad), rnum, make)
+
+    def pedestals(self, det, device_name, evt):
+        def make():
+            ped = det.pedestals(evt)
+            if ped is not None:
+                ped.setflags(write = False)
+            return ped
+        return self.get(('pedestals', device_name), evt.run(), make)
+
+    def report(self):
+        log('detector cache: %d hits, %d misses' % (self.hits, self.misses))
+
+detector_cache = DetectorCache()
+
+# Communicator over which the events of the run being evaluated are
+# distributed. None means MPI.COMM_WORLD; see evaluate_runs_concurrently.
+# The communicator helpers live in workqueue, so that cache.py can use them
+get_comm = workqueue.get_comm
+run_communicator = workqueue.run_communicator
+
+def accepted_events(nevents, run_mask = None, accepted = None):
+    """
+    Return the sorted array of event numbers in [0, nevents) that are to be
+    read, given either a RunMask or a sequence of accepted event numbers
+    (if both are None, all events are accepted). In testing mode only every
+    tenth event is accepted.
+    """
+    if accepted is not None:
+        events = np.unique(np.asarray(accepted, dtype = int))
+        events = events[(events >= 0) & (events < nevents)]
+    elif run_mask is not None:
+        events = run_mask.accepted()
+        events = events[events < nevents]
+    else:
+        events = np.arange(nevents)
+    if config.testing:
+        events = events[events % 10 == 0]
+    return events
+
+def idxgen(ds, stats = None, run_mask = None, accepted = None, deferred = False):
+    """
+    Yield (nevent, evt) for the accepted events of the first run in ds that
+    are assigned to this MPI rank. Only accepted events are read, and chunks
+    of them are handed out on demand by a shared work queue, so every
+    accepted event is visited by exactly one rank and the work is balanced
+    over the accepted set rather than over the whole run.
+
+    stats : workqueue.WorkerStats
+        If provided, accumulates this rank's event count and busy time.
+    run_mask : eventmask.RunMask
+        If provided, events excluded by the mask are skipped without being
+        read.
+    accepted : sequence of ints
+        Precomputed event numbers to read. Takes precedence over run_mask.
+    deferred : bool
+        If True, yield (nevent, read) instead, where read() reads the event
+        (see prefetch.EventPrefetcher).
+    """
+    comm = get_comm()
     rank = comm.Get_rank()
     if rank==0: log( 'idx mode')
-    size = comm.Get_size()
+    if stats is None:
+        stats = workqueue.WorkerStats(rank)
     run = ds.runs().next()
     times = run.times()
-    log('size: '+ str(size))
-    mylength = len(times)//size
-    startevt = rank*mylength
-    mytimes= times[startevt:(rank+1)*mylength]
-    for nevent,t in enumerate(mytimes, startevt):
-        yield nevent,run.event(t)
+    events = accepted_events(len(times), run_mask = run_mask, accepted = accepted)
+    log('size: '+ str(comm.Get_size()))
+    if rank == 0:
+        log('reading %d of %d events' % (len(events), len(times)))
+    queue = workqueue.ChunkQueue(len(events), workqueue.MPICounter(comm))
+    try:
+        for k in stats.iter_events(queue):
+            nevent = int(events[k])
+            if deferred:
+                yield nevent, lambda t = times[nevent]: run.event(t)
+            else:
+                yield nevent, run.event(times[nevent])
+    finally:
+        # collective: also reached if the consumer stops early or raises
+        queue.free()
 
 #def mproc_process(nevent, run):
 #    times = run.times()
 #    return run.event(times[nevent])
 
 def smdgen(ds):
-    from mpi4py import MPI
-    comm = MPI.COMM_WORLD
+    comm = get_comm()
     rank = comm.Get_rank()
     size = comm.Get_size()
     if rank==0: log( 'smd mode')
@@ -154,7 +399,7 @@ from dataccess import utils
 XTC_DIR = '/reg/d/psdm/' + config.exppath + '/xtc/'
 
 
-@utils.eager_persist_to_file('cache/psget/gsor')
+@cache.persist_to_file('psget/gsor')
 def get_signal_one_run(runNum, detid = 1, sigma_max = 1000.0,
     event_data_getter = None, event_mask = None, **kwargs):
     # TODO: remove sigma_max discrimination
@@ -227,33 +472,50 @@ def get_signal_one_run(runNum, detid = 1, sigma_max = 1000.0,
         return signal, event_data
 
 
-def get_area_detector_subregion(quad, det, evt, detid):
+def get_area_detector_subregion(quad, det, evt, detid, prefetched = None, dtype = 'float'):
     """
     Extracts data from an individual quad detector.
 
     if chip_level_correction, the 50th percentile value for each
     chip is subtracted.
+
+    dtype : str
+        dtype of the returned frame if the whole detector is read. With
+        'int64', integer raw data is returned as int64 and anything else as
+        float64 (see config.accumulation_dtype).
+
+    prefetched : dict
+        Per-event arrays already read by a function returned by
+        detector_fetcher, keyed by the name of the Detector method
+        ('raw' or 'image').
     """
+    if prefetched is None:
+        prefetched = {}
+    def read(name):
+        if name in prefetched:
+            return prefetched[name]
+        return getattr(det, name)(evt)
     if quad>3 : quad = 3
     if quad >= 0:
         if 'Cspad' not in config.detinfo_map[detid].device_name:
             raise ValueError("Can't take subregion of non-CSPAD detector")
         rnum = evt.run()
-        geo = det.geometry(rnum)        # for >ana-0.17.5
+        device_name = config.detinfo_map[detid].device_name
 
         # get pixel index array for quad, shape=(8, 185, 388)
-        iX, iY = geo.get_pixel_coord_indexes('QUAD:V1', quad)
+        iX, iY = detector_cache.pixel_indexes(det, device_name, rnum, quad)
 #        print_ndarr(iX, 'iX')
 #        print_ndarr(iY, 'iY')
 
         t0_sec = time.time()
 
-        nda = det.raw(evt)
+        nda = read('raw')
         if nda is None:
             msg = "get_area_detector_subregion: det.raw() returned None"
             log (msg)
             raise AttributeError(msg)
-        ped = det.pedestals(evt)
+        # Cached across events of the run: must not be modified in place
+        ped = detector_cache.pedestals(det, device_name, evt)
         # documentation: https://confluence.slac.stanford.edu/display/
         # PSDM/Common+mode+correction+algorithms
         cm = det.common_mode_correction(evt, nda - ped, [5, 50])
@@ -262,14 +524,13 @@ def get_area_detector_subregion(quad, det, evt, detid):
         #print_ndarr(nda, 'raw')
 
         # get intensity array for quad, shape=(8, 185, 388)
-        nda.shape = (4, 8, 185, 388)
+        # reshape views: nda may be shared between several specs' accumulators
+        nda = nda.reshape((4, 8, 185, 388))
         ndaq = nda[quad,:]
 
-        cm.shape = nda.shape
-        cmq = cm[quad,:]
+        cmq = cm.reshape(nda.shape)[quad,:]
         
-        ped.shape = (4, 8, 185, 388)
-        pedq = ped[quad,:]
+        pedq = ped.reshape((4, 8, 185, 388))[quad,:]
 # TODO: should we keep chip-level correction disabled?
         try:
             chip_correction = config.chip_level_correction
@@ -280,14 +541,18 @@ def get_area_detector_subregion(quad, det, evt, detid):
 #        except AttributeError, e:
 #            raise utils.ConfigAttributeError(str(e))
         if chip_correction:
+            pedq = pedq.copy()
             for chip_pedestal, chip_nda in zip(pedq, ndaq):
                 offset = np.percentile(chip_nda, 45) - np.mean(chip_pedestal)
                 chip_pedestal += offset
+            bg = img_from_pixel_arrays(iX, iY, W=pedq)
+        else:
+            bg = detector_cache.get(('pedestal_image', device_name, quad), rnum,
+                lambda: img_from_pixel_arrays(iX, iY, W=pedq))
         #print_ndarr(ndaq, 'nda[%d,:]'%quad)
 
         # reconstruct image for quad
         img = img_from_pixel_arrays(iX, iY, W=ndaq)
-        bg = img_from_pixel_arrays(iX, iY, W=pedq)
         common = img_from_pixel_arrays(iX, iY, W=cmq)
 
         new = np.empty_like(img)
@@ -295,14 +560,34 @@ def get_area_detector_subregion(quad, det, evt, detid):
         return new
     else:
         if 'Cspad' in config.detinfo_map[detid].device_name:
-            increment = det.image(evt)
+            increment = read('image')
         else:
-            increment = det.raw(evt)
+            increment = read('raw')
         if increment is not None:
-            return increment.astype('float')
+            if dtype == 'int64' and increment.dtype.kind not in 'biu':
+                dtype = 'float'
+            return increment.astype(dtype)
         else:
             return increment
 
+def detector_fetcher(det, detid):
+    """
+    Return a function that reads, for a given event, the arrays that
+    get_area_detector_subregion needs from det. Used to move xtc reads onto
+    a prefetch.EventPrefetcher thread.
+    """
+    subregion_index = config.detinfo_map[detid].subregion_index
+    if subregion_index >= 0:
+        # pedestals come from detector_cache
+        names = ['raw']
+    elif 'Cspad' in config.detinfo_map[detid].device_name:
+        names = ['image']
+    else:
+        names = ['raw']
+    def fetch(evt):
+        return {name: getattr(det, name)(evt) for name in names}
+    return fetch
+
 def get_ds(runNum):
     if config.smd:
         return psana.DataSource('exp=%s:run=%d:idx' % (config.expname, runNum))
@@ -323,39 +608,57 @@ def get_event_data_nonarea(runNum, detid = None, **kwargs):
             size = 1
         else:
             size = pool.ncpus
+        ds = get_ds(runNum)
+        queue = workqueue.ChunkQueue(len(ds.runs().next().times()),
+            workqueue.pool_counter())
         def mapfunc(i):
             ds = get_ds(runNum)
             if i ==0: log( 'idx mode')
             run = ds.runs().next()
             times = run.times()
             log('size: '+ str(size))
-            length = max(1, len(times)//size)
-            startevt = i *length
-            mytimes= times[startevt:(i +1)*length]
-            det_values = []
-            for t in mytimes:
-                evt = run.event(t)
-                det_values = accumulator_nonarea(evt, detid, det_values = det_values)
-            return det_values
-
-        gathered = pool.map(mapfunc, range(size))
+            stats = workqueue.WorkerStats(i)
+            indexed_values = []
+            for nevent in stats.iter_events(queue):
+                evt = run.event(times[nevent])
+                det_values = accumulator_nonarea(evt, detid, det_values = [])
+                if det_values:
+                    indexed_values.append((nevent, det_values[0]))
+            return indexed_values, stats
+
+        start = time.time()
+        if config.testing:
+            gathered, stats_list = zip(*map(mapfunc, range(size)))
+        else:
+            gathered, stats_list = zip(*pool.map(mapfunc, range(size)))
+        workqueue.report_utilization(stats_list, time.time() - start)
     else:
         log('using MPI in get_event_data_nonarea')
-        from mpi4py import MPI
-        comm = MPI.COMM_WORLD
+        comm = get_comm()
         #evtgen = smdgen(ds)
         ds = get_ds(runNum)
-        evtgen = idxgen(ds)
-        det_values = []
+        stats = workqueue.WorkerStats(comm.Get_rank())
+        evtgen = idxgen(ds, stats = stats)
+        indexed_values = []
         for nevent, evt in evtgen:
             log('processing' + str(nevent))
-            if config.testing and nevent % 10 != 0:
-                continue
-            det_values = accumulator_nonarea(evt, detid, det_values = det_values)
+            det_values = accumulator_nonarea(evt, detid, det_values = [])
+            if det_values:
+                indexed_values.append((nevent, det_values[0]))
+        workqueue.gather_utilization(comm, stats)
+        if config.event_data_shards:
+            # only the shards' manifest and a view of them are communicated
+            shard = eventdata.EventData([runNum] * len(indexed_values),
+                [nevent for nevent, _ in indexed_values],
+                [value for _, value in indexed_values])
+            return list(framestore.gather_event_data(comm, shard).flat())
         log('going to gather')
-        gathered = comm.allgather(det_values)
+        gathered = comm.allgather(indexed_values)
         log('gathered')
-    return reduce(lambda x, y: x + y, gathered)
+    # Chunks are handed out dynamically, so restore event order
+    indexed_values = sorted(reduce(lambda x, y: x + y, gathered),
+        key = lambda pair: pair[0])
+    return [value for nevent, value in indexed_values]
 
 #@utils.eager_persist_to_file('cache/psget/gedn')
 def accumulator_nonarea(evt, detid, det_values = []):
@@ -382,10 +685,10 @@ def accumulator_nonarea(evt, detid, det_values = []):
 #@memory.cache
 def get_signal_one_run_nonarea(runNum, detid = None,
         event_data_getter = None, event_mask = None, **kwargs):
+    event_mask = eventmask.as_event_mask(event_mask)
     def event_valid(nevent):
         if event_mask:
-            run_mask = event_mask[runNum]
-            return run_mask[nevent]
+            return event_mask.is_valid(runNum, nevent)
         else:
             return True
 
@@ -395,6 +698,7 @@ def get_signal_one_run_nonarea(runNum, detid = None,
         for i, dat in enumerate(det_values)
         if event_valid(i)]
     event_mean = np.sum(det_values_filtered) / len(det_values_filtered)
+    pixel_stats = accumulators.PixelStats.from_frames(det_values_filtered)
 
     if event_data_getter:
         event_data_list =\
@@ -407,13 +711,13 @@ def get_signal_one_run_nonarea(runNum, detid = None,
             if event_valid(i)}
     else:
         event_data = {}
-    return event_mean, event_data, len(det_values_filtered)
+    return event_mean, event_data, len(det_values_filtered), pixel_stats
 
 
 # TODO: more testing and refactor all of this!
 def eval_frame_processor(evt, ds, frame_processor, **kwargs):
     def detid_array(detid):
-        det = psana.Detector(config.detinfo_map[detid].device_name, ds.env())
+        det = detector_cache.detector(config.detinfo_map[detid].device_name, ds)
         try:
             subregion_index = config.detinfo_map[detid].subregion_index
         except KeyError, e:
@@ -431,27 +735,40 @@ def eval_frame_processor(evt, ds, frame_processor, **kwargs):
         except KeyError, e:
             raise ValueError("kwarg 'detid' must be provided if frame_processor lacks the attribute detids")
 
-def accumulator_area(ds, evt,  nevent, runNum, det, signalsum = None, detid = None, event_data = None, events_processed = 0,
-        dark_frame = None, event_mask = None, frame_processor = None, event_data_getter = None, **kwargs):
+def accumulator_area(ds, evt,  nevent, runNum, det, pixel_stats = None, detid = None, event_data = None, events_processed = 0,
+        dark_frame = None, event_mask = None, frame_processor = None, event_data_getter = None,
+        prefetched = None, **kwargs):
+    """
+    Process one event, adding the (possibly frame_processor-transformed)
+    detector data to pixel_stats, an accumulators.PixelStats instance.
+
+    Returns pixel_stats, event_data, events_processed.
+    """
+    if pixel_stats is None:
+        pixel_stats = accumulators.PixelStats()
     if event_data is None:
         event_data = {}
+    event_mask = eventmask.as_event_mask(event_mask)
     def event_valid(nevent):
-        if config.testing and nevent % 10 != 0:
-            return False
         if event_mask is not None:
-            run_mask = event_mask[runNum]
-            if nevent in run_mask:
-                return run_mask[nevent]
-            else:
-                return False
+            return event_mask.is_valid(runNum, nevent)
         else:
             return True
     if event_valid(nevent):
         try:
             subregion_index = config.detinfo_map[detid].subregion_index
+            if frame_processor is None and event_data_getter is None:
+                # frames aren't seen by any per-event consumer
+                dtype = config.accumulation_dtype
+            else:
+                dtype = 'float'
             increment = get_area_detector_subregion(subregion_index, det, evt,
-                detid)
-            if dark_frame is not None:
+                detid, prefetched = prefetched, dtype = dtype)
+            # frame_processor output is computed from evt, so the corrected
+            # frame is only needed if it's accumulated directly
+            if dark_frame is not None and frame_processor is None:
+                if increment.dtype.kind in 'biu':
+                    increment = increment.astype('float')
                 increment -= dark_frame#.astype('uint16')
             if frame_processor is not None:
                 if dark_frame is None:
@@ -474,149 +791,333 @@ def accumulator_area(ds, evt,  nevent, runNum, det, signalsum = None, detid = No
             if event_data_getter:
                 event_data[nevent] = event_data_getter(increment, run = runNum,
                     nevent = nevent)
-            if signalsum is None:
-                signalsum = np.zeros_like(increment).astype('float')
-            signalsum += increment
+            pixel_stats.add(increment)
             events_processed += 1
         else:
             if event_valid(nevent):
                 log('bad event: %d' % nevent)
-    return signalsum, event_data, events_processed
+    return pixel_stats, event_data, events_processed
+
+EvalSpec = namedtuple('EvalSpec', ['detid', 'event_data_getter', 'frame_processor', 'dark_frame'])
+
+def defers_dark_subtraction(spec):
+    """
+    Return True if spec's dark frame can be subtracted from the reduced
+    statistics rather than from every event. This is the case when no
+    per-event consumer (frame processor or event data getter) needs the
+    dark-subtracted frame: the subtraction commutes with accumulation.
+    """
+    return (spec.dark_frame is not None and spec.frame_processor is None
+        and spec.event_data_getter is None and spec.detid not in config.nonarea)
+
+def make_spec(spec):
+    """
+    Normalize spec, a detector id or a tuple of the form (detid[,
+    event_data_getter[, frame_processor[, dark_frame]]]), to an EvalSpec.
+    """
+    if isinstance(spec, EvalSpec):
+        return spec
+    if not isinstance(spec, (tuple, list)):
+        spec = (spec,)
+    if not 1 <= len(spec) <= 4:
+        raise ValueError("Invalid evaluation spec: %s" % str(spec))
+    return EvalSpec(*(tuple(spec) + (None,) * (4 - len(spec))))
+
+class SpecAccumulator(object):
+    """
+    Accumulates the data of one EvalSpec over the events of a run.
+
+    If store_frames is True, large per-event values (see
+    config.frame_store_min_bytes) are written to a framestore.FrameWriter
+    instead of being kept in self.event_data.
+    """
+    def __init__(self, spec, runNum, ds, event_mask = None, store_frames = True, **kwargs):
+        self.spec = spec
+        self.runNum = runNum
+        self.event_mask = event_mask
+        self.kwargs = kwargs
+        self.nonarea = spec.detid in config.nonarea
+        if self.nonarea:
+            self.det = None
+        else:
+            self.det = detector_cache.detector(config.detinfo_map[spec.detid].device_name, ds)
+        self.pixel_stats = accumulators.make_accumulator(config.accumulation_dtype,
+            config.accumulation_block_size, moments = config.accumulate_moments)
+        self.event_data = {}
+        self.events_processed = 0
+        # sharedmem.StatsSlot holding pixel_stats' arrays, if any
+        self.slot = None
+        if store_frames and spec.event_data_getter:
+            self.frame_writer = framestore.FrameWriter()
+        else:
+            self.frame_writer = None
+        # event number -> row in frame_writer's file
+        self.stored_rows = {}
+
+    def fetcher(self):
+        if self.nonarea:
+            return None
+        return detector_fetcher(self.det, self.spec.detid)
+
+    def add_event(self, ds, evt, nevent, prefetched = None):
+        """
+        Process one event. Returns True if it yielded valid data.
+        """
+        spec = self.spec
+        events_before = self.events_processed
+        if self.nonarea:
+            if self.event_mask is not None and not self.event_mask.is_valid(self.runNum, nevent):
+                return False
+            values = accumulator_nonarea(evt, spec.detid, det_values = [])
+            if values:
+                value = values[0]
+                if spec.event_data_getter:
+                    self.event_data[nevent] = spec.event_data_getter(value, run = self.runNum)
+                self.pixel_stats.add(value)
+                self.events_processed += 1
+        else:
+            self.pixel_stats, self.event_data, self.events_processed = accumulator_area(ds, evt, nevent,
+                    self.runNum, self.det, pixel_stats = self.pixel_stats, detid = spec.detid,
+                    event_data = self.event_data, events_processed = self.events_processed,
+                    dark_frame = None if defers_dark_subtraction(spec) else spec.dark_frame,
+                    event_mask = self.event_mask,
+                    frame_processor = spec.frame_processor, event_data_getter = spec.event_data_getter,
+                    prefetched = prefetched, **self.kwargs)
+        if self.slot is not None:
+            self.slot.track(self.pixel_stats)
+        if self.frame_writer is not None and self.frame_writer.accepts(self.event_data.get(nevent)):
+            self.stored_rows[nevent] = self.frame_writer.append(self.event_data.pop(nevent))
+        return self.events_processed > events_before
+
+    def partial(self):
+        """
+        Return this worker's partial result: pixel_stats, event_data
+        (as eventdata.EventData) and events_processed.
+        """
+        event_data = eventdata.EventData.from_dict({self.runNum: self.event_data})
+        if self.stored_rows:
+            self.frame_writer.close()
+            events = sorted(self.stored_rows)
+            stored = eventdata.EventData([self.runNum] * len(events), events,
+                self.frame_writer.column([self.stored_rows[nevent] for nevent in events]))
+            event_data = eventdata.concatenate([event_data, stored])
+        return self.pixel_stats.finalize(), event_data, self.events_processed
+
+    def shared_partial(self):
+        """
+        Return this worker's partial result as a sharedmem.SharedPartial.
+        """
+        return sharedmem.export_partial(self.slot, *self.partial())
+
+def _accumulate_events(prefetcher, ds, accumulators_list, event_filter = None, progress = None):
+    """
+    Run the event loop shared by all specs: each event is read once and
+    handed to every accumulator. If event_filter (a SpecAccumulator) is
+    given, it is evaluated first, and the event is passed on only if its
+    event_data_getter returns a true value.
+    """
+    for nevent, evt, prefetched in prefetcher:
+        if event_filter is not None:
+            event_filter.add_event(ds, evt, nevent, prefetched = prefetched.get(event_filter.spec.detid))
+            if not event_filter.event_data.get(nevent):
+                continue
+        for acc in accumulators_list:
+            acc.add_event(ds, evt, nevent, prefetched = prefetched.get(acc.spec.detid))
+        if progress is not None:
+            progress(nevent)
+
+def _combined_fetcher(accumulators_list):
+    fetchers = {}
+    for acc in accumulators_list:
+        fetcher = acc.fetcher()
+        if fetcher is not None:
+            fetchers[acc.spec.detid] = fetcher
+    def fetch(evt):
+        return {detid: fetcher(evt) for detid, fetcher in fetchers.iteritems()}
+    return fetch
+
+#@utils.eager_persist_to_file('cache/psget/gsorsm')
+def get_signal_one_run_smd_multi(runNum, specs, event_mask = None, event_filter = None, **kwargs):
+    """
+    Evaluate several specs (see make_spec) over the events of one run in a
+    single pass, reading each event once.
+
+    event_filter : spec
+        If provided, events for which the filter's event_data_getter returns
+        a false value are excluded from all specs.
+
+    Returns a list with one element per spec, and a last element for
+    event_filter if it is provided. Each element is a tuple (mean,
+    event_data, events_processed, pixel_stats), or None if the spec didn't
+    yield any valid events.
+    """
+    specs = map(make_spec, specs)
+    if event_filter is not None:
+        event_filter = make_spec(event_filter)
+        all_specs = specs + [event_filter]
+    else:
+        all_specs = specs
+    event_mask = eventmask.as_event_mask(event_mask)
+    if event_mask is not None:
+        run_mask = event_mask[runNum]
+    else:
+        run_mask = None
+
+    def make_accumulators(ds):
+        accs = [SpecAccumulator(spec, runNum, ds, event_mask = event_mask, **kwargs)
+            for spec in specs]
+        if event_filter is not None:
+            # the event loop reads the filter's values from its event_data
+            return accs, SpecAccumulator(event_filter, runNum, ds, store_frames = False, **kwargs)
+        return accs, None
 
-#@utils.eager_persist_to_file('cache/psget/gsorsa')
-def get_signal_one_run_smd_area(runNum, detid = None, event_data_getter = None, event_mask = None,
-        frame_processor = None, dark_frame = None, **kwargs):
     def multiprocess_func():
         """
-        Returns signalsum_final, event_data, events_processed, or None if no
-        valid data is found
-
-        signalsum_final : numpy array
-            The sum of event data (either raw or transformed by
-            frame_processor, if that function is non-None
-        event_data : list of dicts
-            list of dectionaries generated by evaluating event_data_getter on
-            each event datum. One list element per MPI rank.
-        events_processed : int
-            number of events processed
+        Returns a list of per-spec partial results (pixel_stats, event_data,
+        events_processed), merged over pool workers.
         """
-        log('using multiprocessing in get_signal_one_run_smd_area')
+        log('using multiprocessing in get_signal_one_run_smd_multi')
         pool = get_pool()
         if config.testing:
             size = 1
         else:
             size = pool.ncpus
+        ds = get_ds(runNum)
+        events = accepted_events(len(ds.runs().next().times()), run_mask = run_mask)
+        queue = workqueue.ChunkQueue(len(events), workqueue.pool_counter())
+        shared = config.multiprocess_shared_memory
+        if shared:
+            prefix = sharedmem.new_prefix()
         def mapfunc(i):
             ds = get_ds(runNum)
-            det = psana.Detector(config.detinfo_map[detid].device_name, ds.env())
+            detector_cache.reset_counters()
+            accs, filter_acc = make_accumulators(ds)
+            if shared:
+                for j, acc in enumerate(accs + filter(None, [filter_acc])):
+                    acc.slot = sharedmem.StatsSlot('%s-%d-%d' % (prefix, i, j))
             run = ds.runs().next()
             times = run.times()
             log('size: '+ str(size))
-            length = max(1, len(times)//size)
-            startevt = i *length
-            mytimes= times[startevt:(i +1)*length]
-            #log('mytimes',len(mytimes),startevt,length,i,size,len(times))
-            for nevent, t in enumerate(mytimes, start = startevt):
-                evt = run.event(t)
+            stats = workqueue.WorkerStats(i)
+            # masked events are skipped without being read
+            evtgen = ((int(events[k]), lambda t = times[events[k]]: run.event(t))
+                for k in stats.iter_events(queue))
+            prefetcher = prefetch.EventPrefetcher(evtgen,
+                _combined_fetcher(accs + filter(None, [filter_acc])), deferred = True)
+            _accumulate_events(prefetcher, ds, accs, event_filter = filter_acc)
+            prefetcher.report()
+            detector_cache.report()
+            if shared:
+                # only small descriptors are pickled
+                return [acc.shared_partial() for acc in accs + filter(None, [filter_acc])], stats
+            return [acc.partial() for acc in accs + filter(None, [filter_acc])], stats
+
+        start = time.time()
+        try:
+            if config.testing:
+                gathered = map(mapfunc, range(size))
+            else:
                 try:
-                    signalsum, event_data, events_processed = accumulator_area(ds, evt,  nevent, runNum, det,
-                            detid = detid, signalsum = signalsum, event_data = event_data,
-                            events_processed = events_processed, dark_frame = dark_frame,
-                            event_mask = event_mask, frame_processor = frame_processor, event_data_getter = event_data_getter, **kwargs)
-                except NameError:
-                    signalsum, event_data, events_processed = accumulator_area(ds, evt, nevent, runNum, det, detid = detid, 
-                            dark_frame = dark_frame, event_mask = event_mask, frame_processor = frame_processor, event_data_getter = event_data_getter, **kwargs)
-            try:
-                return signalsum, event_data, events_processed 
-            except UnboundLocalError:
-                return None
+                    gathered = pool.map(mapfunc, range(size))
+                except AssertionError, e: # Can't do nestied multiprocessing with daemonic processes
+                    log(str(e))
+                    gathered = map(mapfunc, range(1))
+            workqueue.report_utilization([elt[1] for elt in gathered], time.time() - start)
+            merged = []
+            for partials in zip(*[elt[0] for elt in gathered]):
+                if shared:
+                    pixel_stats, event_data, events_processed = sharedmem.reduce_partials(partials)
+                    merged.append((pixel_stats, [event_data], events_processed))
+                    continue
+                pixel_stats_list, event_data_list, events_processed_list = zip(*partials)
+                merged.append((accumulators.merge_all(pixel_stats_list), event_data_list,
+                    sum(events_processed_list)))
+        finally:
+            if shared:
+                sharedmem.cleanup(prefix)
+        return merged
 
-        if config.testing:
-            gathered = map(mapfunc, range(size))
-        else:
-            try:
-                gathered = pool.map(mapfunc, range(size))
-            except AssertionError, e: # Can't do nestied multiprocessing with daemonic processes
-                log(str(e))
-                gathered = map(mapfunc, range(1))
-        signalsum_list, event_data_list, events_processed_list  = zip(*filter(lambda elt: elt is not None, gathered))
-        signalsum = reduce(lambda x, y: x + y, filter(lambda d: d is not None, signalsum_list))
-        events_processed = reduce(lambda x, y: x + y, events_processed_list)
-        return signalsum, event_data_list, events_processed
     def mpi_func():
         """
-        Returns signalsum_final, event_data, events_processed, or None if no
-        valid data is found
-
-        signalsum_final : numpy array
-            The sum of event data (either raw or transformed by
-            frame_processor, if that function is non-None
-        event_data : list of dicts
-            list of dectionaries generated by evaluating event_data_getter on
-            each event datum. One list element per MPI rank.
-        events_processed : int
-            number of events processed
+        Returns a list of per-spec partial results (pixel_stats, event_data,
+        events_processed), reduced over all MPI ranks.
         """
-        log('using MPI in get_signal_one_run_smd_area')
-        from mpi4py import MPI
-        comm = MPI.COMM_WORLD
-        #DIVERTED_CODE = 162
+        log('using MPI in get_signal_one_run_smd_multi')
+        comm = get_comm()
         ds = get_ds(runNum)
-        det = psana.Detector(config.detinfo_map[detid].device_name, ds.env())
-        #evtgen = smdgen(ds)
-        evtgen = idxgen(ds)
-        #det = Detector(config.detinfo_map[detid].device_name, ds.env())
+        detector_cache.reset_counters()
+        accs, filter_acc = make_accumulators(ds)
         rank = comm.Get_rank()
+        stats = workqueue.WorkerStats(rank)
+        evtgen = idxgen(ds, stats = stats, run_mask = run_mask, deferred = True)
+        prefetcher = prefetch.EventPrefetcher(evtgen,
+            _combined_fetcher(accs + filter(None, [filter_acc])), deferred = True)
         log( "rank is", rank)
         size = comm.Get_size()
-        last = time.time()
-        last_nevent = 0
-        for nevent, evt in evtgen:
-            if config.testing and nevent % 10 != 0:
-                continue
-            try:
-                signalsum, event_data, events_processed = accumulator_area(ds, evt, nevent, runNum,
-                        det, signalsum = signalsum, detid = detid,
-                        event_data = event_data, events_processed = events_processed, dark_frame = dark_frame,
-                        event_mask = event_mask,  frame_processor = frame_processor, event_data_getter = event_data_getter, **kwargs)
-            except NameError:
-                signalsum, event_data, events_processed = accumulator_area(ds, evt, nevent, runNum, det, detid = detid,
-                        dark_frame = dark_frame, event_mask = event_mask, frame_processor = frame_processor, event_data_getter = event_data_getter, **kwargs)
-            if nevent % 100 == 0:
+        progress_state = {'last': time.time(), 'last_nevent': 0}
+        def progress(nevent):
+            if stats.nevents - progress_state['last_nevent'] >= 100:
                 now = time.time()
-                deltat = now - last
-                deltan = nevent - last_nevent
+                deltat = now - progress_state['last']
+                deltan = stats.nevents - progress_state['last_nevent']
                 log( 'processed event: ', nevent, (deltan/deltat) * size, "rank is: ", rank, "size is: ", size)
-                last = now
-                last_nevent = nevent
-        if signalsum is not None:
-            signalsum_final = np.empty_like(signalsum)
-            comm.Allreduce(signalsum, signalsum_final)
+                progress_state['last'] = now
+                progress_state['last_nevent'] = stats.nevents
+        _accumulate_events(prefetcher, ds, accs, event_filter = filter_acc, progress = progress)
+        prefetcher.report()
+        detector_cache.report()
+        workqueue.gather_utilization(comm, stats)
+        reduced = []
+        for spec, acc in zip(all_specs, accs + filter(None, [filter_acc])):
+            pixel_stats, event_data, events_processed = acc.partial()
+            # With dynamic scheduling a rank may end up without any valid
+            # events; it still takes part in the reduction with count 0.
+            pixel_stats = pixel_stats.allreduce(comm)
             events_processed = comm.allreduce(events_processed)
-            if event_data_getter:
+            if not spec.event_data_getter:
+                event_data = []
+            elif config.event_data_shards:
+                # only the shards' manifest and a view of them are communicated
+                event_data = [framestore.gather_event_data(comm, event_data)]
+            else:
                 event_data = comm.allgather(event_data)
-            log( "rank is: ", rank)
             if rank == 0:
-                log( "processed ", events_processed, "events")
-            return signalsum_final, event_data, events_processed
+                log( "processed ", events_processed, "events for detector ", spec.detid)
+            reduced.append((pixel_stats, event_data, events_processed))
+        return reduced
 
     if config.multiprocess:
-        result = multiprocess_func()
+        partials = multiprocess_func()
     else:
-        result = mpi_func()
-
-    if result is not None:
-        signalsum_final, event_data, events_processed = result
-        signalsum_final /= events_processed
+        partials = mpi_func()
+
+    results = []
+    for spec, (pixel_stats, event_data, events_processed) in zip(all_specs, partials):
+        if events_processed == 0:
+            results.append(None)
+            continue
+        if defers_dark_subtraction(spec):
+            pixel_stats = pixel_stats.shift(spec.dark_frame)
         if event_data:
-            #print event_data
-            #event_data = reduce(lambda x, y: x + y, event_data)
-            log( 'before merge')
-            #log( event_data)
-            event_data = utils.merge_dicts(*event_data)
-        return signalsum_final, event_data, events_processed
-    else:
-        raise ValueError("No events found for det: " + str(detid) + ", run: " + str(runNum) + ": " + str(events_processed))
+            event_data = eventdata.concatenate(event_data)
+        else:
+            event_data = eventdata.EventData()
+        results.append((pixel_stats.mean, event_data, events_processed, pixel_stats))
+    return results
+
+#@utils.eager_persist_to_file('cache/psget/gsorsa')
+def get_signal_one_run_smd_area(runNum, detid = None, event_data_getter = None, event_mask = None,
+        frame_processor = None, dark_frame = None, **kwargs):
+    """
+    Returns mean, event_data, events_processed, pixel_stats for a single
+    area detector.
+    """
+    result, = get_signal_one_run_smd_multi(runNum,
+        [EvalSpec(detid, event_data_getter, frame_processor, dark_frame)],
+        event_mask = event_mask, **kwargs)
+    if result is None:
+        raise ValueError("No events found for det: " + str(detid) + ", run: " + str(runNum))
+    return result
 
 
 def check_autompi():
@@ -638,21 +1139,52 @@ def get_signal_one_run_smd(runNum, detid = None, event_data_getter = None, event
 
 
 #@memory.cache
-@utils.eager_persist_to_file('cache/psget/gsmp')
+@cache.persist_to_file('psget/gsmp')
 def get_signal_many_parallel(runList, detid = None, event_data_getter = None,
     event_mask = None, **kwargs):
     """
     Parallel version of get_signal_many
     """
+    event_mask = eventmask.as_event_mask(event_mask)
     def mapfunc(run_number):
         return get_signal_one_run(run_number, detid, event_data_getter =
             event_data_getter, event_mask = event_mask, **kwargs)
     # TODO move the .get()u up one level on the stack
-    def mapfunc_smd(run_number):
+    def partial_key(run_number):
+        spec_kwargs = dict(kwargs)
+        spec = EvalSpec(detid, event_data_getter, spec_kwargs.pop('frame_processor', None),
+            spec_kwargs.pop('dark_frame', None))
+        if detid in config.nonarea:
+            kind = 'nonarea_positional'
+        else:
+            kind = 'events'
+        return partials.partial_key(run_number, spec, run_event_mask(event_mask, run_number),
+            kind = kind, **spec_kwargs)
+    def evaluate_smd(run_number):
         log('calling get_signal_one_run_smd')
         return get_signal_one_run_smd(run_number, detid, event_data_getter =
             event_data_getter, event_mask = event_mask, **kwargs)
+    def mapfunc_smd(run_number):
+        key = partial_key(run_number)
+        result = partials.load(key)
+        if result is not None:
+            log('using stored partial result for run %d' % run_number)
+            return result
+        result = evaluate_smd(run_number)
+        partials.store(key, result)
+        return result
 
+    if config.smd and config.concurrent_runs > 1 and not config.multiprocess:
+        keys = map(partial_key, runList)
+        run_data = map(partials.load, keys)
+        pending = [i for i, result in enumerate(run_data) if result is None]
+        computed = evaluate_runs_concurrently([runList[i] for i in pending], evaluate_smd,
+            event_mask = event_mask)
+        for i, result in zip(pending, computed):
+            run_data[i] = result
+            partials.store(keys[i], result)
+        log('returning from get_signal_many_parallel')
+        return combine_run_results(runList, run_data)
     if config.smd:
         # Iterate through runs. Bad runs are excluded from the returned
         # data, unless all runs are bad, in which case a ValueError is
@@ -684,18 +1216,192 @@ def get_signal_many_parallel(runList, detid = None, event_data_getter = None,
         pool = get_pool()
         run_data = pool.map(mapfunc, runList)
         #run_data = map(mapfunc, runList)
-    event_data = {}
-    runindx = 0
-    total_events = np.sum(map(lambda x: x[2], run_data))
-    for signal_increment, event_data_entry, events_processed in run_data:
-        try:
-            signal += signal_increment * (float(events_processed) / total_events)
-        except UnboundLocalError:
-            signal = signal_increment * (float(events_processed) / total_events)
-        event_data[runList[runindx]] = event_data_entry
-        runindx += 1
     log('returning from get_signal_many_parallel')
-    return DataResult(signal, event_data)
+    return combine_run_results(runList, run_data)
     #return signal, event_data
 
+def run_cost(runNum, event_mask = None):
+    """
+    Return the estimated cost of evaluating run runNum: the number of
+    events that will be read.
+    """
+    nevents = len(get_ds(runNum).runs().next().times())
+    if event_mask is None:
+        return nevents
+    return len(accepted_events(nevents, run_mask = event_mask[runNum]))
+
+class RunFailure(object):
+    """
+    Exception raised by the evaluation of a run, as passed between ranks.
+    """
+    def __init__(self, run, exc_info):
+        self.run = run
+        exc = exc_info[1]
+        try:
+            pickle.dumps(exc, 2)
+        except Exception:
+            exc = RuntimeError('%s: %s' % (exc_info[0].__name__, str(exc)))
+        self.exc = exc
+        self.traceback = ''.join(traceback.format_exception(*exc_info))
+
+    def reraise(self):
+        log('evaluation of run %s failed:\n%s' % (str(self.run), self.traceback))
+        raise self.exc
+
+def evaluate_runs_concurrently(runList, evaluate, event_mask = None):
+    """
+    Return [evaluate(run) for run in runList], on all ranks, processing
+    config.concurrent_runs runs at the same time.
+
+    The ranks of COMM_WORLD are split into config.concurrent_runs groups,
+    each with its own communicator (see get_comm), and the runs are
+    assigned to groups by their estimated costs (see run_cost) so that all
+    groups finish at about the same time. The costs are estimated in
+    parallel, each rank handling a share of the runs. Each group evaluates
+    its runs one after the other, distributing each run's events over its
+    ranks.
+
+    If evaluate raises for a run, the exception is re-raised on all ranks
+    once all groups are done.
+    """
+    from mpi4py import MPI
+    world = MPI.COMM_WORLD
+    rank = world.Get_rank()
+    ngroups = max(1, min(config.concurrent_runs, len(runList), world.Get_size()))
+    # each rank opens the DataSources of every size-th run only
+    size = world.Get_size()
+    local_costs = {i: run_cost(runList[i], event_mask = event_mask)
+        for i in range(rank, len(runList), size)}
+    costs = [None] * len(runList)
+    for rank_costs in world.allgather(local_costs):
+        for i, cost in rank_costs.iteritems():
+            costs[i] = cost
+    assignment = workqueue.assign_runs(costs, ngroups)
+    color = rank % ngroups
+    if rank == 0:
+        for group, indices in enumerate(assignment):
+            log('rank group %d: runs %s, estimated %d events' % (group,
+                str([runList[i] for i in indices]), sum(costs[i] for i in indices)))
+    comm = world.Split(color, rank)
+    results = {}
+    try:
+        with run_communicator(comm):
+            for i in assignment[color]:
+                try:
+                    results[i] = evaluate(runList[i])
+                except Exception:
+                    # passed on so that the other groups don't wait forever
+                    results[i] = RunFailure(runList[i], sys.exc_info())
+    finally:
+        comm.Free()
+    # every rank of a group holds the group's results; its root, which is
+    # world rank group (Split is keyed by world rank), sends them
+    gathered = {}
+    for group in range(ngroups):
+        gathered.update(workqueue.bcast_arrays(world, results if rank == group else None,
+            root = group))
+    ordered = [gathered[i] for i in range(len(runList))]
+    for result in ordered:
+        if isinstance(result, RunFailure):
+            result.reraise()
+    return ordered
+
+def run_event_mask(event_mask, runNum):
+    """
+    Return the restriction of event_mask (an EventMask) to run runNum, or
+    None if event_mask is None.
+    """
+    if event_mask is None:
+        return None
+    return eventmask.EventMask({runNum: event_mask.bits(runNum)})
+
+def _run_multi_partials(runNum, specs, event_mask = None, event_filter = None, **kwargs):
+    """
+    Return get_signal_one_run_smd_multi's results for one run, reusing
+    stored partial results and evaluating (in a single pass) only the specs
+    for which none are stored.
+    """
+    run_mask = run_event_mask(event_mask, runNum)
+    keys = [partials.partial_key(runNum, spec, run_mask, event_filter = event_filter, **kwargs)
+        for spec in specs]
+    if event_filter is not None:
+        # the filter itself is evaluated over all events
+        keys.append(partials.partial_key(runNum, event_filter, run_mask, **kwargs))
+    stored = map(partials.load, keys)
+    missing = [i for i in range(len(specs)) if stored[i] is None]
+    if missing:
+        results = get_signal_one_run_smd_multi(runNum, [specs[i] for i in missing],
+            event_mask = event_mask, event_filter = event_filter, **kwargs)
+        filter_result = results[len(missing):]
+        for i, result in zip(missing, results):
+            stored[i] = result
+            partials.store(keys[i], partials.NO_EVENTS if result is None else result)
+        if event_filter is not None and stored[-1] is None:
+            stored[-1], = filter_result
+            partials.store(keys[-1], partials.NO_EVENTS if stored[-1] is None else stored[-1])
+    elif event_filter is not None and stored[-1] is None:
+        stored[-1], = get_signal_one_run_smd_multi(runNum, [event_filter],
+            event_mask = event_mask, **kwargs)
+        partials.store(keys[-1], partials.NO_EVENTS if stored[-1] is None else stored[-1])
+    else:
+        log('using stored partial results for run %d' % runNum)
+    return [None if result == partials.NO_EVENTS else result for result in stored]
 
+def combine_run_results(runList, run_data):
+    """
+    Combine per-run results (tuples of the form (mean, event_data,
+    events_processed[, pixel_stats])) into a DataResult, weighting each
+    run's mean by its number of events.
+    """
+    with_stats = all(len(entry) > 3 for entry in run_data)
+    def run_result(run, entry):
+        signal, event_data_entry, events_processed = entry[:3]
+        if not isinstance(event_data_entry, eventdata.EventData):
+            event_data_entry = eventdata.EventData.from_dict({run: event_data_entry})
+        if with_stats:
+            pixel_stats = entry[3]
+        else:
+            pixel_stats = None
+        return DataResult(signal, event_data_entry, pixel_stats = pixel_stats,
+            count = events_processed)
+    results = [run_result(run, entry) for run, entry in zip(runList, run_data)]
+    return reduce(operator.add, results)
+
+@cache.persist_to_file('psget/gsmm')
+def get_signal_many_multi(runList, specs, event_mask = None, event_filter = None, **kwargs):
+    """
+    Evaluate several specs (see make_spec) over the runs in runList, reading
+    each event once regardless of the number of specs. Requires config.smd.
+
+    Per-run partial results are stored (see partials.py) and the dataset's
+    result is composed from them by count-weighted merging, so runs that
+    have already been evaluated with the same spec aren't read again.
+
+    Returns a list of DataResult instances, one per spec, followed by one for
+    event_filter if it is provided.
+    """
+    if not config.smd:
+        raise ValueError("get_signal_many_multi requires config.smd == True")
+    specs = map(make_spec, specs)
+    if event_filter is not None:
+        event_filter = make_spec(event_filter)
+        all_specs = specs + [event_filter]
+    else:
+        all_specs = specs
+    event_mask = eventmask.as_event_mask(event_mask)
+    run_results = [[] for _ in all_specs]
+    for run in runList:
+        # only specs without stored per-run partial results are evaluated
+        results = _run_multi_partials(run, specs, event_mask = event_mask,
+            event_filter = event_filter, **kwargs)
+        for spec_results, result in zip(run_results, results):
+            if result is not None:
+                spec_results.append((run, result))
+    data_results = []
+    for spec, spec_results in zip(all_specs, run_results):
+        if not spec_results:
+            raise ValueError("No events found for det: %s, runs: %s" % (spec.detid, str(runList)))
+        runs, data = zip(*spec_results)
+        data_results.append(combine_run_results(runs, data))
+    log('returning from get_signal_many_multi')
+    return data_results
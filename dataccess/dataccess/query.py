@@ -9,6 +9,8 @@ import numpy as np
 import matplotlib.pyplot as plt
 import logbook
 import utils
+import cache
+import fingerprint
 import summarymetrics
 import data_access
 import database
@@ -152,7 +154,7 @@ class DataSet(object):
                     try:
                         filter_identifier = '-'.join(event_filter.params)
                     except:
-                        filter_identifier = database.hash(utils.random_float())
+                        filter_identifier = fingerprint.fingerprint(event_filter)
                     try:
                         filter_label =\
                             event_filter.label
@@ -228,7 +230,7 @@ class DataSet(object):
         log( "Storing DataSet. Runs: %s" % str(self.runs))
         database.mongo_store_object_by_label(self, self.label)
 
-    @utils.eager_persist_to_file('cache/query/DataSet.evaluate')
+    @cache.persist_to_file('query/DataSet.evaluate')
     def evaluate(self, detid, event_data_getter = None, frame_processor = None,
             darksub = True, event_mask = None):
     #def evaluate(self, detid, event_data_getter = None, insert = True):
@@ -302,7 +304,7 @@ class DataSet(object):
 
     def __eq__(self, other):
         return self.runs == other.runs and\
-                utils.hash_obj(self.event_filter) == utils.hash_obj(other.event_filter) and\
+                fingerprint.fingerprint(self.event_filter) == fingerprint.fingerprint(other.event_filter) and\
                 self.event_filter_detid == other.event_filter_detid
 
     def __ne__(self, other):
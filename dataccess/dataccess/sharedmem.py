@@ -0,0 +1,172 @@
+"""
+Shared-memory transport of partial results between pool workers and the
+parent process.
+
+In multiprocess mode, each pool worker accumulates per-pixel statistics for
+every spec it evaluates. Returning those frame-sized arrays (and the event
+data) from the workers means pickling them, sending them through a pipe and
+unpickling them in the parent. Instead, each worker's statistics live in a
+slot: a file-backed memory map in config.shared_memory_dir (normally the
+/dev/shm tmpfs) that PixelStats.add updates in place. Event data columns are
+written to .npy files next to it (except for lazy columns of frames kept on
+disk by framestore, which are passed as is). Workers return only small
+SharedPartial descriptors, and the parent maps the slots and reduces them in
+place.
+"""
+
+import glob
+import os
+import tempfile
+import uuid
+
+import numpy as np
+
+import config
+import accumulators
+import eventdata
+
+# PixelStats arrays stored in a slot, in order along the slot's first axis
+# (only the mean for mean-only statistics)
+FIELDS = ('mean', 'm2', 'min', 'max')
+
+def shared_dir():
+    """
+    Return the directory holding shared-memory files: config.shared_memory_dir
+    if it exists, the default temporary directory otherwise.
+    """
+    path = config.shared_memory_dir
+    if not os.path.isdir(path):
+        path = tempfile.gettempdir()
+    return path
+
+def new_prefix():
+    """
+    Return a unique path prefix for the files of one reduction.
+    """
+    return os.path.join(shared_dir(), 'dataccess-%d-%s' % (os.getpid(), uuid.uuid4().hex))
+
+def cleanup(prefix):
+    """
+    Remove all files created under prefix.
+    """
+    for path in glob.glob(prefix + '*'):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def _open_slot(path):
+    return np.lib.format.open_memmap(path, mode = 'r+')
+
+class StatsSlot(object):
+    """
+    Shared-memory slot holding one worker's PixelStats arrays.
+
+    The frame shape isn't known until the first frame has been accumulated,
+    so the slot is created by track() once pixel_stats is non-empty; from
+    then on pixel_stats' arrays are views into the slot.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.buf = None
+
+    def track(self, pixel_stats):
+        # reduced-precision accumulators are copied in once finalized
+        if not isinstance(pixel_stats, accumulators.PixelStats):
+            return
+        if self.buf is not None or pixel_stats.count == 0:
+            return
+        fields = FIELDS if pixel_stats.has_moments() else FIELDS[:1]
+        shape = (len(fields),) + np.shape(pixel_stats.mean)
+        self.buf = np.lib.format.open_memmap(self.path, mode = 'w+',
+            dtype = 'float64', shape = shape)
+        for i, name in enumerate(fields):
+            self.buf[i] = getattr(pixel_stats, name)
+            setattr(pixel_stats, name, self.buf[i])
+
+class SharedPartial(object):
+    """
+    Descriptor of a worker's partial result for one spec, returned to the
+    parent in place of the arrays themselves.
+    """
+    def __init__(self, stats_path, count, event_data_prefix, events_processed,
+            lazy_data = None):
+        self.stats_path = stats_path
+        self.count = count
+        self.event_data_prefix = event_data_prefix
+        self.events_processed = events_processed
+        self.lazy_data = lazy_data
+
+    def pixel_stats(self):
+        """
+        Return the worker's PixelStats, with arrays mapped from its slot.
+        """
+        if self.count == 0:
+            return accumulators.PixelStats()
+        buf = _open_slot(self.stats_path)
+        return accumulators.PixelStats(self.count, *[buf[i] for i in range(len(buf))])
+
+    def event_data(self):
+        if self.event_data_prefix is None:
+            return eventdata.EventData()
+        if self.lazy_data is not None:
+            data = self.lazy_data
+        else:
+            data = _load_column(self.event_data_prefix, 'data')
+        return eventdata.EventData(_load_column(self.event_data_prefix, 'runs'),
+            _load_column(self.event_data_prefix, 'events'), data)
+
+def _column_path(prefix, name):
+    return '%s.%s.npy' % (prefix, name)
+
+def _load_column(prefix, name):
+    path = _column_path(prefix, name)
+    try:
+        return np.load(path, mmap_mode = 'r')
+    except ValueError: # object arrays can't be mapped
+        return np.load(path, allow_pickle = True)
+
+def export_partial(slot, pixel_stats, event_data, events_processed):
+    """
+    Called in a worker: write event_data's columns to shared memory and
+    return a SharedPartial describing the worker's result. pixel_stats'
+    arrays must already be in slot (see StatsSlot.track).
+    """
+    slot.track(pixel_stats)
+    if slot.buf is not None:
+        slot.buf.flush()
+    lazy_data = None
+    if event_data.nevents():
+        event_data_prefix = slot.path + '.events'
+        names = ['runs', 'events']
+        if eventdata._is_lazy(event_data.data):
+            lazy_data = event_data.data
+        else:
+            names.append('data')
+        for name in names:
+            np.save(_column_path(event_data_prefix, name), getattr(event_data, name))
+    else:
+        event_data_prefix = None
+    return SharedPartial(slot.path, pixel_stats.count, event_data_prefix, events_processed,
+        lazy_data = lazy_data)
+
+def reduce_partials(shared_partials):
+    """
+    Called in the parent: combine the workers' SharedPartial instances for
+    one spec. The per-pixel statistics are merged in place into a copy of
+    the first non-empty slot.
+
+    Returns pixel_stats, event_data, events_processed.
+    """
+    total = accumulators.PixelStats()
+    for partial in shared_partials:
+        total = total.merge_in_place(partial.pixel_stats())
+    event_data = eventdata.concatenate([partial.event_data() for partial in shared_partials])
+    # detach the results from the files, which are removed by cleanup()
+    data = event_data.data
+    if not eventdata._is_lazy(data):
+        data = np.array(data)
+    event_data = eventdata.EventData(np.array(event_data.runs), np.array(event_data.events),
+        data)
+    return (total, event_data,
+        sum(partial.events_processed for partial in shared_partials))
@@ -5,6 +5,8 @@ import pdb
 
 import utils
 import query
+import data_access
+import eventmask
 
 import playback
 from output import log
@@ -103,6 +105,13 @@ class ScatterData(object):
         lst = [self.row1, self.row2]
         return lst[k]
 
+    def _joined(self):
+        """
+        Return the event data of the two data results, restricted to their
+        common events and aligned by (run, event).
+        """
+        return self.data_result1.event_data.join(self.data_result2.event_data)
+
     def make_mask_dictionary_from_filter(self, filter_func):
         """
         Return an event mask of a format that can be fed back as the
@@ -111,41 +120,42 @@ class ScatterData(object):
         filter_func must be a function of two arguments. It will be evaluated
         for all value pairs in self.data_result1 and self.data_result2.
         """
-        mask = {}
-        event_data_dict = self.data_result1.event_data
-        for run in event_data_dict:
-            run_mask = {}
-            for nevent in event_data_dict[run]:
-                a, b = event_data_dict[run][nevent], self.data_result2.event_data[run][nevent]
-                run_mask[nevent] = filter_func(a, b)
-            mask[run] = run_mask
-        return mask
+        ed1, ed2 = self._joined()
+        included = np.array([bool(filter_func(a, b)) for a, b in zip(ed1.data, ed2.data)], dtype = bool)
+        return self._event_mask(ed1, included)
 
     def make_mask_dictionary_from_mask_array(self, arr_mask):
-        dict_mask = {}
-        for i, (run, nevent, a, b) in enumerate(self.iter_event_value_pairs()):
-            if i in arr_mask:
-                dict_mask.setdefault(run, {})[nevent] = True
-            else:
-                dict_mask.setdefault(run, {})[nevent] = False
-        return dict_mask
+        ed1, _ = self._joined()
+        return self._event_mask(ed1, np.in1d(np.arange(ed1.nevents()), arr_mask))
+
+    @staticmethod
+    def _event_mask(ed, included):
+        """
+        Return an EventMask including the events of ed for which included is
+        True.
+        """
+        runs = np.unique(ed.runs)
+        return eventmask.EventMask.from_events(runs,
+            [ed.events[(ed.runs == run) & included] for run in runs],
+            ed.events.max() + 1 if ed.nevents() else 0)
 
     # TODO docstring
     def iter_event_value_pairs(self):
-        event_data_dict = self.data_result1.event_data
-        for run in event_data_dict:
-            for nevent in event_data_dict[run]:
-                a, b = event_data_dict[run][nevent], self.data_result2.event_data[run][nevent]
-                yield run, nevent, a, b
+        ed1, ed2 = self._joined()
+        return zip(ed1.runs.tolist(), ed1.events.tolist(), ed1.data, ed2.data)
 
     def apply_mask_dictionary(self, event_mask):
-        row1 = []
-        row2 = []
-        for run, nevent, a, b in self.iter_event_value_pairs():
-            if event_mask[run][nevent]:
-                row1.append(a)
-                row2.append(b)
-        return np.array(row1), np.array(row2)
+        ed1, ed2 = self._joined()
+        event_mask = eventmask.as_event_mask(event_mask)
+        selected = np.zeros(ed1.nevents(), dtype = bool)
+        for run in np.unique(ed1.runs):
+            in_run = ed1.runs == run
+            bits = event_mask[run].bits
+            events = ed1.events[in_run]
+            if np.any(events >= len(bits)):
+                raise KeyError("event mask does not cover all events of run %d" % run)
+            selected[in_run] = bits[events]
+        return ed1.data[selected], ed2.data[selected]
 
 
 def scatter(dataset_identifier, detid_function_1, detid_function_2, normalize = False,
@@ -172,10 +182,6 @@ def scatter(dataset_identifier, detid_function_1, detid_function_2, normalize =
     detid2, eventgetter2 = detid_function_2
     dataset = get_DataSet_instance(dataset_identifier)
 
-    def get_datarun(event_data_getter, detid):
-        return dataset.evaluate(detid, event_data_getter = event_data_getter,
-                frame_processor = frame_processor)
-
     def make_label(event_data_getter, detid):
         return "Function: %s; detector: %s" % (event_data_getter.__name__, detid)
 
@@ -195,8 +201,9 @@ def scatter(dataset_identifier, detid_function_1, detid_function_2, normalize =
             return get_normalized(raw)
         return raw
 
-    data1, data2 = delete_mismatching(
-            *map(get_datarun, [eventgetter1, eventgetter2], [detid1, detid2]))
+    # both functions are evaluated in a single pass over the dataset
+    data1, data2 = delete_mismatching(*data_access.eval_dataset_and_filter_multi(dataset,
+            [(detid1, eventgetter1, frame_processor), (detid2, eventgetter2, frame_processor)]))
     scatter_data = ScatterData(data1, data2)
     xlabel, ylabel = map(make_label, [eventgetter1, eventgetter2], [detid1, detid2])
     if plot:
@@ -0,0 +1,309 @@
+"""
+Dynamic distribution of events among MPI ranks and multiprocessing workers.
+
+Instead of statically slicing a run's event timestamps into one block per
+worker, the event index range is split into chunks of config.event_chunk_size
+events. Workers fetch chunks on demand by atomically incrementing a shared
+counter, so fast workers keep pulling work while slow ones (e.g. those hit by
+expensive frame processors) finish their current chunk. Every event index is
+handed out exactly once.
+
+Also provides the MPI communicator on which the current run is evaluated
+(see get_comm) and a broadcast that sends large arrays as buffers
+(bcast_arrays).
+"""
+
+import os
+import time
+import pickle
+from contextlib import contextmanager
+from cStringIO import StringIO
+import numpy as np
+
+import config
+from output import log
+
+def chunk_bounds(nitems, chunksize, k):
+    """
+    Return the (start, stop) index range of the k'th chunk, or None if k
+    lies past the end of the range [0, nitems).
+    """
+    start = k * chunksize
+    if start >= nitems:
+        return None
+    return start, min(start + chunksize, nitems)
+
+class LocalCounter(object):
+    """
+    Counter for a single worker (e.g. serial execution in testing mode).
+    """
+    def __init__(self):
+        self.value = 0
+
+    def fetch_and_increment(self):
+        value = self.value
+        self.value += 1
+        return value
+
+    def free(self):
+        pass
+
+class ManagerCounter(object):
+    """
+    Counter shared among multiprocessing pool workers.
+
+    The counter and its lock are proxies to objects living in a
+    multiprocess.Manager server process, so instances of this class can be
+    pickled into the closures that are sent to the pool.
+    """
+    def __init__(self, manager):
+        # Keep a reference to the manager: its server process shuts down
+        # when the manager is garbage collected.
+        self.manager = manager
+        self.value = manager.Value('i', 0)
+        self.lock = manager.Lock()
+
+    def __getstate__(self):
+        return {'manager': None, 'value': self.value, 'lock': self.lock}
+
+    def fetch_and_increment(self):
+        with self.lock:
+            value = self.value.value
+            self.value.value = value + 1
+        return value
+
+    def free(self):
+        pass
+
+class MPICounter(object):
+    """
+    Counter shared among the ranks of an MPI communicator.
+
+    The counter is stored in a one-sided communication window exposed by
+    rank 0 and incremented with MPI_Fetch_and_op, so no rank has to service
+    requests on behalf of the others. Construction and free() are
+    collective over comm.
+    """
+    def __init__(self, comm):
+        from mpi4py import MPI
+        self.comm = comm
+        if comm.Get_rank() == 0:
+            self._buf = np.zeros(1, dtype = 'l')
+            self.win = MPI.Win.Create(self._buf, comm = comm)
+        else:
+            self._buf = None
+            self.win = MPI.Win.Create(None, comm = comm)
+        comm.Barrier()
+
+    def fetch_and_increment(self):
+        from mpi4py import MPI
+        one = np.ones(1, dtype = 'l')
+        value = np.zeros(1, dtype = 'l')
+        self.win.Lock(0, MPI.LOCK_SHARED)
+        self.win.Fetch_and_op(one, value, 0, 0, MPI.SUM)
+        self.win.Unlock(0)
+        return int(value[0])
+
+    def free(self):
+        self.comm.Barrier()
+        self.win.Free()
+
+class ChunkQueue(object):
+    """
+    Hands out (start, stop) event index ranges covering [0, nitems) from a
+    shared counter. Iterating over an instance yields chunks until the range
+    is exhausted.
+    """
+    def __init__(self, nitems, counter, chunksize = None):
+        if chunksize is None:
+            chunksize = config.event_chunk_size
+        self.nitems = nitems
+        self.chunksize = max(1, int(chunksize))
+        self.counter = counter
+
+    def next_chunk(self):
+        return chunk_bounds(self.nitems, self.chunksize,
+            self.counter.fetch_and_increment())
+
+    def __iter__(self):
+        while True:
+            chunk = self.next_chunk()
+            if chunk is None:
+                return
+            yield chunk
+
+    def free(self):
+        self.counter.free()
+
+# pid -> multiprocess.Manager, shared by the counters of all pool maps
+_managers = {}
+
+def get_manager():
+    """
+    Return this process's multiprocess.Manager, starting its server process
+    on the first call.
+    """
+    pid = os.getpid()
+    if pid not in _managers:
+        from multiprocess import Manager
+        _managers[pid] = Manager()
+    return _managers[pid]
+
+def pool_counter():
+    """
+    Return a counter shareable among pool workers, or a LocalCounter if this
+    process is not allowed to spawn a manager (e.g. inside a daemonic pool
+    worker, in which case the work is done serially anyway). Counters are
+    created in a single manager, which is started once and reused.
+    """
+    if config.testing:
+        return LocalCounter()
+    try:
+        return ManagerCounter(get_manager())
+    except AssertionError, e:
+        log(str(e))
+        return LocalCounter()
+
+class WorkerStats(object):
+    """
+    Bookkeeping of the time a single worker spends processing chunks.
+    """
+    def __init__(self, worker):
+        self.worker = worker
+        self.nevents = 0
+        self.nchunks = 0
+        self.busy = 0.
+        self.start = time.time()
+        self._chunk_start = None
+
+    def begin_chunk(self):
+        self._chunk_start = time.time()
+
+    def end_chunk(self, nevents):
+        self.busy += time.time() - self._chunk_start
+        self.nevents += nevents
+        self.nchunks += 1
+
+    def iter_events(self, queue):
+        """
+        Iterate through event indices from queue, timing each chunk.
+        """
+        for start, stop in queue:
+            self.begin_chunk()
+            for nevent in xrange(start, stop):
+                yield nevent
+            self.end_chunk(stop - start)
+
+def gather_utilization(comm, stats):
+    """
+    Collective over comm: gather the WorkerStats of all ranks and log their
+    utilization on rank 0. The elapsed time is that of the slowest rank.
+    """
+    from mpi4py import MPI
+    elapsed = comm.allreduce(time.time() - stats.start, op = MPI.MAX)
+    stats_list = comm.gather(stats, root = 0)
+    if comm.Get_rank() == 0:
+        return report_utilization(stats_list, elapsed)
+
+def report_utilization(stats_list, elapsed):
+    """
+    Log the number of events and chunks processed by each worker, along with
+    its utilization (fraction of the elapsed wall time spent processing
+    events). Returns a dict mapping worker id to utilization.
+    """
+    utilization = {}
+    for stats in sorted(stats_list, key = lambda s: s.worker):
+        if elapsed > 0:
+            utilization[stats.worker] = stats.busy / elapsed
+        else:
+            utilization[stats.worker] = 0.
+        log('worker %s: %d events in %d chunks, utilization %.2f' %
+            (stats.worker, stats.nevents, stats.nchunks, utilization[stats.worker]))
+    return utilization
+
+def assign_runs(costs, ngroups):
+    """
+    Assign runs with the given (estimated) costs to ngroups groups of
+    workers that process their runs one after another, so as to balance the
+    groups' total costs: runs are taken in order of decreasing cost and each
+    is given to the group with the lowest total so far.
+
+    Returns a list of ngroups lists of run indices, each sorted.
+    """
+    loads = [0.] * ngroups
+    groups = [[] for _ in range(ngroups)]
+    for i in sorted(range(len(costs)), key = lambda i: -costs[i]):
+        group = loads.index(min(loads))
+        groups[group].append(i)
+        loads[group] += costs[i]
+    return [sorted(group) for group in groups]
+
+_run_comm = [None]
+
+def get_comm():
+    """
+    Return the MPI communicator whose ranks share the work of evaluating the
+    current run.
+    """
+    if _run_comm[0] is None:
+        from mpi4py import MPI
+        return MPI.COMM_WORLD
+    return _run_comm[0]
+
+@contextmanager
+def run_communicator(comm):
+    """
+    Context manager within which runs are evaluated over the ranks of comm.
+    """
+    previous = _run_comm[0]
+    _run_comm[0] = comm
+    try:
+        yield comm
+    finally:
+        _run_comm[0] = previous
+
+# ndarrays of at least this many bytes are sent by bcast_arrays as buffers
+BCAST_MIN_BYTES = 1 << 16
+# Maximum number of bytes per Bcast call (MPI counts are 32-bit ints)
+BCAST_CHUNK_BYTES = 1 << 30
+
+def bcast_arrays(comm, obj, root = 0):
+    """
+    Collective over comm: like comm.bcast(obj, root = root), but large
+    ndarrays in obj (e.g. means, PixelStats arrays and stacked event data)
+    are sent with buffer-based Bcast calls, in chunks of at most
+    BCAST_CHUNK_BYTES bytes, instead of being pickled. Only the rest of obj
+    is pickled.
+    """
+    is_root = comm.Get_rank() == root
+    arrays = []
+    if is_root:
+        buf = StringIO()
+        pickler = pickle.Pickler(buf, 2)
+        # id -> index into arrays, so that shared arrays are sent once
+        index = {}
+        def persistent_id(o):
+            if (not isinstance(o, np.ndarray) or o.dtype.hasobject
+                    or o.nbytes < BCAST_MIN_BYTES):
+                return None
+            if id(o) not in index:
+                index[id(o)] = len(arrays)
+                arrays.append(np.ascontiguousarray(o))
+            return str(index[id(o)])
+        pickler.persistent_id = persistent_id
+        pickler.dump(obj)
+        header = (buf.getvalue(), [(arr.shape, arr.dtype.str) for arr in arrays])
+    else:
+        header = None
+    payload, layouts = comm.bcast(header, root = root)
+    if not is_root:
+        arrays = [np.empty(shape, dtype = dtype) for shape, dtype in layouts]
+    for arr in arrays:
+        flat = arr.reshape(-1).view('uint8')
+        for start in xrange(0, len(flat), BCAST_CHUNK_BYTES):
+            comm.Bcast(flat[start:start + BCAST_CHUNK_BYTES], root = root)
+    if is_root:
+        return obj
+    unpickler = pickle.Unpickler(StringIO(payload))
+    unpickler.persistent_load = lambda pid: arrays[int(pid)]
+    return unpickler.load()
@@ -90,7 +90,8 @@ def mean_from_label(detid, transpose = False):
     """
     def data_getter(label):
         arr = data.eval_dataset_and_filter(label, detid)[0]
-        arr = arr.astype('float64')
+        # no copy if the (possibly memory-mapped) cached mean is float64
+        arr = np.asarray(arr, dtype = 'float64')
         if transpose:
             return arr.T
         else:
@@ -163,12 +163,17 @@ class XRDset:
     Represents data on a single detector.
     """
     def __init__(self, dataref, detid, compound_list, model = None, mask = True,
-            label = '', event_mask = None, **kwargs):
+            label = '', event_mask = None, data_result = None, **kwargs):
         """
         kwargs are frame-processing related arguments, including
         event_data_getter and frame_processor. See data_access.py for details.
+
+        data_result : psget.DataResult
+            Already-evaluated data for dataref and detid (e.g. from a
+            multi-detector pass), used instead of evaluating dataref.
         """
         self.dataref = dataref
+        self.data_result = data_result
         self.detid = detid
         self.compound_list = compound_list
         self.mask = mask
@@ -188,6 +193,9 @@ class XRDset:
         if type(self.dataref) == np.ndarray:
             imarray, event_data =  self.dataref, None
 
+        elif self.data_result is not None:
+            imarray, event_data = self.data_result
+
         else:# Assume this is a query.DataSet instance
             imarray, event_data = data.eval_dataset_and_filter(self.dataref, self.detid,
                 event_mask = self.event_mask, **self.kwargs)
@@ -197,7 +205,9 @@ class XRDset:
             base_mask = (imarray != 0.)
             extra_masks = config.detinfo_map[self.detid].extra_masks
             combined_mask = utils.combine_masks(base_mask, extra_masks, transpose = True)
-            imarray *= combined_mask
+            # not in place: imarray may be the caller's array or a cached,
+            # memory-mapped result
+            imarray = imarray * combined_mask
         return imarray
 
 class RealMask:
@@ -578,6 +588,22 @@ class Pattern:
         xrdset = XRDset(dataset, detid, compound_list, label = label)
         return Pattern.from_xrdset(xrdset, label = label, dataset = dataset, **kwargs)
 
+    @classmethod
+    def from_stack(cls, frames, detid, compound_list, nbins = 1000,
+            pre_integration_smoothing = 0, chunksize = 64, **kwargs):
+        """
+        Instantiate one Pattern per frame from an (N, H, W) stack of 2d data
+        arrays (or an iterable of 2d data arrays), integrating the frames in
+        batches (see geometry.process_stack).
+
+        kwargs are passed to Pattern.__init__().
+        """
+        angles, intensities = geometry.process_stack(detid, frames, nbins = nbins,
+                pre_integration_smoothing = pre_integration_smoothing,
+                chunksize = chunksize)
+        return [cls(angles, pattern, compound_list, nbins = nbins, **kwargs)
+                for pattern in intensities]
+
     @classmethod
     def from_event_patterns(cls, dataset, frame_processor, peak_width = config.peak_width,
              **kwargs):
@@ -873,13 +899,21 @@ class XRD:
             event_masks = [None] * len(data_identifiers)
 
         def pattern_one_dataref(dataref, event_mask = None):
-            def one_detid(detid):
+            if type(dataref) != np.ndarray and len(detid_list) > 1:
+                # read each event once for all detectors
+                from dataccess import data_access as data
+                data_results = data.eval_dataset_and_filter_multi(dataref,
+                    [(detid, event_data_getter, frame_processor) for detid in detid_list],
+                    darksub = kwargs.get('darksub', False), event_mask = event_mask)
+            else:
+                data_results = [None] * len(detid_list)
+            def one_detid(detid, data_result):
                 dataset = XRDset(dataref, detid, compound_list, mask = mask,
                         event_data_getter = event_data_getter, frame_processor = frame_processor,
-                        event_mask = event_mask, **kwargs)
+                        event_mask = event_mask, data_result = data_result, **kwargs)
                 return Pattern.from_xrdset(dataset, label = dataset.label, bgsub = bgsub, starting_values = starting_values,
                         fixed_params = fixed_params, **kwargs)
-            return reduce(operator.add, map(one_detid, detid_list))
+            return reduce(operator.add, map(one_detid, detid_list, data_results))
 
         self.patterns =\
                 [pattern_one_dataref(dataref, event_mask = event_mask)
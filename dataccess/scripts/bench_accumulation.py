@@ -0,0 +1,62 @@
+"""
+Benchmark psget's per-pixel accumulators (see config.accumulation_dtype and
+config.accumulate_moments) on synthetic CSPAD-sized frames, and report their
+time per frame and their error relative to a float64 reference.
+
+All modes start from the same raw int16 frames, and the timed loop includes
+the per-frame conversion to the accumulation dtype that
+psget.get_area_detector_subregion performs. The 'float32 plain' mode is an
+uncompensated float32 sum, for comparison with the Kahan-compensated one
+that psget uses.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from dataccess import accumulators
+
+def bench(make, dtype, frames):
+    acc = make()
+    start = time.time()
+    for frame in frames:
+        acc.add(frame.astype(dtype))
+    stats = acc.finalize()
+    return (time.time() - start) / len(frames), stats
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('--nframes', type = int, default = 50)
+    parser.add_argument('--npixels', type = int, default = 2296960,
+        help = 'pixels per frame (default: CSPAD)')
+    parser.add_argument('--block-size', type = int, default = 64)
+    args = parser.parse_args()
+
+    def accumulator(dtype, moments):
+        return lambda: accumulators.make_accumulator(dtype, args.block_size,
+            moments = moments)
+    modes = [('float64 moments', 'float64', accumulator('float64', True)),
+        ('float32 moments', 'float32', accumulator('float32', True)),
+        ('int64 moments', 'int64', accumulator('int64', True)),
+        ('float64 sum', 'float64', accumulator('float64', False)),
+        ('float32 Kahan', 'float32', accumulator('float32', False)),
+        ('float32 plain', 'float32', lambda: accumulators.PixelSum('float32')),
+        ('int64 sum', 'int64', accumulator('int64', False))]
+
+    np.random.seed(0)
+    adu = np.random.poisson(1000., size = (args.nframes, args.npixels)).astype('int16')
+    reference = None
+    for name, dtype, make in modes:
+        per_frame, stats = bench(make, dtype, adu)
+        if reference is None:
+            reference = stats
+        mean_error = np.max(np.abs(stats.mean - reference.mean) / np.abs(reference.mean))
+        if stats.has_moments():
+            std_error = '%.2e' % np.max(np.abs(stats.std() - reference.std()))
+        else:
+            std_error = '-'
+        print '%16s: %7.2f ms/frame, max relative mean error %.2e, max |std error| %s' % (
+            name, 1e3 * per_frame, mean_error, std_error)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+from dataccess import accumulators
+import numpy as np
+
+def make_frames():
+    np.random.seed(0)
+    return np.random.normal(100., 5., size = (30, 4, 6))
+
+def check_stats(stats, frames):
+    assert stats.count == len(frames)
+    assert np.allclose(stats.mean, frames.mean(axis = 0))
+    assert np.allclose(stats.variance(), frames.var(axis = 0))
+    assert np.allclose(stats.variance(ddof = 1), frames.var(axis = 0, ddof = 1))
+    assert np.all(stats.min == frames.min(axis = 0))
+    assert np.all(stats.max == frames.max(axis = 0))
+
+def test_streaming():
+    frames = make_frames()
+    stats = accumulators.PixelStats()
+    for frame in frames:
+        stats.add(frame)
+    check_stats(stats, frames)
+    check_stats(accumulators.PixelStats.from_frames(frames), frames)
+
+def test_merge():
+    frames = make_frames()
+    partials = [accumulators.PixelStats.from_frames(frames[:7]),
+        None,
+        accumulators.PixelStats(),
+        accumulators.PixelStats.from_frames(frames[7:20]),
+        accumulators.PixelStats.from_frames(frames[20:])]
+    check_stats(accumulators.merge_all(partials), frames)
+    shifted = accumulators.merge_all(partials).shift(frames[0])
+    check_stats(shifted, frames - frames[0])
+
+def test_merge_in_place_leaves_inputs():
+    frames = make_frames()
+    first = accumulators.PixelStats.from_frames(frames[:10])
+    m2 = first.m2.copy()
+    total = accumulators.PixelStats().merge_in_place(first.shift(frames[0]))
+    total.merge_in_place(accumulators.PixelStats.from_frames(frames[10:]).shift(frames[0]))
+    check_stats(total, frames - frames[0])
+    assert np.all(first.m2 == m2)
+    assert first.astype('float32').copy().dtype == 'float32'
+
+def test_reduced_precision():
+    frames = make_frames()
+    blocked = accumulators.make_accumulator('float32', block_size = 8)
+    for frame in frames:
+        blocked.add(frame)
+    stats = blocked.finalize()
+    assert stats.count == len(frames)
+    assert stats.mean.dtype == np.float64
+    assert np.allclose(stats.mean, frames.mean(axis = 0), rtol = 1e-6)
+    assert np.allclose(stats.variance(), frames.var(axis = 0), rtol = 1e-4)
+
+    adu = np.round(frames * 10).astype('int16')
+    exact = accumulators.make_accumulator('int64')
+    for frame in adu:
+        exact.add(frame)
+    check_stats(exact.finalize(), adu.astype('float64'))
+    # non-integer frames switch to float64 accumulation
+    exact.add(frames[0])
+    check_stats(exact.finalize(), np.concatenate((adu, frames[:1])))
+
+def test_sum_only():
+    frames = make_frames()
+    acc = accumulators.make_accumulator('float64', moments = False)
+    for frame in frames[:10]:
+        acc.add(frame)
+    stats = acc.finalize()
+    assert not stats.has_moments()
+    assert np.allclose(stats.mean, frames[:10].mean(axis = 0))
+    try:
+        stats.variance()
+    except ValueError:
+        pass
+    else:
+        assert False
+    # merging with full statistics keeps the mean only
+    merged = stats.merge(accumulators.PixelStats.from_frames(frames[10:]))
+    assert merged.count == len(frames) and not merged.has_moments()
+    assert np.allclose(merged.mean, frames.mean(axis = 0))
+    assert np.allclose(merged.shift(frames[0]).mean, (frames - frames[0]).mean(axis = 0))
+
+    adu = np.round(frames * 10).astype('int16')
+    exact = accumulators.make_accumulator('int64', moments = False)
+    for frame in adu:
+        exact.add(frame)
+    assert exact.sum.dtype == np.int64
+    assert np.all(exact.finalize().mean == adu.mean(axis = 0))
+
+def test_compensated_sum():
+    np.random.seed(1)
+    # float32 rounding of a plain sum of this many frames is well above 1e-7
+    frames = np.random.uniform(1000., 1001., size = (20000, 3)).astype('float32')
+    acc = accumulators.make_accumulator('float32', moments = False)
+    for frame in frames:
+        acc.add(frame)
+    stats = acc.finalize()
+    assert stats.count == len(frames) and stats.mean.dtype == np.float64
+    exact = frames.astype('float64').mean(axis = 0)
+    assert np.all(np.abs(stats.mean - exact) <= 2.5e-7 * exact)
@@ -0,0 +1,54 @@
+import os
+import tempfile
+import time
+
+from dataccess import cache
+
+def test_store_load_evict():
+    store = cache.DiskCache(tempfile.mkdtemp(), max_bytes = None)
+    try:
+        store.load('ns', 'missing')
+    except KeyError:
+        pass
+    else:
+        assert False
+    payload = 'x' * 1000
+    for i in range(4):
+        store.store('ns', str(i), payload)
+        # distinct access times for LRU ordering
+        os.utime(store.path('ns', str(i)), (time.time() - 100 + i, time.time() - 100 + i))
+    assert store.load('ns', '0') == payload # refreshes entry 0
+    assert store.hits == 1 and store.misses == 1
+    count, nbytes, _ = store.summary()['ns']
+    assert count == 4
+    removed, freed = store.prune(max_bytes = 2 * nbytes / 4)
+    assert removed == 2
+    assert sorted(os.path.basename(path) for path, _, _ in store.entries()) == ['0', '3']
+    store.clear('ns')
+    assert store.entries() == []
+
+def test_memmapped_arrays():
+    import numpy as np
+    store = cache.DiskCache(tempfile.mkdtemp())
+    frame = np.arange(300000.)
+    store.store('ns', 'key', {'mean': frame, 'shared': frame, 'small': np.ones(3)})
+    value = store.load('ns', 'key')
+    assert isinstance(value['mean'], np.memmap)
+    assert np.all(value['mean'] == frame) and np.all(value['shared'] == frame)
+    assert not isinstance(value['small'], np.memmap)
+    # copy-on-write: modifying the loaded array leaves the entry unchanged
+    value['mean'][0] = -1.
+    assert store.load('ns', 'key')['mean'][0] == 0.
+    (path, size, _), = store.entries()
+    assert size > frame.nbytes
+    store.clear()
+    assert store.entries() == []
+
+def test_budget():
+    payload = 'x' * 1000
+    store = cache.DiskCache(tempfile.mkdtemp(), max_bytes = 3500)
+    for i in range(6):
+        store.store('ns', str(i), payload, shared = False)
+        assert store.size <= 3500
+    assert len(store.entries()) == 3
+    assert store.evictions == 3
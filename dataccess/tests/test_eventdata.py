@@ -0,0 +1,45 @@
+from dataccess import eventdata
+import numpy as np
+import pickle
+
+def make_dict():
+    return {5: {3: np.arange(3.), 1: np.ones(3)}, 2: {7: np.zeros(3)}}
+
+def test_from_dict():
+    ed = eventdata.EventData.from_dict(make_dict())
+    assert ed.nevents() == 3
+    assert list(ed.runs) == [2, 5, 5] and list(ed.events) == [7, 1, 3]
+    assert ed.flat().shape == (3, 3)
+    assert np.all(ed[5][3] == np.arange(3.))
+    assert 1 in ed[5] and 7 not in ed[5]
+    assert sorted(ed.keys()) == [2, 5]
+    assert set(ed.to_dict()[5].keys()) == set([1, 3])
+    restored = pickle.loads(pickle.dumps(ed, protocol = 2))
+    assert np.all(restored.flat() == ed.flat())
+    assert np.all(restored[2][7] == 0)
+
+def test_object_values():
+    ed = eventdata.EventData.from_dict({1: {0: 'a', 1: (1, 2, 3)}})
+    assert ed.flat().dtype == object
+    assert ed[1][1] == (1, 2, 3)
+
+def test_join_and_merge():
+    ed1 = eventdata.EventData([1, 1, 2, 3], [0, 1, 0, 0], [10., 11., 20., 30.])
+    ed2 = eventdata.EventData.from_dict({2: {0: 200.}, 1: {1: 110., 5: 150.}})
+    left, right = ed1.join(ed2)
+    assert list(left.flat()) == [11., 20.]
+    assert list(right.flat()) == [110., 200.]
+    merged = ed1.merge(ed2)
+    assert merged.nevents() == 5
+    assert merged[1][1] == 110.
+    assert merged[3][0] == 30.
+
+def test_merge_all():
+    ed1 = eventdata.EventData([1, 1], [0, 1], [10., 11.])
+    ed2 = eventdata.EventData([2], [0], [20.])
+    ed3 = eventdata.EventData([1], [1], [110.])
+    disjoint = eventdata.merge_all([ed2, eventdata.EventData(), ed1])
+    assert list(disjoint.flat()) == [10., 11., 20.]
+    overlapping = eventdata.merge_all([ed1, ed2, ed3])
+    assert overlapping.nevents() == 3
+    assert overlapping[1][1] == 110.
@@ -0,0 +1,30 @@
+from dataccess import eventmask
+import numpy as np
+import pickle
+
+def test_dict_round_trip():
+    legacy = {3: {0: True, 1: False, 2: True}, 4: {1: True}}
+    mask = eventmask.EventMask.from_dict(legacy)
+    assert mask.count() == 3
+    assert mask[3][2] and not mask[3][1]
+    assert 2 in mask[3] and 5 not in mask[3]
+    assert not mask.is_valid(4, 0) and mask.is_valid(4, 1)
+    assert not mask.is_valid(7, 0)
+    assert mask.to_dict() == {3: {0: True, 1: False, 2: True}, 4: {0: False, 1: True}}
+    assert pickle.loads(pickle.dumps(mask, protocol = 2)) == mask
+
+def test_from_events():
+    mask = eventmask.EventMask.from_events([1, 2], [[0, 5, 20], []], 10)
+    assert list(mask[1].accepted()) == [0, 5]
+    assert mask[2].count() == 0
+    assert len(mask[1]) == 10
+
+def test_logic():
+    a = eventmask.EventMask({1: [True, True, False], 2: [True]})
+    b = eventmask.EventMask({1: [False, True, True, True]})
+    assert list((a & b)[1].accepted()) == [1]
+    assert 2 not in (a & b)
+    assert list((a | b)[1].accepted()) == [0, 1, 2, 3]
+    assert list((a | b)[2].accepted()) == [0]
+    assert list((~a)[1].accepted()) == [2]
+    assert (a & {1: {0: True}})[1].count() == 1
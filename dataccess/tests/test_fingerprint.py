@@ -0,0 +1,38 @@
+import numpy as np
+
+from dataccess import fingerprint
+
+def make_processor(scale, offset):
+    def processor(imarr, **kwargs):
+        return imarr * scale + offset
+    return processor
+
+def test_arrays():
+    arr = np.arange(24.).reshape((4, 6))
+    assert fingerprint.fingerprint(arr) == fingerprint.fingerprint(arr.copy())
+    # non-contiguous arrays hash like their contiguous copies
+    assert fingerprint.fingerprint(arr.T) == fingerprint.fingerprint(np.ascontiguousarray(arr.T))
+    assert fingerprint.fingerprint(arr) != fingerprint.fingerprint(arr.astype('float32'))
+    assert fingerprint.fingerprint(arr) != fingerprint.fingerprint(arr.reshape((6, 4)))
+    modified = arr.copy()
+    modified[3, 5] += 1
+    assert fingerprint.fingerprint(arr) != fingerprint.fingerprint(modified)
+
+def test_closures():
+    f1, f2 = make_processor(2., 1.), make_processor(2., 1.)
+    assert f1 is not f2
+    assert fingerprint.fingerprint(f1) == fingerprint.fingerprint(f2)
+    assert fingerprint.fingerprint(f1) != fingerprint.fingerprint(make_processor(2., 0.))
+    assert fingerprint.fingerprint(lambda x: x + 1) != fingerprint.fingerprint(lambda x: x + 2)
+
+def test_containers():
+    d1 = dict((i, str(i)) for i in range(20))
+    d2 = dict((i, str(i)) for i in reversed(range(20)))
+    assert fingerprint.fingerprint(d1) == fingerprint.fingerprint(d2)
+    assert fingerprint.fingerprint((1, 2)) != fingerprint.fingerprint([1, 2])
+    assert fingerprint.fingerprint(1) != fingerprint.fingerprint(1.)
+    shared = [1]
+    assert fingerprint.fingerprint([shared, shared]) != fingerprint.fingerprint([[1], [2]])
+    cyclic = []
+    cyclic.append(cyclic)
+    fingerprint.fingerprint(cyclic)
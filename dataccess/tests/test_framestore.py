@@ -0,0 +1,123 @@
+import os
+import pickle
+import tempfile
+
+import numpy as np
+
+import config
+
+from dataccess import eventdata
+from dataccess import framestore
+
+def write_column(frames):
+    writer = framestore.FrameWriter(os.path.join(tempfile.mkdtemp(), 'frames.h5'))
+    rows = [writer.append(frame) for frame in frames]
+    writer.close()
+    return writer.column(rows)
+
+def test_frame_column():
+    np.random.seed(0)
+    frames = np.random.normal(size = (5, 3, 4))
+    column = write_column(frames)
+    assert column.shape == frames.shape
+    assert np.all(column[2] == frames[2])
+    assert np.all(np.asarray(column[[4, 0]]) == frames[[4, 0]])
+    assert np.all(np.array(list(column[1:3])) == frames[1:3])
+    # pickles to references only
+    restored = pickle.loads(pickle.dumps(column))
+    assert np.all(np.asarray(restored) == frames)
+
+def test_lazy_event_data():
+    np.random.seed(1)
+    frames = np.random.normal(size = (6, 2, 2))
+    first = eventdata.EventData([1, 1, 1], [4, 0, 2], write_column(frames[:3]))
+    second = eventdata.EventData([2, 2, 2], [0, 1, 2], write_column(frames[3:]))
+    assert np.all(first[1][4] == frames[0])
+    merged = eventdata.merge_all([first, second])
+    assert isinstance(merged.data, framestore.FrameColumn)
+    assert len(merged.data.paths) == 2
+    assert np.all(merged[1][2] == frames[2])
+    assert np.all(merged[2].values()[1] == frames[4])
+    assert np.all(np.asarray(merged.intersection(second).data) == frames[3:])
+
+def test_mixed_column():
+    np.random.seed(3)
+    frames = np.random.normal(size = (3, 2, 2))
+    stored = eventdata.EventData([1, 1, 1], [0, 2, 4], write_column(frames))
+    in_memory = eventdata.EventData([1, 1], [1, 3], [1., 2.])
+    merged = eventdata.concatenate([in_memory, stored])
+    assert isinstance(merged.data, framestore.FrameColumn)
+    assert merged.data.frame_shape == (2, 2)
+    assert list(merged.events) == range(5)
+    assert merged[1][3] == 2.
+    assert np.all(merged[1][4] == frames[2])
+    values = list(pickle.loads(pickle.dumps(merged.data)))
+    assert values[1] == 1. and np.all(values[2] == frames[1])
+
+def test_accepts():
+    old = config.frame_store_min_bytes
+    config.frame_store_min_bytes = 64
+    try:
+        writer = framestore.FrameWriter()
+        assert writer.accepts(np.zeros((4, 4)))
+        assert not writer.accepts(np.zeros(2))
+        assert not writer.accepts(None)
+    finally:
+        config.frame_store_min_bytes = old
+
+def test_shards():
+    old = config.frame_store_dir, config.frame_store_min_bytes
+    config.frame_store_dir = tempfile.mkdtemp()
+    config.frame_store_min_bytes = 64
+    try:
+        np.random.seed(2)
+        frames = np.random.normal(size = (4, 3, 3))
+        ed = eventdata.EventData([3, 3, 5, 5], [0, 7, 1, 2], frames)
+        entry = framestore.write_shard(ed)
+        assert entry.format == 'hdf5' and entry.nevents == 4 and entry.keep
+        restored = framestore.read_shard(entry)
+        assert isinstance(restored.data, framestore.FrameColumn)
+        assert np.all(restored[5][2] == frames[3])
+        scalars = eventdata.EventData([1, 1], [0, 1], [1., 2.])
+        restored = framestore.read_shard(framestore.write_shard(scalars))
+        assert np.all(restored.flat() == [1., 2.])
+        # per-value threshold: many small values are read into memory
+        many = eventdata.EventData([1] * 20, range(20), np.arange(20.))
+        entry = framestore.write_shard(many)
+        assert not entry.keep
+        assert np.all(framestore.read_shard(entry).flat() == np.arange(20.))
+        objects = eventdata.EventData([1, 1], [0, 1], ['a', 'bc'])
+        entry = framestore.write_shard(objects)
+        assert entry.format == 'pickle'
+        assert list(framestore.read_shard(entry).flat()) == ['a', 'bc']
+    finally:
+        config.frame_store_dir, config.frame_store_min_bytes = old
+
+class SingleRankComm(object):
+    def Get_rank(self):
+        return 0
+    def gather(self, obj, root = 0):
+        return [obj]
+    def bcast(self, obj, root = 0):
+        return obj
+    def Bcast(self, buf, root = 0):
+        pass
+
+def test_gather():
+    old = config.frame_store_dir, config.frame_store_min_bytes
+    config.frame_store_dir = tempfile.mkdtemp()
+    config.frame_store_min_bytes = 64
+    try:
+        np.random.seed(4)
+        frames = np.random.normal(size = (3, 3, 3))
+        ed = eventdata.EventData([2, 2, 2], [0, 1, 2], frames)
+        merged = framestore.gather_event_data(SingleRankComm(), ed)
+        assert isinstance(merged.data, framestore.FrameColumn)
+        assert np.all(merged[2][1] == frames[1])
+        # shards of small values are read and removed
+        scalars = eventdata.EventData([1, 1], [0, 1], [1., 2.])
+        merged = framestore.gather_event_data(SingleRankComm(), scalars)
+        assert np.all(merged.flat() == [1., 2.])
+        assert len(os.listdir(config.frame_store_dir)) == 1
+    finally:
+        config.frame_store_dir, config.frame_store_min_bytes = old
@@ -6,3 +6,13 @@ def test_makemask():
     target = np.array([[False, False, False, False, False,  True, False, False],
        [False, False, False, False, False,  True, False, False]], dtype=bool)
     assert np.all(maskmaker.makemask(image, 1) == target)
+
+def test_makemask_matches_neighbor_search():
+    image = np.random.uniform(0., 1., (20, 30))
+    image[image < 0.1] = 0.
+    for avoidby in [0, 1, 2, 2.5]:
+        expected = np.array(
+            [[not maskmaker.has_zero_neighbors(image, x, y, image.shape[0], image.shape[1], avoidby)
+                for y in range(image.shape[1])]
+                for x in range(image.shape[0])])
+        assert np.all(maskmaker.makemask(image, avoidby) == expected)
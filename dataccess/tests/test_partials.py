@@ -0,0 +1,40 @@
+import tempfile
+import numpy as np
+
+import config
+
+from dataccess import partials
+
+def test_store_load():
+    old = config.cache_dir
+    config.cache_dir = tempfile.mkdtemp()
+    try:
+        key = partials.partial_key(5, ('quad1', None, None, None), frame_processor = None)
+        assert key != partials.partial_key(6, ('quad1', None, None, None), frame_processor = None)
+        assert partials.load(key) is None
+        partials.store(key, (np.ones(3), {}, 2))
+        mean, event_data, count = partials.load(key)
+        assert np.all(mean == 1) and count == 2
+    finally:
+        config.cache_dir = old
+
+def test_key_depends_on_config():
+    spec = ('quad1', None, None, None)
+    old = config.testing
+    try:
+        config.testing = False
+        key = partials.partial_key(5, spec)
+        config.testing = True
+        assert partials.partial_key(5, spec) != key
+    finally:
+        config.testing = old
+
+def test_key_depends_on_detinfo():
+    spec = ('quad1', None, None, None)
+    old = config.detinfo_map['quad1']
+    try:
+        key = partials.partial_key(5, spec)
+        config.detinfo_map['quad1'] = old._replace(subregion_index = 2)
+        assert partials.partial_key(5, spec) != key
+    finally:
+        config.detinfo_map['quad1'] = old
@@ -0,0 +1,47 @@
+from dataccess import peakfinder
+import numpy as np
+
+def make_frame():
+    frame = np.zeros((50, 60))
+    frame[10:13, 20:23] = 30.
+    frame[11, 21] = 200.
+    frame[40, 40] = 160.
+    frame[40, 41] = 40.
+    # below thr_high: not a peak
+    frame[25, 5] = 100.
+    return frame
+
+def test_find_peaks():
+    peaks = peakfinder.find_peaks(make_frame(), thr_low = 10, thr_high = 150, radius = 3)
+    assert len(peaks) == 2
+    first, second = peaks
+    assert (first['row'], first['col']) == (11, 21)
+    assert first['npix'] == 9
+    assert np.isclose(first['amp_total'], 8 * 30. + 200.)
+    assert np.isclose(first['row_cgrav'], 11.) and np.isclose(first['col_cgrav'], 21.)
+    assert np.isclose(second['amp_total'], 200.)
+    assert np.isclose(second['col_cgrav'], 40.2)
+
+def test_consolidate_peaks_stack():
+    stack = np.array([make_frame(), np.zeros((50, 60)), make_frame()])
+    consolidated = peakfinder.consolidate_peaks_stack(stack, thr_low = 10, thr_high = 150, radius = 3)
+    assert np.all(consolidated[1] == 0)
+    assert np.all(consolidated[0] == consolidated[2])
+    assert np.isclose(consolidated[0][11, 21], 440.)
+    assert np.all(consolidated[0] == peakfinder.consolidate_peaks(make_frame(),
+        thr_low = 10, thr_high = 150, radius = 3, method = 'numpy'))
+
+def test_matches_psana():
+    try:
+        import ImgAlgos
+    except ImportError:
+        return
+    np.random.seed(0)
+    frames = [make_frame(), make_frame() + np.random.uniform(0, 5, size = (50, 60))]
+    for frame in frames:
+        numpy_result = peakfinder.consolidate_peaks(frame, thr_low = 10, thr_high = 150,
+            radius = 3, method = 'numpy')
+        psana_result = peakfinder.consolidate_peaks(frame, thr_low = 10, thr_high = 150,
+            radius = 3, method = 'psana')
+        assert np.all(np.nonzero(numpy_result)[0] == np.nonzero(psana_result)[0])
+        assert np.allclose(numpy_result, psana_result)
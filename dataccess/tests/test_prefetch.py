@@ -0,0 +1,44 @@
+from dataccess import prefetch
+
+def events(n):
+    for nevent in range(n):
+        yield nevent, {'value': nevent}
+
+def test_prefetch_order():
+    for depth in (0, 3):
+        prefetcher = prefetch.EventPrefetcher(events(20),
+            lambda evt: evt['value'] * 2, depth = depth)
+        items = list(prefetcher)
+        assert [nevent for nevent, evt, fetched in items] == range(20)
+        assert all(fetched == 2 * nevent for nevent, evt, fetched in items)
+        assert prefetcher.nevents == 20
+
+def test_prefetch_exception():
+    def fetch(evt):
+        if evt['value'] == 5:
+            raise ValueError('bad event')
+        return evt['value']
+    prefetcher = prefetch.EventPrefetcher(events(10), fetch, depth = 2)
+    seen = []
+    try:
+        for nevent, evt, fetched in prefetcher:
+            seen.append(nevent)
+    except ValueError:
+        pass
+    else:
+        assert False
+    assert seen == range(5)
+
+def test_prefetch_deferred_on_consumer_thread():
+    import threading
+    threads = []
+    def deferred_events(n):
+        for nevent in range(n):
+            # the event source runs on the consumer's thread
+            threads.append(threading.current_thread())
+            yield nevent, lambda nevent = nevent: {'value': nevent}
+    prefetcher = prefetch.EventPrefetcher(deferred_events(10),
+        lambda evt: evt['value'], depth = 3, deferred = True)
+    items = list(prefetcher)
+    assert [fetched for nevent, evt, fetched in items] == range(10)
+    assert set(threads) == set([threading.current_thread()])
@@ -0,0 +1,31 @@
+import numpy as np
+
+from dataccess import accumulators
+from dataccess import eventdata
+from dataccess import sharedmem
+
+def test_shared_reduction():
+    np.random.seed(0)
+    frames = np.random.normal(10., 2., size = (12, 3, 4))
+    prefix = sharedmem.new_prefix()
+    try:
+        shared = []
+        for i, (start, stop) in enumerate([(0, 5), (5, 5), (5, 12)]):
+            slot = sharedmem.StatsSlot('%s-%d' % (prefix, i))
+            stats = accumulators.PixelStats()
+            for frame in frames[start:stop]:
+                stats.add(frame)
+                slot.track(stats)
+            ed = eventdata.EventData([1] * (stop - start), range(start, stop),
+                frames[start:stop, 0, 0])
+            shared.append(sharedmem.export_partial(slot, stats, ed, stop - start))
+        pixel_stats, event_data, events_processed = sharedmem.reduce_partials(shared)
+    finally:
+        sharedmem.cleanup(prefix)
+    assert events_processed == 12
+    assert pixel_stats.count == 12
+    assert np.allclose(pixel_stats.mean, frames.mean(axis = 0))
+    assert np.allclose(pixel_stats.variance(), frames.var(axis = 0))
+    assert np.all(pixel_stats.max == frames.max(axis = 0))
+    assert list(event_data.events) == range(12)
+    assert np.allclose(event_data.flat(), frames[:, 0, 0])
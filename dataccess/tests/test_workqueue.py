@@ -0,0 +1,33 @@
+from dataccess import workqueue
+
+def test_chunk_queue_covers_range():
+    queue = workqueue.ChunkQueue(103, workqueue.LocalCounter(), chunksize = 10)
+    chunks = list(queue)
+    assert chunks[0] == (0, 10)
+    assert chunks[-1] == (100, 103)
+    nevents = [n for start, stop in chunks for n in range(start, stop)]
+    assert nevents == range(103)
+    assert queue.next_chunk() is None
+
+def test_worker_stats():
+    counter = workqueue.LocalCounter()
+    stats = [workqueue.WorkerStats(i) for i in range(2)]
+    first, second = [s.iter_events(workqueue.ChunkQueue(25, counter, chunksize = 4))
+        for s in stats]
+    # the first worker stalls inside its first chunk while the second one
+    # drains the rest of the queue
+    seen = [next(first)]
+    seen.extend(second)
+    seen.extend(first)
+    assert sorted(seen) == range(25)
+    assert stats[0].nevents == 4 and stats[0].nchunks == 1
+    assert stats[1].nevents == 21
+    utilization = workqueue.report_utilization(stats, 1.)
+    assert set(utilization.keys()) == set([0, 1])
+
+def test_assign_runs():
+    costs = [100, 10, 60, 50, 0, 40]
+    groups = workqueue.assign_runs(costs, 2)
+    assert sorted(i for group in groups for i in group) == range(len(costs))
+    assert groups == [[0, 5], [1, 2, 3, 4]]
+    assert workqueue.assign_runs([5, 3], 3)[2] == []
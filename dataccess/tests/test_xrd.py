@@ -88,3 +88,46 @@ def test_peak_sizes():
     assert np.isclose(np.mean(arr), -68.242721825892659)
     peakarr = my_200_array(arr)
     assert np.isclose(peakarr, np.array([  1.10760626,  24.60676483,   0.85673761])).all()
+
+def test_azimuthal_integrator():
+    beta = np.random.uniform(10., 60., (40, 50))
+    arr = np.random.uniform(0., 10., (40, 50))
+    arr[arr < 2.] = 0.
+    nbins = 30
+    integrator = geometry.AzimuthalIntegrator(beta, nbins)
+
+    # reference: per-pixel binning loop
+    thetas, intens = beta.flatten(), arr.flatten()
+    mi, ma = min(thetas), max(thetas)
+    stepsize = (ma - mi)/nbins
+    numPix = np.zeros(nbins + 1)
+    intenValue = np.zeros(nbins + 1)
+    for theta, value in zip(thetas, intens):
+        if value != 0:
+            k = int(np.floor((theta - mi)/stepsize))
+            numPix[k] += 1
+            intenValue[k] += value
+    expected = np.nan_to_num(intenValue/numPix)
+    assert np.all(np.isclose(integrator.integrate(arr), expected))
+    assert len(integrator.binangles) == nbins + 1
+
+def test_integrate_stack():
+    beta = np.random.uniform(10., 60., (40, 50))
+    stack = np.random.uniform(0., 10., (5, 40, 50))
+    integrator = geometry.AzimuthalIntegrator(beta, 30)
+    batched = integrator.integrate_stack(stack)
+    assert batched.shape == (5, 31)
+    for frame, pattern in zip(stack, batched):
+        assert np.all(np.isclose(integrator.integrate(frame), pattern))
+
+def test_geometry_maps():
+    arr = np.zeros((830, 825))
+    params = geometry.get_detid_parameters('quad2')
+    beta, rho = geometry.get_beta_rho(arr, *params)
+    assert beta.dtype == np.float32
+    reference = geometry._compute_maps(arr.shape, *params)
+    assert np.allclose(beta, reference['beta'], rtol = 1e-5)
+    assert np.allclose(rho, reference['rho'], rtol = 1e-5)
+    # maps are computed once per geometry and shape
+    assert geometry.get_geometry_maps('quad2', arr.shape) is\
+        geometry.get_geometry_maps('quad2', arr.shape)